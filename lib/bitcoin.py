@@ -36,6 +36,7 @@ from .util import bfh, bh2u, to_string
 from . import version
 from .util import print_error, InvalidPassword, assert_bytes, to_bytes, inv_dict
 from . import segwit_addr
+from . import ecc_backend
 
 def read_json(filename, default):
     path = os.path.join(os.path.dirname(__file__), filename)
@@ -559,9 +560,8 @@ def is_compressed(sec):
 
 
 def public_key_from_private_key(pk, compressed):
-    pkey = regenerate_key(pk)
-    public_key = GetPubKey(pkey.pubkey, compressed)
-    return bh2u(public_key)
+    assert len(pk) == 32
+    return bh2u(ecc_backend.backend.pubkey_from_secret(pk, compressed))
 
 def address_from_private_key(sec):
     txin_type, privkey, compressed = deserialize_privkey(sec)
@@ -626,17 +626,14 @@ def verify_message(address, sig, message):
     assert_bytes(sig, message)
     try:
         h = Hash(msg_magic(message))
-        public_key, compressed = pubkey_from_signature(sig, h)
+        pubkey, compressed = recover_pubkey(sig, h)
         # check public key using the address
-        pubkey = point_to_ser(public_key.pubkey.point, compressed)
         for txin_type in ['p2pkh','p2wpkh','p2wpkh-p2sh']:
             addr = pubkey_to_address(txin_type, bh2u(pubkey))
             if address == addr:
                 break
         else:
             raise Exception("Bad signature")
-        # check message
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
         return True
     except Exception as e:
         print_error("Verification error: {0}".format(e))
@@ -716,7 +713,7 @@ class MyVerifyingKey(ecdsa.VerifyingKey):
         return klass.from_public_point( Q, curve )
 
 
-def pubkey_from_signature(sig, h):
+def decode_signature_header(sig):
     if len(sig) != 65:
         raise Exception("Wrong encoding")
     nV = sig[0]
@@ -728,9 +725,25 @@ def pubkey_from_signature(sig, h):
     else:
         compressed = False
     recid = nV - 27
+    return recid, compressed
+
+
+def pubkey_from_signature(sig, h):
+    recid, compressed = decode_signature_header(sig)
     return MyVerifyingKey.from_signature(sig[1:], recid, h, curve = SECP256k1), compressed
 
 
+def recover_pubkey(sig, h):
+    """Serialized public key of a 65-byte message signature, checked
+    against h, and whether it is compressed."""
+    recid, compressed = decode_signature_header(sig)
+    r, s = ecdsa.util.sigdecode_string(sig[1:], generator_secp256k1.order())
+    pubkey = ecc_backend.backend.recover(r, s, recid, h, compressed)
+    if pubkey is None or not ecc_backend.backend.verify(pubkey, r, s, h):
+        raise Exception("Bad signature")
+    return pubkey, compressed
+
+
 class MySigningKey(ecdsa.SigningKey):
     """Enforce low S values in signatures"""
 
@@ -756,11 +769,11 @@ class EC_KEY(object):
         return bh2u(point_to_ser(self.pubkey.point, compressed))
 
     def sign(self, msg_hash):
-        private_key = MySigningKey.from_secret_exponent(self.secret, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
-        signature = private_key.sign_digest_deterministic(msg_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_string)
-        assert public_key.verify_digest(signature, msg_hash, sigdecode = ecdsa.util.sigdecode_string)
-        return signature
+        order = generator_secp256k1.order()
+        secret = number_to_string(self.secret, order)
+        r, s = ecc_backend.backend.sign(secret, msg_hash)
+        assert ecc_backend.backend.verify(point_to_ser(self.pubkey.point), r, s, msg_hash)
+        return ecdsa.util.sigencode_string(r, s, order)
 
     def sign_message(self, message, is_compressed):
         message = to_bytes(message, 'utf8')
@@ -778,12 +791,10 @@ class EC_KEY(object):
     def verify_message(self, sig, message):
         assert_bytes(message)
         h = Hash(msg_magic(message))
-        public_key, compressed = pubkey_from_signature(sig, h)
+        pubkey, compressed = recover_pubkey(sig, h)
         # check public key
-        if point_to_ser(public_key.pubkey.point, compressed) != point_to_ser(self.pubkey.point, compressed):
+        if pubkey != point_to_ser(self.pubkey.point, compressed):
             raise Exception("Bad signature")
-        # check message
-        public_key.verify_digest(sig[1:], h, sigdecode = ecdsa.util.sigdecode_string)
 
 
     # ECIES encryption/decryption methods; AES-128-CBC with PKCS7 is used as the cipher; hmac-sha256 is used as the mac
@@ -840,10 +851,8 @@ BIP32_PRIME = 0x80000000
 
 def get_pubkeys_from_secret(secret):
     # public key
-    private_key = ecdsa.SigningKey.from_string( secret, curve = SECP256k1 )
-    public_key = private_key.get_verifying_key()
-    K = public_key.to_string()
-    K_compressed = GetPubKey(public_key.pubkey,True)
+    K = ecc_backend.backend.pubkey_from_secret(secret, False)[1:]
+    K_compressed = ecc_backend.backend.pubkey_from_secret(secret, True)
     return K, K_compressed
 
 
@@ -862,8 +871,7 @@ def CKD_priv(k, c, n):
 
 def _CKD_priv(k, c, s, is_prime):
     order = generator_secp256k1.order()
-    keypair = EC_KEY(k)
-    cK = GetPubKey(keypair.pubkey,True)
+    cK = ecc_backend.backend.pubkey_from_secret(k, True)
     data = bytes([0]) + k + s if is_prime else cK + s
     I = hmac.new(c, data, hashlib.sha512).digest()
     k_n = number_to_string( (string_to_number(I[0:32]) + string_to_number(k)) % order , order )
@@ -882,13 +890,9 @@ def CKD_pub(cK, c, n):
 
 # helper function, callable with arbitrary string
 def _CKD_pub(cK, c, s):
-    order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
-    curve = SECP256k1
-    pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
-    public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
+    cK_n = ecc_backend.backend.tweak_add_pubkey(cK, string_to_number(I[0:32]))
     c_n = I[32:]
-    cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
 
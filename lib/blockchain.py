@@ -21,6 +21,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import gzip
+import mmap
+import struct
+import time
+import hashlib
 import threading
 
 from . import util
@@ -28,6 +33,11 @@ from . import bitcoin
 from .bitcoin import *
 
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+HASH_CACHE_SIZE = 4096
+TARGET_CACHE_SIZE = 256
+HEADER_INDEX_SIZE = 4 * HASH_CACHE_SIZE
+# gzip stream: magic, big-endian uint32 number of chunks, raw headers
+SNAPSHOT_MAGIC = b'electrum-headers\x01'
 
 def serialize_header(res):
     s = int_to_hex(res.get('version'), 4) \
@@ -58,7 +68,53 @@ def hash_header(header):
     return hash_encode(Hash(bfh(serialize_header(header))))
 
 
+class HeaderStore(object):
+    """
+    Read-only memory map of a headers file. Blockchain re-maps it
+    whenever the underlying file is rewritten or renamed.
+    """
+
+    def __init__(self):
+        self.mm = None
+
+    def map(self, path):
+        self.close()
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def read(self, offset, length):
+        if self.mm is None or offset + length > len(self.mm):
+            return None
+        return self.mm[offset:offset+length]
+
+
 blockchains = {}
+# block hash -> Blockchain whose own file holds that header.  Entries
+# are hints; they are checked against the chain before being used.
+header_index = util.LRUCache(HEADER_INDEX_SIZE)
+# checkpoint -> checkpoints of the direct children of that blockchain
+children = {}
+
+def update_links():
+    children.clear()
+    for b in blockchains.values():
+        if b.parent_id is not None:
+            children.setdefault(b.parent_id, set()).add(b.checkpoint)
+
+def lookup_hash(header_hash, height):
+    '''Return the blockchain holding header_hash at height, if indexed'''
+    b = header_index.get(header_hash)
+    if b is None or blockchains.get(b.checkpoint) is not b:
+        return None
+    if not (b.checkpoint <= height <= b.height()):
+        return None
+    return b if b.get_hash(height) == header_hash else None
 
 def read_blockchains(config):
     blockchains[0] = Blockchain(config, 0, None)
@@ -72,21 +128,38 @@ def read_blockchains(config):
         parent_id = int(filename.split('_')[1])
         b = Blockchain(config, checkpoint, parent_id)
         h = b.read_header(b.checkpoint)
+        if h is None:
+            # the process stopped before the first header was written
+            util.print_error("removing empty fork", filename)
+            b.store.close()
+            os.unlink(b.path())
+            continue
         if b.parent().can_connect(h, check_height=False):
             blockchains[b.checkpoint] = b
         else:
             util.print_error("cannot connect", filename)
+    update_links()
     return blockchains
 
 def check_header(header):
     if type(header) is not dict:
         return False
+    height = header.get('block_height')
+    b = lookup_hash(hash_header(header), height)
+    if b:
+        return b
+    # not indexed; only chains whose own file covers height can hold it
     for b in blockchains.values():
-        if b.check_header(header):
+        if b.checkpoint <= height <= b.height() and b.check_header(header):
             return b
     return False
 
 def can_connect(header):
+    height = header.get('block_height')
+    b = lookup_hash(header.get('prev_block_hash'), height - 1)
+    if b:
+        # no other chain holds the parent of this header
+        return b if b.can_connect(header) else False
     for b in blockchains.values():
         if b.can_connect(header):
             return b
@@ -105,15 +178,26 @@ class Blockchain(util.PrintError):
         self.checkpoints = bitcoin.NetworkConstants.CHECKPOINTS
         self.parent_id = parent_id
         self.lock = threading.Lock()
+        self.store = HeaderStore()
+        # only hold values computed from this blockchain's own file,
+        # i.e. for heights >= checkpoint
+        self.hashes = util.LRUCache(HASH_CACHE_SIZE)
+        self.targets = util.LRUCache(TARGET_CACHE_SIZE)
+        # headers appended by save_header that are not on disk yet
+        self.pending = bytearray()
+        self.last_sync = time.time()
+        self.fsync_count = config.get('headers_fsync_count', 2016)
+        self.fsync_interval = config.get('headers_fsync_interval', 10)
         with self.lock:
+            self.truncate_partial_record()
             self.update_size()
 
     def parent(self):
         return blockchains[self.parent_id]
 
     def get_max_child(self):
-        children = list(filter(lambda y: y.parent_id==self.checkpoint, blockchains.values()))
-        return max([x.checkpoint for x in children]) if children else None
+        c = children.get(self.checkpoint)
+        return max(c) if c else None
 
     def get_checkpoint(self):
         mc = self.get_max_child()
@@ -134,7 +218,12 @@ class Blockchain(util.PrintError):
         checkpoint = header.get('block_height')
         self = Blockchain(parent.config, checkpoint, parent.checkpoint)
         open(self.path(), 'w+').close()
+        # the first header is synced before the fork is registered, so
+        # that a fork file never starts without it after a crash
         self.save_header(header)
+        self.flush()
+        blockchains[checkpoint] = self
+        update_links()
         return self
 
     def height(self):
@@ -147,6 +236,21 @@ class Blockchain(util.PrintError):
     def update_size(self):
         p = self.path()
         self._size = os.path.getsize(p)//80 if os.path.exists(p) else 0
+        self._size += len(self.pending)//80
+        self.store.map(p)
+
+    def truncate_partial_record(self):
+        # a crash in the middle of a write can leave a partial header
+        p = self.path()
+        if not os.path.exists(p):
+            return
+        size = os.path.getsize(p)
+        if size % 80:
+            self.print_error("truncating partial header record", p, size)
+            with open(p, 'rb+') as f:
+                f.truncate(size - size % 80)
+                f.flush()
+                os.fsync(f.fileno())
 
     def verify_header(self, header, prev_hash, target):
         _hash = hash_header(header)
@@ -161,14 +265,33 @@ class Blockchain(util.PrintError):
             raise BaseException("insufficient proof of work: %s vs target %s" % (int('0x' + _hash, 16), target))
 
     def verify_chunk(self, index, data):
+        # works on the raw 80-byte records; hashes are kept in
+        # internal (little-endian) byte order throughout
+        if len(data) % 80:
+            raise BaseException("chunk length is not a multiple of 80: %d" % len(data))
         num = len(data) // 80
-        prev_hash = self.get_hash(index * 2016 - 1)
+        prev_hash = bfh(self.get_hash(index * 2016 - 1))[::-1]
         target = self.get_target(index-1)
+        check_pow = not bitcoin.NetworkConstants.TESTNET
+        if check_pow:
+            bits = self.target_to_bits(target)
+            raw_bits = bits.to_bytes(4, 'little')
+        sha256 = hashlib.sha256
+        view = memoryview(data)
         for i in range(num):
-            raw_header = data[i*80:(i+1) * 80]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target)
-            prev_hash = hash_header(header)
+            raw_header = view[i*80:(i+1)*80]
+            if raw_header[4:36] != prev_hash:
+                raise BaseException("prev hash mismatch at height %d" % (index*2016 + i))
+            _hash = sha256(sha256(raw_header).digest()).digest()
+            if check_pow:
+                if raw_header[72:76] != raw_bits:
+                    raise BaseException("bits mismatch: %s vs %s" % (bits, int.from_bytes(raw_header[72:76], 'little')))
+                if int.from_bytes(_hash, 'little') > target:
+                    raise BaseException("insufficient proof of work: %s vs target %s" % (int.from_bytes(_hash, 'little'), target))
+            prev_hash = _hash
+        if num == 2016 and index < len(self.checkpoints):
+            if prev_hash != bfh(self.checkpoints[index][0])[::-1]:
+                raise BaseException("chunk %d does not match checkpoint" % index)
 
     def path(self):
         d = util.get_headers_dir(self.config)
@@ -194,6 +317,8 @@ class Blockchain(util.PrintError):
         parent_id = self.parent_id
         checkpoint = self.checkpoint
         parent = self.parent()
+        self.flush()
+        parent.flush()
         with open(self.path(), 'rb') as f:
             my_data = f.read()
         with open(parent.path(), 'rb') as f:
@@ -208,19 +333,32 @@ class Blockchain(util.PrintError):
         self.parent_id = parent.parent_id; parent.parent_id = parent_id
         self.checkpoint = parent.checkpoint; parent.checkpoint = checkpoint
         self._size = parent._size; parent._size = parent_branch_size
+        # cached hashes and targets follow files, not checkpoints
+        for b in blockchains.values():
+            b.clear_cache()
         # move files
         for b in blockchains.values():
             if b in [self, parent]: continue
             if b.old_path != b.path():
                 self.print_error("renaming", b.old_path, b.path())
-                os.rename(b.old_path, b.path())
+                with b.lock:
+                    b.store.close()
+                    os.rename(b.old_path, b.path())
+                    b.store.map(b.path())
+        # self and parent now point to each other's files
+        for b in [self, parent]:
+            with b.lock:
+                b.store.map(b.path())
         # update pointers
         blockchains[self.checkpoint] = self
         blockchains[parent.checkpoint] = parent
+        update_links()
 
     def write(self, data, offset):
         filename = self.path()
         with self.lock:
+            self._flush()
+            self.store.close()
             with open(filename, 'rb+') as f:
                 if offset != self._size*80:
                     f.seek(offset)
@@ -230,13 +368,69 @@ class Blockchain(util.PrintError):
                 f.flush()
                 os.fsync(f.fileno())
             self.update_size()
+            self.last_sync = time.time()
+        self.invalidate_cache(self.checkpoint + offset // 80)
+
+    def append(self, data):
+        '''Write-behind append.  Data is kept in memory and written with
+        a single fsync once fsync_count headers are pending, or when
+        fsync_interval seconds have passed since the last sync.'''
+        with self.lock:
+            self.pending += data
+            self._size += len(data)//80
+            if len(self.pending) >= self.fsync_count*80 or time.time() - self.last_sync >= self.fsync_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def flush_if_due(self):
+        with self.lock:
+            if self.pending and time.time() - self.last_sync >= self.fsync_interval:
+                self._flush()
+
+    def _flush(self):
+        # must be called with self.lock held
+        if not self.pending:
+            return
+        self.store.close()
+        with open(self.path(), 'rb+') as f:
+            f.seek((self._size - len(self.pending)//80)*80)
+            f.write(self.pending)
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = bytearray()
+        self.last_sync = time.time()
+        self.update_size()
+
+    def read_raw(self, delta):
+        # must be called with self.lock held
+        on_disk = self._size - len(self.pending)//80
+        if delta >= on_disk:
+            i = (delta - on_disk)*80
+            return bytes(self.pending[i:i+80])
+        return self.store.read(delta*80, 80)
+
+    def invalidate_cache(self, height):
+        '''Forget cached values that depend on headers at or above height'''
+        self.hashes.discard_if(lambda h: h >= height)
+        self.targets.discard_if(lambda index: index * 2016 + 2015 >= height)
+
+    def clear_cache(self):
+        self.hashes.clear()
+        self.targets.clear()
 
     def save_header(self, header):
-        delta = header.get('block_height') - self.checkpoint
+        height = header.get('block_height')
+        delta = height - self.checkpoint
         data = bfh(serialize_header(header))
         assert delta == self.size()
         assert len(data) == 80
-        self.write(data, delta*80)
+        self.append(data)
+        h = hash_header(header)
+        self.hashes.put(height, h)
+        header_index.put(h, self)
         self.swap_with_parent()
 
     def read_header(self, height):
@@ -248,12 +442,9 @@ class Blockchain(util.PrintError):
         if height > self.height():
             return
         delta = height - self.checkpoint
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * 80)
-                h = f.read(80)
-        if h == bytes([0])*80:
+        with self.lock:
+            h = self.read_raw(delta)
+        if h is None or h == bytes([0])*80:
             return None
         return deserialize_header(h, height)
 
@@ -267,19 +458,38 @@ class Blockchain(util.PrintError):
             index = height // 2016
             h, t = self.checkpoints[index]
             return h
+        elif height < self.checkpoint:
+            return self.parent().get_hash(height)
         else:
-            return hash_header(self.read_header(height))
+            h = self.hashes.get(height)
+            if h is None:
+                header = self.read_header(height)
+                h = hash_header(header)
+                if header is not None:
+                    self.hashes.put(height, h)
+                    header_index.put(h, self)
+            return h
 
     def get_target(self, index):
         # compute target from chunk x, used in chunk x+1
         if bitcoin.NetworkConstants.TESTNET:
             return 0, 0
         if index == -1:
-            return 0x1d00ffff, MAX_TARGET
+            return MAX_TARGET
         if index < len(self.checkpoints):
             h, t = self.checkpoints[index]
             return t
-        # new target
+        if index * 2016 + 2015 < self.checkpoint:
+            return self.parent().get_target(index)
+        target = self.targets.get(index)
+        if target is None:
+            target = self.compute_target(index)
+            # a target straddling our checkpoint depends on the parent
+            if index * 2016 >= self.checkpoint:
+                self.targets.put(index, target)
+        return target
+
+    def compute_target(self, index):
         first = self.read_header(index * 2016)
         last = self.read_header(index * 2016 + 2015)
         bits = last.get('bits')
@@ -341,6 +551,68 @@ class Blockchain(util.PrintError):
             self.print_error('verify_chunk failed', str(e))
             return False
 
+    def export_snapshot(self, path):
+        '''Write the checkpointed chunks we have to a compressed snapshot.
+        Returns the number of chunks written.'''
+        self.flush()
+        n = min(len(self.checkpoints), (self.height() + 1) // 2016)
+        chunks = []
+        for index in range(n):
+            with self.lock:
+                data = self.store.read((index * 2016 - self.checkpoint) * 80, 2016 * 80)
+            try:
+                self.verify_chunk(index, data)
+            except BaseException as e:
+                self.print_error('export stopped at chunk', index, str(e))
+                break
+            chunks.append(data)
+        with gzip.open(path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack('>I', len(chunks)))
+            for data in chunks:
+                f.write(data)
+        return len(chunks)
+
+    def import_snapshot(self, path):
+        '''Bulk import a snapshot written by export_snapshot. Chunks are
+        streamed from the file and each one is verified against
+        the checkpoints before it is written; import stops at the first
+        chunk that does not verify. Existing data after the imported
+        range is kept. Returns the number of chunks imported.'''
+        assert self.parent_id is None
+        n = 0
+        with gzip.open(path, 'rb') as snapshot:
+            if snapshot.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise BaseException('not a headers snapshot: %s' % path)
+            num = struct.unpack('>I', snapshot.read(4))[0]
+            num = min(num, len(self.checkpoints))
+            with self.lock:
+                self._flush()
+                self.store.close()
+            with open(self.path(), 'rb+') as f:
+                for index in range(num):
+                    try:
+                        data = snapshot.read(2016 * 80)
+                    except EOFError:
+                        data = b''
+                    if len(data) != 2016 * 80:
+                        self.print_error('snapshot truncated at chunk', index)
+                        break
+                    try:
+                        self.verify_chunk(index, data)
+                    except BaseException as e:
+                        self.print_error('snapshot import stopped at chunk', index, str(e))
+                        break
+                    f.seek(index * 2016 * 80)
+                    f.write(data)
+                    n += 1
+                f.flush()
+                os.fsync(f.fileno())
+        with self.lock:
+            self.update_size()
+        self.print_error('imported %d chunks from snapshot' % n)
+        return n
+
     def get_checkpoints(self):
         # for each chunk, store the hash of the last block and the target after the chunk
         cp = []
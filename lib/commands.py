@@ -341,6 +341,20 @@ class Commands:
         """Return the list of available servers"""
         return self.network.get_servers()
 
+    @command('n')
+    def getconnections(self):
+        """Return the request window, timeout and round trip time
+        percentiles of each connected server"""
+        return self.network.get_interface_stats()
+
+    @command('n')
+    def exportheaders(self, path):
+        """Export the checkpointed block headers to a compressed snapshot
+        file. Set the 'headers_snapshot' config variable to this file on
+        a new installation to import them instead of downloading them."""
+        n = self.network.export_headers_snapshot(path)
+        return {'path': path, 'chunks': n}
+
     @command('')
     def version(self):
         """Return the version of electrum."""
@@ -545,7 +559,9 @@ class Commands:
         if self.wallet and txid in self.wallet.transactions:
             tx = self.wallet.transactions[txid]
         else:
-            raw = self.network.synchronous_get(('blockchain.transaction.get', [txid]))
+            raw = self.network.tx_cache.get(txid)
+            if raw is None:
+                raw = self.network.synchronous_get(('blockchain.transaction.get', [txid]))
             if raw:
                 tx = Transaction(raw)
             else:
@@ -694,6 +710,7 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in BTC).',
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'path': 'File path',
 }
 
 command_options = {
@@ -35,6 +35,7 @@ from .network import Network
 from .util import json_decode, DaemonThread
 from .util import print_error
 from .wallet import Wallet
+from .keystore import close_derivation_pool
 from .storage import WalletStorage
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
@@ -264,6 +265,7 @@ class Daemon(DaemonThread):
             self.server.handle_request() if self.server else time.sleep(0.1)
         for k, wallet in self.wallets.items():
             wallet.stop_threads()
+        close_derivation_pool()
         if self.network:
             self.print_error("shutting down network")
             self.network.stop()
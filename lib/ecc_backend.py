@@ -0,0 +1,246 @@
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Signing, verification, public key recovery and derivation on
+# secp256k1.  The system libsecp256k1 is used through ctypes when it
+# can be loaded; otherwise the pure Python ecdsa module is used.
+#
+# Keys and hashes are bytes, public keys are serialized (33 or 65
+# bytes), and signatures are (r, s) pairs of integers.  Signatures
+# are deterministic (RFC 6979) with low S values, so both backends
+# produce the same bytes.
+
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import sys
+
+import ecdsa
+from ecdsa.curves import SECP256k1
+from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
+from ecdsa.ellipticcurve import Point, INFINITY
+from ecdsa.numbertheory import inverse_mod
+
+from . import ecc_fast
+from .util import print_error
+
+
+N = generator_secp256k1.order()
+P = curve_secp256k1.p()
+
+SECP256K1_CONTEXT_SIGN = (1 << 0) | (1 << 9)
+SECP256K1_CONTEXT_VERIFY = (1 << 0) | (1 << 8)
+SECP256K1_EC_COMPRESSED = (1 << 1) | (1 << 8)
+SECP256K1_EC_UNCOMPRESSED = (1 << 1)
+
+
+def load_library():
+    if sys.platform == 'darwin':
+        names = ['libsecp256k1.0.dylib', 'libsecp256k1.dylib']
+    elif sys.platform in ('windows', 'win32'):
+        names = ['libsecp256k1-0.dll', 'libsecp256k1.dll']
+    else:
+        names = ['libsecp256k1.so.0', 'libsecp256k1.so']
+    path = ctypes.util.find_library('secp256k1')
+    if path:
+        names.append(path)
+    for name in names:
+        try:
+            lib = ctypes.cdll.LoadLibrary(name)
+        except OSError:
+            continue
+        try:
+            declare_functions(lib)
+        except AttributeError:
+            print_error("[ecc] incomplete library", name)
+            continue
+        return lib
+    return None
+
+
+def declare_functions(lib):
+    from ctypes import c_void_p, c_char_p, c_size_t, c_uint, c_int, POINTER
+    lib.secp256k1_context_create.argtypes = [c_uint]
+    lib.secp256k1_context_create.restype = c_void_p
+    lib.secp256k1_context_randomize.argtypes = [c_void_p, c_char_p]
+    lib.secp256k1_context_randomize.restype = c_int
+    lib.secp256k1_ec_pubkey_parse.argtypes = [c_void_p, c_char_p, c_char_p, c_size_t]
+    lib.secp256k1_ec_pubkey_parse.restype = c_int
+    lib.secp256k1_ec_pubkey_serialize.argtypes = [c_void_p, c_char_p, POINTER(c_size_t), c_char_p, c_uint]
+    lib.secp256k1_ec_pubkey_serialize.restype = c_int
+    lib.secp256k1_ec_pubkey_create.argtypes = [c_void_p, c_char_p, c_char_p]
+    lib.secp256k1_ec_pubkey_create.restype = c_int
+    lib.secp256k1_ec_pubkey_tweak_add.argtypes = [c_void_p, c_char_p, c_char_p]
+    lib.secp256k1_ec_pubkey_tweak_add.restype = c_int
+    lib.secp256k1_ecdsa_sign.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p, c_void_p, c_void_p]
+    lib.secp256k1_ecdsa_sign.restype = c_int
+    lib.secp256k1_ecdsa_verify.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p]
+    lib.secp256k1_ecdsa_verify.restype = c_int
+    lib.secp256k1_ecdsa_signature_parse_compact.argtypes = [c_void_p, c_char_p, c_char_p]
+    lib.secp256k1_ecdsa_signature_parse_compact.restype = c_int
+    lib.secp256k1_ecdsa_signature_serialize_compact.argtypes = [c_void_p, c_char_p, c_char_p]
+    lib.secp256k1_ecdsa_signature_serialize_compact.restype = c_int
+    lib.secp256k1_ecdsa_signature_normalize.argtypes = [c_void_p, c_char_p, c_char_p]
+    lib.secp256k1_ecdsa_signature_normalize.restype = c_int
+    # the recovery module is optional when building the library
+    try:
+        lib.secp256k1_ecdsa_recoverable_signature_parse_compact.argtypes = [c_void_p, c_char_p, c_char_p, c_int]
+        lib.secp256k1_ecdsa_recoverable_signature_parse_compact.restype = c_int
+        lib.secp256k1_ecdsa_recover.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p]
+        lib.secp256k1_ecdsa_recover.restype = c_int
+        lib.has_recovery = True
+    except AttributeError:
+        lib.has_recovery = False
+
+
+def number_to_bytes(x):
+    return x.to_bytes(32, 'big')
+
+
+class PythonBackend(object):
+
+    name = 'python'
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        secexp = int.from_bytes(secret, 'big')
+        if len(secret) != 32 or not 0 < secexp < N:
+            raise ValueError('invalid private key')
+        point = generator_secp256k1 * secexp
+        return ecc_fast.serialize((point.x(), point.y()), compressed)
+
+    def sign(self, secret, msg_hash):
+        secexp = int.from_bytes(secret, 'big')
+        if len(secret) != 32 or not 0 < secexp < N:
+            raise ValueError('invalid private key')
+        private_key = ecdsa.SigningKey.from_secret_exponent(secexp, curve=SECP256k1)
+        r, s = private_key.sign_digest_deterministic(
+            msg_hash, hashfunc=hashlib.sha256, sigencode=lambda r, s, order: (r, s))
+        if s > N // 2:
+            s = N - s
+        return r, s
+
+    def verify(self, pubkey, r, s, msg_hash):
+        try:
+            public_key = ecdsa.VerifyingKey.from_string(pubkey, curve=SECP256k1)
+            return public_key.verify_digest((r, s), msg_hash, sigdecode=lambda sig, order: sig)
+        except BaseException:
+            return False
+
+    def recover(self, r, s, recid, msg_hash, compressed=True):
+        """ See http://www.secg.org/download/aid-780/sec1-v2.pdf, chapter 4.1.6 """
+        if not (0 < r < N and 0 < s < N and 0 <= recid < 4):
+            return None
+        x = r + (recid // 2) * N
+        if x >= P:
+            return None
+        alpha = (pow(x, 3, P) + curve_secp256k1.b()) % P
+        beta = pow(alpha, (P + 1) // 4, P)
+        if beta * beta % P != alpha:
+            return None
+        y = beta if (beta - recid) % 2 == 0 else P - beta
+        R = Point(curve_secp256k1, x, y, N)
+        e = int.from_bytes(msg_hash, 'big')
+        Q = inverse_mod(r, N) * (s * R + (-e % N) * generator_secp256k1)
+        if Q == INFINITY:
+            return None
+        return ecc_fast.serialize((Q.x(), Q.y()), compressed)
+
+    def tweak_add_pubkey(self, pubkey, k, compressed=True):
+        return ecc_fast.tweak_add_pubkey(pubkey, k, compressed)
+
+
+class LibsecpBackend(object):
+
+    name = 'libsecp256k1'
+
+    def __init__(self, lib):
+        self.lib = lib
+        self.ctx = lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
+        lib.secp256k1_context_randomize(self.ctx, os.urandom(32))
+        self.fallback = PythonBackend()
+
+    def parse_pubkey(self, pubkey):
+        p = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, p, pubkey, len(pubkey)):
+            raise ValueError('invalid public key')
+        return p
+
+    def serialize_pubkey(self, p, compressed):
+        out = ctypes.create_string_buffer(65)
+        size = ctypes.c_size_t(65)
+        flags = SECP256K1_EC_COMPRESSED if compressed else SECP256K1_EC_UNCOMPRESSED
+        self.lib.secp256k1_ec_pubkey_serialize(self.ctx, out, ctypes.byref(size), p, flags)
+        return out.raw[:size.value]
+
+    def pubkey_from_secret(self, secret, compressed=True):
+        p = ctypes.create_string_buffer(64)
+        if len(secret) != 32 or not self.lib.secp256k1_ec_pubkey_create(self.ctx, p, secret):
+            raise ValueError('invalid private key')
+        return self.serialize_pubkey(p, compressed)
+
+    def sign(self, secret, msg_hash):
+        sig = ctypes.create_string_buffer(64)
+        if len(secret) != 32 or not self.lib.secp256k1_ecdsa_sign(self.ctx, sig, msg_hash, secret, None, None):
+            raise ValueError('invalid private key')
+        compact = ctypes.create_string_buffer(64)
+        self.lib.secp256k1_ecdsa_signature_serialize_compact(self.ctx, compact, sig)
+        return int.from_bytes(compact.raw[:32], 'big'), int.from_bytes(compact.raw[32:], 'big')
+
+    def verify(self, pubkey, r, s, msg_hash):
+        if not (0 < r < N and 0 < s < N):
+            return False
+        try:
+            p = self.parse_pubkey(pubkey)
+        except ValueError:
+            return False
+        sig = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_signature_parse_compact(self.ctx, sig, number_to_bytes(r) + number_to_bytes(s)):
+            return False
+        # libsecp256k1 only accepts low S values
+        self.lib.secp256k1_ecdsa_signature_normalize(self.ctx, sig, sig)
+        return self.lib.secp256k1_ecdsa_verify(self.ctx, sig, msg_hash, p) == 1
+
+    def recover(self, r, s, recid, msg_hash, compressed=True):
+        if not self.lib.has_recovery:
+            return self.fallback.recover(r, s, recid, msg_hash, compressed)
+        if not (0 < r < N and 0 < s < N and 0 <= recid < 4):
+            return None
+        sig = ctypes.create_string_buffer(65)
+        if not self.lib.secp256k1_ecdsa_recoverable_signature_parse_compact(
+                self.ctx, sig, number_to_bytes(r) + number_to_bytes(s), recid):
+            return None
+        p = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_recover(self.ctx, p, sig, msg_hash):
+            return None
+        return self.serialize_pubkey(p, compressed)
+
+    def tweak_add_pubkey(self, pubkey, k, compressed=True):
+        p = self.parse_pubkey(pubkey)
+        if not self.lib.secp256k1_ec_pubkey_tweak_add(self.ctx, p, number_to_bytes(k % N)):
+            raise ValueError('point at infinity')
+        return self.serialize_pubkey(p, compressed)
+
+
+libsecp256k1 = load_library()
+backend = LibsecpBackend(libsecp256k1) if libsecp256k1 else PythonBackend()
@@ -0,0 +1,208 @@
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Public key arithmetic on secp256k1 for key derivation.  Only public
+# data goes through here: the operations are not constant time.
+
+import threading
+
+from ecdsa.ecdsa import curve_secp256k1, generator_secp256k1
+
+from .util import LRUCache
+
+
+P = curve_secp256k1.p()
+N = generator_secp256k1.order()
+B = curve_secp256k1.b()
+G = (generator_secp256k1.x(), generator_secp256k1.y())
+
+# k*G is the sum of one table entry per WINDOW bits of k
+WINDOW = 8
+POINT_CACHE_SIZE = 1024
+
+g_table = None
+g_table_lock = threading.Lock()
+# serialized public key -> affine point
+points = LRUCache(POINT_CACHE_SIZE)
+
+
+try:
+    pow(2, -1, P)
+except ValueError:
+    # before Python 3.8
+    def inverse(z):
+        return pow(z, P - 2, P)
+else:
+    def inverse(z):
+        return pow(z, -1, P)
+
+
+# Points in Jacobian coordinates (X, Y, Z) stand for (X/Z^2, Y/Z^3);
+# Z == 0 is the point at infinity.
+
+def jacobian_double(p):
+    X, Y, Z = p
+    if Z == 0 or Y == 0:
+        return (0, 1, 0)
+    YY = Y * Y % P
+    S = 4 * X * YY % P
+    M = 3 * X * X % P
+    X3 = (M * M - 2 * S) % P
+    Y3 = (M * (S - X3) - 8 * YY * YY) % P
+    Z3 = 2 * Y * Z % P
+    return (X3, Y3, Z3)
+
+
+def jacobian_add_affine(p, q):
+    '''p in Jacobian coordinates plus affine q (None for infinity).'''
+    if q is None:
+        return p
+    X1, Y1, Z1 = p
+    x2, y2 = q
+    if Z1 == 0:
+        return (x2, y2, 1)
+    Z1Z1 = Z1 * Z1 % P
+    U2 = x2 * Z1Z1 % P
+    S2 = y2 * Z1 * Z1Z1 % P
+    H = (U2 - X1) % P
+    R = (S2 - Y1) % P
+    if H == 0:
+        if R == 0:
+            return jacobian_double(p)
+        return (0, 1, 0)
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - Y1 * HHH) % P
+    Z3 = Z1 * H % P
+    return (X3, Y3, Z3)
+
+
+def to_affine(p):
+    X, Y, Z = p
+    if Z == 0:
+        return None
+    zi = inverse(Z)
+    zi2 = zi * zi % P
+    return (X * zi2 % P, Y * zi2 * zi % P)
+
+
+def batch_to_affine(jacobians):
+    '''to_affine for a list of points, with a single inversion.'''
+    acc = 1
+    prefix = []
+    for X, Y, Z in jacobians:
+        prefix.append(acc)
+        acc = acc * Z % P
+    inv = inverse(acc)
+    out = [None] * len(jacobians)
+    for i in range(len(jacobians) - 1, -1, -1):
+        X, Y, Z = jacobians[i]
+        zi = inv * prefix[i] % P
+        inv = inv * Z % P
+        zi2 = zi * zi % P
+        out[i] = (X * zi2 % P, Y * zi2 * zi % P)
+    return out
+
+
+def get_g_table():
+    '''table[i][j] is j * 2^(WINDOW*i) * G, in affine coordinates;
+    entry 0 of each row is None (infinity).'''
+    global g_table
+    with g_table_lock:
+        if g_table is not None:
+            return g_table
+        table = []
+        base = (G[0], G[1], 1)
+        for i in range(256 // WINDOW):
+            # j * base for j = 1 .. 2^WINDOW - 1
+            row = [base]
+            base_affine = to_affine(base)
+            for j in range(2, 1 << WINDOW):
+                row.append(jacobian_add_affine(row[-1], base_affine))
+            affine = batch_to_affine(row)
+            table.append([None] + affine)
+            # next base: 2^WINDOW * base
+            base = jacobian_add_affine(row[-1], base_affine)
+        g_table = table
+        return g_table
+
+
+def mul_G(k):
+    '''k*G in Jacobian coordinates.'''
+    table = get_g_table()
+    k %= N
+    mask = (1 << WINDOW) - 1
+    p = (0, 1, 0)
+    i = 0
+    while k:
+        p = jacobian_add_affine(p, table[i][k & mask])
+        k >>= WINDOW
+        i += 1
+    return p
+
+
+def decompress(ser):
+    '''Affine point of a serialized public key, cached.'''
+    q = points.get(ser)
+    if q is not None:
+        return q
+    if len(ser) == 33 and ser[0] in (2, 3):
+        x = int.from_bytes(ser[1:], 'big')
+        y2 = (pow(x, 3, P) + B) % P
+        y = pow(y2, (P + 1) // 4, P)
+        if y * y % P != y2 or x >= P:
+            raise ValueError('invalid public key')
+        if (y & 1) != (ser[0] == 3):
+            y = P - y
+    elif len(ser) == 65 and ser[0] == 4:
+        x = int.from_bytes(ser[1:33], 'big')
+        y = int.from_bytes(ser[33:], 'big')
+        if (y * y - pow(x, 3, P) - B) % P != 0:
+            raise ValueError('invalid public key')
+    else:
+        raise ValueError('invalid public key')
+    q = (x, y)
+    points.put(ser, q)
+    return q
+
+
+def serialize(q, compressed=True):
+    x, y = q
+    if compressed:
+        return bytes([2 + (y & 1)]) + x.to_bytes(32, 'big')
+    return b'\x04' + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+
+
+def tweak_add(q, k):
+    '''k*G + q for an affine point q, as an affine point.'''
+    r = to_affine(jacobian_add_affine(mul_G(k), q))
+    if r is None:
+        raise ValueError('point at infinity')
+    return r
+
+
+def tweak_add_pubkey(ser, k, compressed=True):
+    '''Serialized k*G + K, where ser is the serialized public key K.'''
+    return serialize(tweak_add(decompress(ser), k), compressed)
@@ -30,6 +30,7 @@ import sys
 import threading
 import time
 import traceback
+from collections import deque, OrderedDict
 
 import requests
 
@@ -41,27 +42,158 @@ from . import util
 from . import x509
 from . import pem
 
+# Bounds of the in-flight request window of an Interface
+MIN_WINDOW = 4
+INITIAL_WINDOW = 100
+MAX_WINDOW = 2000
+# Bounds of the adaptive request timeout, in seconds
+MIN_TIMEOUT = 10
+MAX_TIMEOUT = 120
+# Fraction of error responses above which the window shrinks
+MAX_ERROR_RATE = 0.1
+RTT_SAMPLES = 256
+
+
+# Maximum number of threads making connections at the same time
+CONNECTION_WORKERS = 8
+
+
+class ConnectionPool(object):
+    """Runs connection attempts on at most `size` threads.  Threads
+    are started on demand and exit when no attempt is waiting."""
+
+    def __init__(self, size):
+        self.size = size
+        self.jobs = deque()
+        self.running = 0
+        self.lock = threading.Lock()
+
+    def submit(self, job):
+        with self.lock:
+            self.jobs.append(job)
+            if self.running >= self.size:
+                return
+            self.running += 1
+        t = threading.Thread(target=self.work)
+        t.daemon = True
+        t.start()
+
+    def work(self):
+        while True:
+            with self.lock:
+                if not self.jobs:
+                    self.running -= 1
+                    return
+                job = self.jobs.popleft()
+            try:
+                job.run()
+            except BaseException:
+                traceback.print_exc(file=sys.stderr)
+
+
+connection_pool = ConnectionPool(CONNECTION_WORKERS)
+
+
+class TLSCache(object):
+    """SSL contexts, pinned certificates and TLS sessions kept across
+    connection attempts.  A session can only be resumed with the
+    context that created it, so contexts are reused: one for servers
+    signed by a CA, and one per pinned certificate."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ca_context = None
+        # host -> (pem, context), or None if there is no pinned cert
+        self.pinned = {}
+        # server -> (context, session)
+        self.sessions = {}
+
+    def get_ca_context(self):
+        with self.lock:
+            if self.ca_context is None:
+                self.ca_context = TcpConnection.get_ssl_context(
+                    cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_path)
+            return self.ca_context
+
+    def get_pinned(self, config_path, host):
+        '''Returns (pem, context) for the certificate pinned for host.'''
+        with self.lock:
+            if host in self.pinned:
+                return self.pinned[host]
+        cert_path = os.path.join(config_path, 'certs', host)
+        try:
+            with open(cert_path) as f:
+                cert = f.read()
+        except FileNotFoundError:
+            value = None
+        else:
+            value = cert, self.make_pinned_context(cert)
+        with self.lock:
+            self.pinned[host] = value
+        return value
+
+    @staticmethod
+    def make_pinned_context(cert):
+        '''Returns a context that trusts cert only, or None if cert
+        cannot be loaded.  Without cadata the context would load the
+        system CAs, so an empty file is rejected too.'''
+        if not cert:
+            return None
+        try:
+            return TcpConnection.get_ssl_context(
+                cert_reqs=ssl.CERT_REQUIRED, ca_certs=None, cadata=cert)
+        except ssl.SSLError as e:
+            print_error("[TLSCache] unusable certificate:", e)
+            return None
+
+    def set_pinned(self, host, cert, context):
+        with self.lock:
+            self.pinned[host] = (cert, context) if cert else None
+
+    def forget_pinned(self, host):
+        '''The certificate file of host is read again on the next
+        connection attempt.'''
+        with self.lock:
+            self.pinned.pop(host, None)
+
+    def get_session(self, server, context):
+        with self.lock:
+            c, session = self.sessions.get(server, (None, None))
+        return session if c is context else None
+
+    def save_session(self, server, s):
+        session = getattr(s, 'session', None)
+        if session is None:
+            return
+        with self.lock:
+            self.sessions[server] = s.context, session
+
+    def forget(self, server):
+        with self.lock:
+            self.sessions.pop(server, None)
+
+
+tls_cache = TLSCache()
+
 
 def Connection(server, queue, config_path):
     """Makes asynchronous connections to a remote electrum server.
-    Returns the running thread that is making the connection.
+    Returns the connection attempt, which runs on the connection pool.
 
-    Once the thread has connected, it finishes, placing a tuple on the
-    queue of the form (server, socket), where socket is None if
-    connection failed.
+    Once connected, it places a tuple on the queue of the form
+    (server, socket), where socket is None if connection failed.
     """
     host, port, protocol = server.rsplit(':', 2)
     if not protocol in 'st':
         raise Exception('Unknown protocol: %s' % protocol)
     c = TcpConnection(server, queue, config_path)
-    c.start()
+    connection_pool.submit(c)
     return c
 
 
-class TcpConnection(threading.Thread, util.PrintError):
+class TcpConnection(util.PrintError):
 
     def __init__(self, server, queue, config_path):
-        threading.Thread.__init__(self)
         self.config_path = config_path
         self.queue = queue
         self.server = server
@@ -69,7 +201,6 @@ class TcpConnection(threading.Thread, util.PrintError):
         self.host = str(self.host)
         self.port = int(self.port)
         self.use_ssl = (self.protocol == 's')
-        self.daemon = True
 
     def diagnostic_name(self):
         return self.host
@@ -120,8 +251,8 @@ class TcpConnection(threading.Thread, util.PrintError):
             self.print_error("failed to connect", str(e))
 
     @staticmethod
-    def get_ssl_context(cert_reqs, ca_certs):
-        context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=ca_certs)
+    def get_ssl_context(cert_reqs, ca_certs, cadata=None):
+        context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=ca_certs, cadata=cadata)
         context.check_hostname = False
         context.verify_mode = cert_reqs
 
@@ -131,18 +262,31 @@ class TcpConnection(threading.Thread, util.PrintError):
 
         return context
 
+    def wrap_socket(self, context, s):
+        '''TLS handshake, resuming the last session with the server if
+        it was made with the same context.'''
+        session = tls_cache.get_session(self.server, context)
+        if session is not None:
+            s = context.wrap_socket(s, do_handshake_on_connect=True, session=session)
+        else:
+            s = context.wrap_socket(s, do_handshake_on_connect=True)
+        if getattr(s, 'session_reused', False):
+            self.print_error("TLS session resumed")
+        tls_cache.save_session(self.server, s)
+        return s
+
     def get_socket(self):
         if self.use_ssl:
             cert_path = os.path.join(self.config_path, 'certs', self.host)
-            if not os.path.exists(cert_path):
+            pinned = tls_cache.get_pinned(self.config_path, self.host)
+            if pinned is None:
                 is_new = True
                 s = self.get_simple_socket()
                 if s is None:
                     return
                 # try with CA first
                 try:
-                    context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED, ca_certs=ca_path)
-                    s = context.wrap_socket(s, do_handshake_on_connect=True)
+                    s = self.wrap_socket(tls_cache.get_ca_context(), s)
                 except ssl.SSLError as e:
                     print_error(e)
                     s = None
@@ -174,8 +318,14 @@ class TcpConnection(threading.Thread, util.PrintError):
                 temporary_path = cert_path + '.temp'
                 with open(temporary_path,"w") as f:
                     f.write(cert)
+                context = tls_cache.make_pinned_context(cert)
             else:
                 is_new = False
+                cert, context = pinned
+            if context is None:
+                self.print_error("SSL error: unusable certificate")
+                tls_cache.forget_pinned(self.host)
+                return
 
         s = self.get_simple_socket()
         if s is None:
@@ -183,14 +333,14 @@ class TcpConnection(threading.Thread, util.PrintError):
 
         if self.use_ssl:
             try:
-                context = self.get_ssl_context(cert_reqs=ssl.CERT_REQUIRED,
-                                               ca_certs=(temporary_path if is_new else cert_path))
-                s = context.wrap_socket(s, do_handshake_on_connect=True)
+                s = self.wrap_socket(context, s)
             except socket.timeout:
                 self.print_error('timeout')
                 return
             except ssl.SSLError as e:
                 self.print_error("SSL error:", e)
+                tls_cache.forget(self.server)
+                tls_cache.forget_pinned(self.host)
                 if e.errno != 1:
                     return
                 if is_new:
@@ -199,8 +349,6 @@ class TcpConnection(threading.Thread, util.PrintError):
                         os.unlink(rej)
                     os.rename(temporary_path, rej)
                 else:
-                    with open(cert_path) as f:
-                        cert = f.read()
                     try:
                         b = pem.dePem(cert, 'CERTIFICATE')
                         x = x509.X509(b)
@@ -213,6 +361,7 @@ class TcpConnection(threading.Thread, util.PrintError):
                     except:
                         self.print_error("certificate has expired:", cert_path)
                         os.unlink(cert_path)
+                        tls_cache.set_pinned(self.host, None, None)
                         return
                     self.print_error("wrong certificate")
                 if e.errno == 104:
@@ -226,6 +375,7 @@ class TcpConnection(threading.Thread, util.PrintError):
             if is_new:
                 self.print_error("saving certificate")
                 os.rename(temporary_path, cert_path)
+                tls_cache.set_pinned(self.host, cert, context)
 
         return s
 
@@ -236,12 +386,93 @@ class TcpConnection(threading.Thread, util.PrintError):
         self.queue.put((self.server, socket))
 
 
+class RequestWindow(object):
+    """Congestion control for the requests of one connection.
+
+    The number of unanswered requests allowed grows by one per answer
+    until the first congestion signal, and by one per window after
+    that.  It is halved, at most once per round trip, when an answer
+    arrives later than the current timeout or when errors become
+    frequent.  The timeout follows the smoothed round trip time and its
+    variance, as TCP does.
+    """
+
+    def __init__(self):
+        self.size = INITIAL_WINDOW
+        self.threshold = MAX_WINDOW
+        self.srtt = None
+        self.rttvar = None
+        self.samples = deque(maxlen=RTT_SAMPLES)
+        self.errors = deque(maxlen=100)
+        self.last_decrease = 0
+
+    def limit(self):
+        return int(self.size)
+
+    def timeout(self):
+        if self.srtt is None:
+            return MIN_TIMEOUT
+        t = self.srtt + 4 * self.rttvar
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, t))
+
+    def error_rate(self):
+        return sum(self.errors) / len(self.errors) if self.errors else 0.
+
+    def on_response(self, rtt, error, in_flight):
+        late = rtt > self.timeout()
+        self.samples.append(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.errors.append(bool(error))
+        if late or (error and self.error_rate() > MAX_ERROR_RATE):
+            self.decrease()
+        elif in_flight >= self.size / 2:
+            # only grow a window that is actually used
+            self.increase()
+
+    def increase(self):
+        if self.size < self.threshold:
+            self.size += 1
+        else:
+            self.size += 1. / self.size
+        self.size = min(self.size, MAX_WINDOW)
+
+    def decrease(self):
+        now = time.time()
+        if now - self.last_decrease < (self.srtt or 0):
+            return
+        self.last_decrease = now
+        self.threshold = max(MIN_WINDOW, self.size / 2)
+        self.size = self.threshold
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+        s = sorted(self.samples)
+        return s[min(len(s) - 1, int(p * len(s)))]
+
+    def get_stats(self):
+        return {
+            'window': self.limit(),
+            'timeout': self.timeout(),
+            'srtt': self.srtt,
+            'rtt_p50': self.percentile(0.5),
+            'rtt_p90': self.percentile(0.9),
+            'rtt_p99': self.percentile(0.99),
+            'error_rate': self.error_rate(),
+        }
+
+
 class Interface(util.PrintError):
     """The Interface class handles a socket connected to a single remote
     electrum server.  It's exposed API is:
 
-    - Member functions close(), fileno(), get_responses(), has_timed_out(),
-      ping_required(), queue_request(), send_requests()
+    - Member functions close(), fileno(), get_responses(), get_stats(),
+      has_timed_out(), ping_required(), queue_request(), send_requests()
     - Member variable server.
     """
 
@@ -256,6 +487,16 @@ class Interface(util.PrintError):
         self.debug = False
         self.unsent_requests = []
         self.unanswered_requests = {}
+        # send time of unanswered requests, oldest first
+        self.sent_time = OrderedDict()
+        self.window = RequestWindow()
+        # JSON-RPC batches are sent until the server rejects one.
+        # batch_supported becomes True once a batch response arrives;
+        # until then the ids sent in batches are kept so they can be
+        # resent one by one.
+        self.batch_requests = True
+        self.batch_supported = False
+        self.unconfirmed_batch_ids = set()
         # Set last ping to zero to ensure immediate ping
         self.last_request = time.time()
         self.last_ping = 0
@@ -269,6 +510,8 @@ class Interface(util.PrintError):
         return self.socket.fileno()
 
     def close(self):
+        # TLS 1.3 session tickets arrive after the handshake
+        tls_cache.save_session(self.server, self.socket)
         if not self.closed_remotely:
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
@@ -284,27 +527,54 @@ class Interface(util.PrintError):
         self.unsent_requests.append(args)
 
     def num_requests(self):
-        '''Keep unanswered requests below 100'''
-        n = 100 - len(self.unanswered_requests)
-        return min(n, len(self.unsent_requests))
+        '''Keep unanswered requests within the request window'''
+        n = self.window.limit() - len(self.unanswered_requests)
+        return max(0, min(n, len(self.unsent_requests)))
 
     def send_requests(self):
         '''Sends queued requests.  Returns False on failure.'''
         make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
         n = self.num_requests()
         wire_requests = self.unsent_requests[0:n]
+        batch = self.batch_requests and n > 1
         try:
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            if batch:
+                self.pipe.send([make_dict(*r) for r in wire_requests])
+            else:
+                self.pipe.send_all([make_dict(*r) for r in wire_requests])
         except socket.error as e:
             self.print_error("socket error:", e)
             return False
         self.unsent_requests = self.unsent_requests[n:]
+        now = time.time()
         for request in wire_requests:
             if self.debug:
                 self.print_error("-->", request)
             self.unanswered_requests[request[2]] = request
+            self.sent_time[request[2]] = now
+            if batch and not self.batch_supported:
+                self.unconfirmed_batch_ids.add(request[2])
         return True
 
+    def on_batch_rejected(self):
+        '''The server answered a batch with a bare error.  Stop batching
+        and queue the requests it did not answer for sending one by one.'''
+        self.print_error("server rejected batch request, disabling batches")
+        self.batch_requests = False
+        requeue = [self.unanswered_requests.pop(i)
+                   for i in sorted(self.unconfirmed_batch_ids)
+                   if i in self.unanswered_requests]
+        for request in requeue:
+            self.sent_time.pop(request[2], None)
+        self.unconfirmed_batch_ids.clear()
+        self.unsent_requests = requeue + self.unsent_requests
+
+    def batch_unanswered(self):
+        '''True if requests sent in a batch were neither answered nor
+        rejected.  A server that closes the connection or times out in
+        this state probably does not understand batches.'''
+        return not self.batch_supported and bool(self.unconfirmed_batch_ids)
+
     def ping_required(self):
         '''Maintains time since last ping.  Returns True if a ping should
         be sent.
@@ -315,10 +585,19 @@ class Interface(util.PrintError):
             return True
         return False
 
+    def get_stats(self):
+        stats = self.window.get_stats()
+        stats['in_flight'] = len(self.unanswered_requests)
+        return stats
+
     def has_timed_out(self):
-        '''Returns True if the interface has timed out.'''
-        if (self.unanswered_requests and time.time() - self.request_time > 10
-            and self.pipe.idle_time() > 10):
+        '''Returns True if the oldest unanswered request has waited, and
+        nothing has been received, for longer than the request timeout.'''
+        if not self.sent_time:
+            return False
+        t = self.window.timeout()
+        oldest = next(iter(self.sent_time.values()))
+        if time.time() - oldest > t and self.pipe.idle_time() > t:
             self.print_error("timeout", len(self.unanswered_requests))
             return True
 
@@ -339,27 +618,56 @@ class Interface(util.PrintError):
                 response = self.pipe.get()
             except util.timeout:
                 break
+            if type(response) is list:
+                # batch response
+                self.batch_supported = True
+                self.unconfirmed_batch_ids.clear()
+                if not self.process_response(response, responses):
+                    break
+                continue
             if not type(response) is dict:
                 responses.append((None, None))
                 if response is None:
                     self.closed_remotely = True
                     self.print_error("connection closed remotely")
                 break
+            if (response.get('id') is None and response.get('error')
+                    and self.unconfirmed_batch_ids):
+                self.on_batch_rejected()
+                continue
+            if not self.process_response([response], responses):
+                break
+
+        return responses
+
+    def process_response(self, items, responses):
+        '''Pairs the items of a single or batch response with their
+        requests and appends them to responses.  Returns False if the
+        server is misbehaving.'''
+        for response in items:
+            if not type(response) is dict:
+                responses.append((None, None))
+                return False
             if self.debug:
                 self.print_error("<--", response)
             wire_id = response.get('id', None)
             if wire_id is None:  # Notification
                 responses.append((None, response))
             else:
+                self.unconfirmed_batch_ids.discard(wire_id)
                 request = self.unanswered_requests.pop(wire_id, None)
+                sent = self.sent_time.pop(wire_id, None)
+                if sent is not None:
+                    self.window.on_response(time.time() - sent,
+                                            bool(response.get('error')),
+                                            len(self.unanswered_requests))
                 if request:
                     responses.append((request, response))
                 else:
                     self.print_error("unknown wire ID", wire_id)
                     responses.append((None, None)) # Signal
-                    break
-
-        return responses
+                    return False
+        return True
 
 
 def check_cert(host, cert):
@@ -24,9 +24,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import threading
 from unicodedata import normalize
 
 from . import bitcoin
+from . import ecc_backend
 from .bitcoin import *
 
 from .util import PrintError, InvalidPassword, hfu
@@ -34,6 +36,63 @@ from .mnemonic import Mnemonic, load_wordlist
 from .plugins import run_hook
 
 
+# Worker processes used to derive large batches of public keys
+derivation_pool = None
+derivation_pool_size = 0
+derivation_pool_lock = threading.Lock()
+# batches smaller than this are derived in the calling process
+MIN_POOL_BATCH = 64
+
+
+def get_derivation_pool(processes):
+    global derivation_pool, derivation_pool_size
+    with derivation_pool_lock:
+        if derivation_pool is None or derivation_pool_size != processes:
+            import multiprocessing
+            if derivation_pool is not None:
+                derivation_pool.terminate()
+            # The pool is created from the network thread.  Forking there
+            # could copy locks held by other threads into the children,
+            # so the workers are started as new interpreters.
+            context = multiprocessing.get_context('spawn')
+            derivation_pool = context.Pool(processes)
+            derivation_pool_size = processes
+        return derivation_pool
+
+
+def close_derivation_pool():
+    global derivation_pool, derivation_pool_size
+    with derivation_pool_lock:
+        pool = derivation_pool
+        derivation_pool = None
+        derivation_pool_size = 0
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+
+def map_derivation(func, args, indices, processes=0):
+    '''Returns func(*args, indices), computed in chunks on a pool of
+    processes if processes > 1 and the batch is large enough.'''
+    indices = list(indices)
+    if processes < 2 or len(indices) < MIN_POOL_BATCH:
+        return func(*args, indices)
+    size = -(-len(indices) // processes)
+    chunks = [indices[i:i+size] for i in range(0, len(indices), size)]
+    pool = get_derivation_pool(processes)
+    results = pool.starmap(func, [args + (chunk,) for chunk in chunks])
+    return [pubkey for chunk in results for pubkey in chunk]
+
+
+def xpub_derive_pubkeys(xpub, indices):
+    _, _, _, _, c, cK = deserialize_xpub(xpub)
+    return [bh2u(CKD_pub(cK, c, i)[0]) for i in indices]
+
+
+def mpk_derive_pubkeys(mpk, for_change, indices):
+    return [Old_KeyStore.get_pubkey_from_mpk(mpk, for_change, i) for i in indices]
+
+
 class KeyStore(PrintError):
 
     def has_seed(self):
@@ -221,7 +280,7 @@ class Xpub:
     def get_master_public_key(self):
         return self.xpub
 
-    def derive_pubkey(self, for_change, n):
+    def get_branch_xpub(self, for_change):
         xpub = self.xpub_change if for_change else self.xpub_receive
         if xpub is None:
             xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
@@ -229,8 +288,16 @@ class Xpub:
                 self.xpub_change = xpub
             else:
                 self.xpub_receive = xpub
+        return xpub
+
+    def derive_pubkey(self, for_change, n):
+        xpub = self.get_branch_xpub(for_change)
         return self.get_pubkey_from_xpub(xpub, (n,))
 
+    def derive_pubkeys(self, for_change, indices, processes=0):
+        xpub = self.get_branch_xpub(for_change)
+        return map_derivation(xpub_derive_pubkeys, (xpub,), indices, processes)
+
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
         _, _, _, _, c, cK = deserialize_xpub(xpub)
@@ -391,14 +458,15 @@ class Old_KeyStore(Deterministic_KeyStore):
     @classmethod
     def get_pubkey_from_mpk(self, mpk, for_change, n):
         z = self.get_sequence(mpk, for_change, n)
-        master_public_key = ecdsa.VerifyingKey.from_string(bfh(mpk), curve = SECP256k1)
-        pubkey_point = master_public_key.pubkey.point + z*SECP256k1.generator
-        public_key2 = ecdsa.VerifyingKey.from_public_point(pubkey_point, curve = SECP256k1)
-        return '04' + bh2u(public_key2.to_string())
+        pubkey = ecc_backend.backend.tweak_add_pubkey(bfh('04' + mpk), z, False)
+        return bh2u(pubkey)
 
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys(self, for_change, indices, processes=0):
+        return map_derivation(mpk_derive_pubkeys, (self.mpk, for_change), indices, processes)
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
@@ -24,7 +24,6 @@ import time
 import queue
 import os
 import stat
-import errno
 import random
 import re
 import select
@@ -38,12 +37,31 @@ from . import util
 from . import bitcoin
 from .bitcoin import *
 from .interface import Connection, Interface
+from .txcache import TxCache
+from .scoreboard import ServerScoreboard
 from . import blockchain
+from .transaction import Transaction
 from .version import ELECTRUM_VERSION, PROTOCOL_VERSION
 
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+LOOP_TIMEOUT = 1.0
+CHUNK_PIPELINE_DEPTH = 8
+# Client requests that any server following our chain answers the same
+# way; these are spread over all connected interfaces.
+BALANCED_METHODS = {
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+}
+
+
+def tx_matches(tx_hash, raw):
+    '''Whether raw is the serialization of transaction tx_hash.'''
+    try:
+        return Transaction(raw).txid() == tx_hash
+    except Exception:
+        return False
 
 
 def parse_servers(result):
@@ -91,14 +109,167 @@ def filter_protocol(hostmap, protocol = 's'):
             eligible.append(serialize_server(host, port, protocol))
     return eligible
 
-def pick_random_server(hostmap = None, protocol = 's', exclude_set = set()):
+def pick_random_server(hostmap = None, protocol = 's', exclude_set = set(), scoreboard = None):
     if hostmap is None:
         hostmap = bitcoin.NetworkConstants.DEFAULT_SERVERS
     eligible = list(set(filter_protocol(hostmap, protocol)) - exclude_set)
+    if scoreboard:
+        return scoreboard.choose(eligible)
     return random.choice(eligible) if eligible else None
 
 from .simple_config import SimpleConfig
 
+
+class SocketQueue(queue.Queue):
+    '''Queue of (server, socket) connection results.  Putting an item
+    wakes up the network loop.'''
+
+    def __init__(self, wakeup):
+        queue.Queue.__init__(self)
+        self.wakeup = wakeup
+
+    def put(self, item, block=True, timeout=None):
+        queue.Queue.put(self, item, block, timeout)
+        self.wakeup()
+
+
+class ChunkPipeline(util.PrintError):
+    '''Catch-up on headers with several get_chunk requests in flight,
+    spread over all interfaces whose tip is high enough.  Chunks may
+    arrive out of order; they are buffered and connected to the
+    blockchain strictly in index order.  The interface that started
+    the catch-up (the leader) always serves the last, possibly partial,
+    chunk.'''
+
+    def __init__(self, network, interface, index):
+        self.network = network
+        self.interface = interface
+        self.blockchain = interface.blockchain
+        self.next_request = index
+        self.next_connect = index
+        self.retry = []
+        self.in_flight = {}   # index -> (server, request time)
+        self.buffered = {}    # index -> (server, hex data)
+        self.failed = {}      # index -> servers that returned an error
+        self.message_ids = {} # index -> message id of the last request
+
+    def diagnostic_name(self):
+        return self.interface.host
+
+    def last_index(self):
+        return self.interface.tip // 2016
+
+    def expects(self, interface, index, message_id):
+        '''True if the response is to a request of the pipeline, and
+        not to another get_chunk request for the same index.'''
+        item = self.in_flight.get(index)
+        return (item is not None and item[0] == interface.server
+                and self.message_ids.get(index) == message_id)
+
+    def pick_interface(self, index):
+        if index == self.last_index():
+            return self.interface
+        height = (index + 1) * 2016 - 1
+        load = defaultdict(int)
+        for server, t in self.in_flight.values():
+            load[server] += 1
+        failed = self.failed.get(index, ())
+        # servers on another chain would send chunks that do not connect
+        candidates = [i for i in self.network.interfaces.values()
+                      if i.blockchain is self.blockchain and i.tip >= height
+                      and i.server not in failed]
+        if not candidates:
+            return self.interface
+        return min(candidates, key=lambda i: (load[i.server], i != self.interface))
+
+    def fill(self):
+        while len(self.in_flight) < CHUNK_PIPELINE_DEPTH:
+            if self.retry:
+                index = self.retry.pop(0)
+            elif (self.next_request <= self.last_index()
+                  and self.next_request < self.next_connect + CHUNK_PIPELINE_DEPTH):
+                index = self.next_request
+                self.next_request += 1
+            else:
+                break
+            interface = self.pick_interface(index)
+            interface.print_error("requesting chunk %d" % index)
+            message_id = self.network.queue_request('blockchain.block.get_chunk', [index], interface)
+            self.in_flight[index] = interface.server, time.time()
+            self.message_ids[index] = message_id
+
+    def on_chunk(self, interface, index, result):
+        self.in_flight.pop(index)
+        self.message_ids.pop(index, None)
+        self.failed.pop(index, None)
+        self.buffered[index] = interface.server, result
+        while self.next_connect in self.buffered:
+            index = self.next_connect
+            server, data = self.buffered.pop(index)
+            if not self.blockchain.connect_chunk(index, data):
+                self.retry.append(index)
+                self.network.connection_down(server)
+                if not self.is_active():
+                    return
+                break
+            self.next_connect += 1
+        self.network.notify('updated')
+        if self.next_connect > self.last_index():
+            self.done()
+        else:
+            self.fill()
+
+    def on_error(self, interface, index):
+        '''The chunk is requested again, from another server if there
+        is one.  The leader is dropped if it fails the same chunk twice,
+        as the pipeline cannot complete without it.'''
+        self.in_flight.pop(index)
+        self.message_ids.pop(index, None)
+        failed = self.failed.setdefault(index, set())
+        if interface is self.interface and interface.server in failed:
+            self.network.connection_down(interface.server)
+            return
+        failed.add(interface.server)
+        self.retry.append(index)
+        self.retry.sort()
+        self.fill()
+
+    def on_interface_down(self, server):
+        for index, (s, t) in list(self.in_flight.items()):
+            if s == server:
+                self.in_flight.pop(index)
+                self.message_ids.pop(index, None)
+                self.retry.append(index)
+        for index, (s, data) in list(self.buffered.items()):
+            if s == server:
+                self.buffered.pop(index)
+                self.retry.append(index)
+        self.retry.sort()
+        if self.is_active():
+            self.fill()
+
+    def maintain(self):
+        now = time.time()
+        for index, (server, t) in list(self.in_flight.items()):
+            interface = self.network.interfaces.get(server)
+            if interface is None:
+                continue
+            if now - t > 2 * interface.window.timeout() and self.is_active():
+                self.print_error("chunk request timed out", index, server)
+                self.network.scoreboard.on_timeout(server)
+                self.network.connection_down(server)
+
+    def is_active(self):
+        return self.network.chunk_pipeline is self
+
+    def done(self):
+        interface = self.interface
+        interface.request = None
+        interface.mode = 'default'
+        interface.print_error('catch up done', self.blockchain.height())
+        self.blockchain.catch_up = None
+        self.network.chunk_pipeline = None
+
 proxy_modes = ['socks4', 'socks5', 'http']
 
 
@@ -149,8 +320,8 @@ def serialize_server(host, port, protocol):
 class Network(util.DaemonThread):
     """The Network class manages a set of connections to remote electrum
     servers, each connected socket is handled by an Interface() object.
-    Connections are initiated by a Connection() thread which stops once
-    the connection succeeds or fails.
+    Connections are initiated by Connection(), which runs each attempt on
+    a bounded pool of threads until the connection succeeds or fails.
 
     Our external API:
 
@@ -170,6 +341,11 @@ class Network(util.DaemonThread):
         self.blockchain_index = config.get('blockchain_index', 0)
         if self.blockchain_index not in self.blockchains.keys():
             self.blockchain_index = 0
+        # JSON-RPC batches; servers that rejected one get single requests
+        self.batch_requests = self.config.get('batch_requests', True)
+        self.no_batch_servers = set()
+        # connection statistics of the servers we have used
+        self.scoreboard = ServerScoreboard(self.config)
         # Server for addresses and transactions
         self.default_server = self.config.get('server')
         # Sanitize default server
@@ -178,7 +354,7 @@ class Network(util.DaemonThread):
         except:
             self.default_server = None
         if not self.default_server:
-            self.default_server = pick_random_server()
+            self.default_server = pick_random_server(scoreboard=self.scoreboard)
 
         self.lock = threading.Lock()
         self.pending_sends = []
@@ -196,16 +372,27 @@ class Network(util.DaemonThread):
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)
 
+        # the network loop blocks in select(); other threads write to
+        # this socket pair to wake it up
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+
         dir_path = os.path.join( self.config.path, 'certs')
         if not os.path.exists(dir_path):
             os.mkdir(dir_path)
             os.chmod(dir_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
 
+        # raw transactions, shared by the wallets of this daemon
+        self.tx_cache = TxCache(self.config)
+
         # subscriptions and requests
         self.subscribed_addresses = set()
         self.h2addr = {}
         # Requests from client we've not seen a response to
         self.unanswered_requests = {}
+        # server each of them was sent to
+        self.request_servers = {}
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -216,10 +403,25 @@ class Network(util.DaemonThread):
         self.interfaces = {}
         self.auto_connect = self.config.get('auto_connect', True)
         self.connecting = set()
-        self.socket_queue = queue.Queue()
+        # start time of connection attempts
+        self.connect_time = {}
+        self.socket_queue = SocketQueue(self.wakeup)
+        self.chunk_pipeline = None
         self.start_network(deserialize_server(self.default_server)[2],
                            deserialize_proxy(self.config.get('proxy')))
 
+    def wakeup(self):
+        '''Make the network loop run now.  Can be called from any thread.'''
+        try:
+            self.wakeup_w.send(b'\x00')
+        except (BlockingIOError, OSError):
+            # already signalled, or shutting down
+            pass
+
+    def stop(self):
+        util.DaemonThread.stop(self)
+        self.wakeup()
+
     def register_callback(self, callback, events):
         with self.lock:
             for event in events:
@@ -300,12 +502,17 @@ class Network(util.DaemonThread):
     def send_subscriptions(self):
         self.print_error('sending subscriptions to', self.interface.server, len(self.unanswered_requests), len(self.subscribed_addresses))
         self.sub_cache.clear()
-        # Resend unanswered requests
-        requests = self.unanswered_requests.values()
+        # Resend unanswered requests to the new interface, except
+        # balanced ones still pending on another connected interface
+        requests = self.unanswered_requests
         self.unanswered_requests = {}
-        for request in requests:
-            message_id = self.queue_request(request[0], request[1])
-            self.unanswered_requests[message_id] = request
+        for message_id, request in requests.items():
+            server = self.request_servers.pop(message_id, None)
+            if request[0] in BALANCED_METHODS and server in self.interfaces:
+                self.unanswered_requests[message_id] = request
+                self.request_servers[message_id] = server
+            else:
+                self.queue_client_request(*request)
         self.queue_request('server.banner', [])
         self.queue_request('server.donation_address', [])
         self.queue_request('server.peers.subscribe', [])
@@ -355,6 +562,15 @@ class Network(util.DaemonThread):
         '''The interfaces that are in connected state'''
         return list(self.interfaces.keys())
 
+    def update_lag(self, interface):
+        '''Record how far a server's new tip is behind the best one'''
+        tip = max(i.tip for i in self.interfaces.values())
+        self.scoreboard.on_lag(interface.server, tip - interface.tip)
+
+    def get_interface_stats(self):
+        '''Request window, timeout and round trip times per connected server'''
+        return {server: i.get_stats() for server, i in list(self.interfaces.items())}
+
     def get_servers(self):
         out = bitcoin.NetworkConstants.DEFAULT_SERVERS
         if self.irc_servers:
@@ -375,11 +591,13 @@ class Network(util.DaemonThread):
                 self.print_error("connecting to %s as new interface" % server)
                 self.set_status('connecting')
             self.connecting.add(server)
+            self.connect_time[server] = time.time()
             c = Connection(server, self.socket_queue, self.config.path)
 
     def start_random_interface(self):
         exclude_set = self.disconnected_servers.union(set(self.interfaces))
-        server = pick_random_server(self.get_servers(), self.protocol, exclude_set)
+        server = pick_random_server(self.get_servers(), self.protocol, exclude_set,
+                                    self.scoreboard)
         if server:
             self.start_interface(server)
 
@@ -429,7 +647,7 @@ class Network(util.DaemonThread):
         assert not self.interfaces
         self.connecting = set()
         # Get a new queue - no old pending connections thanks!
-        self.socket_queue = queue.Queue()
+        self.socket_queue = SocketQueue(self.wakeup)
 
     def set_parameters(self, host, port, protocol, proxy, auto_connect):
         proxy_str = serialize_proxy(proxy)
@@ -461,12 +679,13 @@ class Network(util.DaemonThread):
             self.notify('updated')
 
     def switch_to_random_interface(self):
-        '''Switch to a random connected server other than the current one'''
+        '''Switch to a connected server other than the current one,
+        preferring those with good scores'''
         servers = self.get_interfaces()    # Those in connected state
         if self.default_server in servers:
             servers.remove(self.default_server)
         if servers:
-            self.switch_to_interface(random.choice(servers))
+            self.switch_to_interface(self.scoreboard.choose(servers))
 
     def switch_lagging_interface(self):
         '''If auto_connect and lagging, switch interface'''
@@ -475,7 +694,7 @@ class Network(util.DaemonThread):
             header = self.blockchain().read_header(self.get_local_height())
             filtered = list(map(lambda x:x[0], filter(lambda x: x[1].tip_header==header, self.interfaces.items())))
             if filtered:
-                choice = random.choice(filtered)
+                choice = self.scoreboard.choose(filtered)
                 self.switch_to_interface(choice)
 
     def switch_to_interface(self, server):
@@ -501,6 +720,7 @@ class Network(util.DaemonThread):
 
     def close_interface(self, interface):
         if interface:
+            self.scoreboard.on_close(interface.server, interface.get_stats())
             if interface.server in self.interfaces:
                 self.interfaces.pop(interface.server)
             if interface.server == self.default_server:
@@ -555,6 +775,9 @@ class Network(util.DaemonThread):
             self.on_get_chunk(interface, response)
         elif method == 'blockchain.block.get_header':
             self.on_get_header(interface, response)
+        elif method == 'blockchain.transaction.get':
+            if error is None and result:
+                self.tx_cache.put(params[0], result)
 
         for callback in callbacks:
             callback(response)
@@ -565,16 +788,31 @@ class Network(util.DaemonThread):
 
     def process_responses(self, interface):
         responses = interface.get_responses()
+        if self.batch_requests and not interface.batch_requests:
+            self.no_batch_servers.add(interface.server)
         for request, response in responses:
             if request:
                 method, params, message_id = request
                 k = self.get_index(method, params)
                 # client requests go through self.send() with a
-                # callback, are only sent to the current interface,
+                # callback, are sent to the current interface or, for
+                # BALANCED_METHODS, to any interface on its blockchain,
                 # and are placed in the unanswered_requests dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
                 if client_req:
-                    assert interface == self.interface
+                    self.request_servers.pop(message_id, None)
+                    if (method == 'blockchain.transaction.get'
+                            and not response.get('error')
+                            and not tx_matches(params[0], response.get('result'))):
+                        interface.print_error("wrong transaction", params[0])
+                        response = {'id': response.get('id'),
+                                    'error': 'transaction does not match its hash'}
+                    if (response.get('error') and self.interface
+                            and interface != self.interface):
+                        # the server may be lagging; ask the main one
+                        interface.print_error("retrying on main server", method)
+                        self.queue_client_request(*client_req, interface=self.interface)
+                        continue
                     callbacks = [client_req[2]]
                 else:
                     # fixme: will only work for subscriptions
@@ -631,14 +869,19 @@ class Network(util.DaemonThread):
         self.send(msgs, self.overload_cb(callback))
 
     def request_address_history(self, address, callback):
-        h = self.addr_to_scripthash(address)
-        self.send([('blockchain.scripthash.get_history', [h])], self.overload_cb(callback))
+        self.request_address_histories([address], callback)
+
+    def request_address_histories(self, addresses, callback):
+        hashes = [self.addr_to_scripthash(addr) for addr in addresses]
+        msgs = [('blockchain.scripthash.get_history', [x]) for x in hashes]
+        self.send(msgs, self.overload_cb(callback))
 
     def send(self, messages, callback):
         '''Messages is a list of (method, params) tuples'''
         messages = list(messages)
         with self.lock:
             self.pending_sends.append((messages, callback))
+        self.wakeup()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -666,8 +909,51 @@ class Network(util.DaemonThread):
                     util.print_error("cache hit", k)
                     callback(r)
                 else:
-                    message_id = self.queue_request(method, params)
-                    self.unanswered_requests[message_id] = method, params, callback
+                    self.queue_client_request(method, params, callback)
+
+    def queue_client_request(self, method, params, callback, interface=None):
+        if interface is None:
+            interface = self.pick_interface(method)
+        message_id = self.queue_request(method, params, interface)
+        self.unanswered_requests[message_id] = method, params, callback
+        self.request_servers[message_id] = interface.server
+
+    def pick_interface(self, method):
+        '''Interface for a client request.  Requests in BALANCED_METHODS
+        go to a random interface on the same blockchain as the main one,
+        weighted by round trip time and by how busy it is.'''
+        if method not in BALANCED_METHODS:
+            return self.interface
+        chain = self.interface.blockchain
+        candidates = [i for i in self.interfaces.values()
+                      if i.blockchain == chain and i.mode == 'default']
+        if len(candidates) < 2:
+            return self.interface
+        weights = []
+        for i in candidates:
+            rtt = i.window.srtt or i.window.timeout()
+            load = len(i.unsent_requests) + len(i.unanswered_requests)
+            weights.append(1. / (rtt * (1. + load / i.window.limit())))
+        x = random.uniform(0, sum(weights))
+        for i, w in zip(candidates, weights):
+            x -= w
+            if x <= 0:
+                return i
+        return candidates[-1]
+
+    def requeue_requests(self, server):
+        '''Send the client requests pending on a lost interface to the
+        main interface.  If the main interface itself was lost,
+        send_subscriptions resends them after the switch.'''
+        ids = [k for k, v in self.request_servers.items() if v == server]
+        for message_id in ids:
+            self.request_servers.pop(message_id)
+        if self.interface is None:
+            return
+        for message_id in ids:
+            request = self.unanswered_requests.pop(message_id, None)
+            if request:
+                self.queue_client_request(*request, interface=self.interface)
 
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
@@ -685,17 +971,30 @@ class Network(util.DaemonThread):
         self.disconnected_servers.add(server)
         if server == self.default_server:
             self.set_status('disconnected')
+        interface = self.interfaces.get(server)
+        if self.batch_requests and interface and interface.batch_unanswered():
+            interface.print_error("batch request not answered, disabling batches")
+            self.no_batch_servers.add(server)
         if server in self.interfaces:
             self.close_interface(self.interfaces[server])
             self.notify('interfaces')
+        self.requeue_requests(server)
         for b in self.blockchains.values():
             if b.catch_up == server:
                 b.catch_up = None
+        pipeline = self.chunk_pipeline
+        if pipeline:
+            if pipeline.interface.server == server:
+                self.chunk_pipeline = None
+            else:
+                pipeline.on_interface_down(server)
 
     def new_interface(self, server, socket):
         # todo: get tip first, then decide which checkpoint to use.
         self.add_recent_server(server)
         interface = Interface(server, socket)
+        interface.batch_requests = (self.batch_requests
+                                    and server not in self.no_batch_servers)
         interface.blockchain = None
         interface.tip_header = None
         interface.tip = 0
@@ -714,15 +1013,20 @@ class Network(util.DaemonThread):
             server, socket = self.socket_queue.get()
             if server in self.connecting:
                 self.connecting.remove(server)
+            t = self.connect_time.pop(server, None)
             if socket:
+                if t is not None:
+                    self.scoreboard.on_connect(server, time.time() - t)
                 self.new_interface(server, socket)
             else:
+                self.scoreboard.on_connect_failure(server)
                 self.connection_down(server)
 
         # Send pings and shut down stale interfaces
         # must use copy of values
         for interface in list(self.interfaces.values()):
             if interface.has_timed_out():
+                self.scoreboard.on_timeout(interface.server)
                 self.connection_down(interface.server)
             elif interface.ping_required():
                 params = [ELECTRUM_VERSION, PROTOCOL_VERSION]
@@ -759,16 +1063,33 @@ class Network(util.DaemonThread):
         interface.request = idx
         interface.req_time = time.time()
 
+    def start_chunk_pipeline(self, interface, idx):
+        if self.chunk_pipeline is not None:
+            # only one pipelined catch-up at a time
+            self.request_chunk(interface, idx)
+            return
+        interface.request = None
+        self.chunk_pipeline = ChunkPipeline(self, interface, idx)
+        self.chunk_pipeline.fill()
+
     def on_get_chunk(self, interface, response):
         '''Handle receiving a chunk of block headers'''
         error = response.get('error')
         result = response.get('result')
         params = response.get('params')
+        index = params[0] if params else None
+        pipeline = self.chunk_pipeline
+        pipelined = (pipeline is not None
+                     and pipeline.expects(interface, index, response.get('id')))
         if result is None or params is None or error is not None:
             interface.print_error(error or 'bad response')
+            if pipelined:
+                pipeline.on_error(interface, index)
+            return
+        if pipelined:
+            pipeline.on_chunk(interface, index, result)
             return
         # Ignore unsolicited chunks
-        index = params[0]
         if interface.request != index:
             return
         connect = interface.blockchain.connect_chunk(index, result)
@@ -907,7 +1228,7 @@ class Network(util.DaemonThread):
         # If not finished, get the next header
         if next_height:
             if interface.mode == 'catch_up' and interface.tip > next_height + 50:
-                self.request_chunk(interface, next_height // 2016)
+                self.start_chunk_pipeline(interface, next_height // 2016)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -919,32 +1240,43 @@ class Network(util.DaemonThread):
 
     def maintain_requests(self):
         for interface in list(self.interfaces.values()):
-            if interface.request and time.time() - interface.request_time > 20:
+            if (interface.request is not None
+                    and time.time() - interface.req_time > 2 * interface.window.timeout()):
                 interface.print_error("blockchain request timed out")
+                self.scoreboard.on_timeout(interface.server)
                 self.connection_down(interface.server)
                 continue
+        if self.chunk_pipeline:
+            self.chunk_pipeline.maintain()
+        for b in self.blockchains.values():
+            b.flush_if_due()
+        self.scoreboard.save_if_due()
 
     def wait_on_sockets(self):
-        # Python docs say Windows doesn't like empty selects.
-        # Sleep to prevent busy looping
-        if not self.interfaces:
-            time.sleep(0.1)
-            return
-        rin = [i for i in self.interfaces.values()]
+        # Block until a socket is ready, another thread calls wakeup(),
+        # or LOOP_TIMEOUT expires.  The wakeup socket also keeps the
+        # select non-empty, which Windows requires.
+        rin = [self.wakeup_r] + [i for i in self.interfaces.values()]
         win = [i for i in self.interfaces.values() if i.num_requests()]
         try:
-            rout, wout, xout = select.select(rin, win, [], 0.1)
-        except socket.error as e:
-            # TODO: py3, get code from e
-            code = None
-            if code == errno.EINTR:
-                return
-            raise
+            rout, wout, xout = select.select(rin, win, [], LOOP_TIMEOUT)
+        except InterruptedError:
+            return
         assert not xout
         for interface in wout:
             interface.send_requests()
         for interface in rout:
-            self.process_responses(interface)
+            if interface is self.wakeup_r:
+                self.drain_wakeups()
+            else:
+                self.process_responses(interface)
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
 
     def init_headers_file(self):
         b = self.blockchains[0]
@@ -955,9 +1287,24 @@ class Network(util.DaemonThread):
                 if length>0:
                     f.seek(length-1)
                     f.write(b'\x00')
+            with b.lock:
+                b.update_size()
+            snapshot = self.get_headers_snapshot()
+            if snapshot:
+                try:
+                    b.import_snapshot(snapshot)
+                except BaseException as e:
+                    self.print_error('cannot import headers snapshot', snapshot, str(e))
         with b.lock:
             b.update_size()
 
+    def get_headers_snapshot(self):
+        path = self.config.get('headers_snapshot')
+        if path is None:
+            name = 'headers_snapshot_testnet.gz' if bitcoin.NetworkConstants.TESTNET else 'headers_snapshot.gz'
+            path = os.path.join(os.path.dirname(__file__), name)
+        return path if os.path.exists(path) else None
+
     def run(self):
         self.init_headers_file()
         while self.is_running():
@@ -967,6 +1314,11 @@ class Network(util.DaemonThread):
             self.run_jobs()    # Synchronizer and Verifier
             self.process_pending_sends()
         self.stop_network()
+        self.scoreboard.save()
+        for b in self.blockchains.values():
+            b.flush()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
         self.on_stop()
 
     def on_notify_header(self, interface, header):
@@ -974,10 +1326,11 @@ class Network(util.DaemonThread):
         if not height:
             return
         if height < self.max_checkpoint():
-            self.connection_down(interface)
+            self.connection_down(interface.server)
             return
         interface.tip_header = header
         interface.tip = height
+        self.update_lag(interface)
         if interface.mode != 'default':
             return
         b = blockchain.check_header(header)
@@ -1073,5 +1426,9 @@ class Network(util.DaemonThread):
         with open(path, 'w') as f:
             f.write(json.dumps(cp, indent=4))
 
+    def export_headers_snapshot(self, path):
+        # headers up to the last checkpoint, see Blockchain.import_snapshot
+        return self.blockchains[0].export_snapshot(path)
+
     def max_checkpoint(self):
         return max(0, len(bitcoin.NetworkConstants.CHECKPOINTS) * 2016 - 1)
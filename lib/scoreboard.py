@@ -0,0 +1,175 @@
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import json
+import os
+import random
+import time
+
+from .util import PrintError
+
+
+# weight of a new sample in the moving averages
+ALPHA = 0.3
+# values assumed for servers without measurements, in seconds
+DEFAULT_CONNECT_TIME = 2.0
+DEFAULT_RTT = 1.0
+# seconds of expected cost added per failed connection, per timeout
+# and per block of lag, scaled by how often they happen
+FAILURE_PENALTY = 10.0
+TIMEOUT_PENALTY = 20.0
+LAG_PENALTY = 5.0
+# how often the scoreboard is written to disk, in seconds
+SAVE_INTERVAL = 60
+# entries not seen for this long are forgotten
+MAX_AGE = 30 * 24 * 3600
+# counters are halved when attempts reach this, so old events fade
+MAX_ATTEMPTS = 100
+
+EMPTY_SCORE = {
+    'attempts': 0, 'failures': 0, 'timeouts': 0,
+    'connect_time': None, 'rtt_p50': None, 'rtt_p90': None,
+    'error_rate': 0., 'lag': 0.,
+}
+
+
+def ewma(old, sample):
+    return sample if old is None else (1 - ALPHA) * old + ALPHA * sample
+
+
+class ServerScoreboard(PrintError):
+    """Per-server connection statistics, kept in config.path/server_scores.
+
+    For each server, records the time taken to connect, the median and
+    90th percentile round trip times of its requests, how many
+    connection attempts failed or timed out, its error rate, and how
+    many blocks its tip lagged behind the best known tip.  score()
+    turns these into an expected cost in seconds, and choose() picks
+    servers with probability inversely proportional to it.  Servers
+    without measurements get default values, so they are still tried.
+    """
+
+    def __init__(self, config):
+        self.path = os.path.join(config.path, 'server_scores') if config.path else None
+        self.scores = self.read()
+        self.last_save = time.time()
+        self.dirty = False
+
+    def diagnostic_name(self):
+        return 'scoreboard'
+
+    def read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                scores = json.loads(f.read())
+        except:
+            return {}
+        now = time.time()
+        return {k: dict(EMPTY_SCORE, **v) for k, v in scores.items()
+                if isinstance(v, dict) and now - v.get('last_seen', 0) < MAX_AGE}
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        s = json.dumps(self.scores, indent=4, sort_keys=True)
+        try:
+            with open(self.path, 'w') as f:
+                f.write(s)
+        except:
+            return
+        self.dirty = False
+        self.last_save = time.time()
+
+    def save_if_due(self):
+        if time.time() - self.last_save > SAVE_INTERVAL:
+            self.save()
+
+    def get(self, server):
+        d = self.scores.get(server)
+        if d is None:
+            d = self.scores[server] = dict(EMPTY_SCORE)
+        d['last_seen'] = time.time()
+        self.dirty = True
+        return d
+
+    def add_attempt(self, server):
+        d = self.get(server)
+        d['attempts'] += 1
+        if d['attempts'] >= MAX_ATTEMPTS:
+            for k in ['attempts', 'failures', 'timeouts']:
+                d[k] //= 2
+        return d
+
+    def on_connect(self, server, seconds):
+        d = self.add_attempt(server)
+        d['connect_time'] = ewma(d['connect_time'], seconds)
+
+    def on_connect_failure(self, server):
+        self.add_attempt(server)['failures'] += 1
+
+    def on_timeout(self, server):
+        self.get(server)['timeouts'] += 1
+
+    def on_lag(self, server, blocks):
+        d = self.get(server)
+        d['lag'] = ewma(d['lag'], blocks)
+
+    def on_close(self, server, stats):
+        '''Record the request statistics of a closed Interface.'''
+        d = self.get(server)
+        for k in ['rtt_p50', 'rtt_p90']:
+            if stats.get(k) is not None:
+                d[k] = ewma(d[k], stats[k])
+        if stats.get('rtt_p50') is not None:
+            d['error_rate'] = ewma(d['error_rate'], stats['error_rate'])
+
+    def score(self, server):
+        d = self.scores.get(server)
+        if d is None:
+            return DEFAULT_CONNECT_TIME + DEFAULT_RTT
+        attempts = max(1, d['attempts'])
+        rtt = d['rtt_p50'] if d['rtt_p50'] is not None else DEFAULT_RTT
+        if d['rtt_p90'] is not None:
+            rtt = (rtt + d['rtt_p90']) / 2
+        connect_time = d['connect_time'] if d['connect_time'] is not None else DEFAULT_CONNECT_TIME
+        return (connect_time + rtt * (1 + d['error_rate'])
+                + FAILURE_PENALTY * d['failures'] / attempts
+                + TIMEOUT_PENALTY * d['timeouts'] / attempts
+                + LAG_PENALTY * d['lag'])
+
+    def choose(self, servers):
+        '''Pick one of servers, preferring low scores.'''
+        servers = list(servers)
+        if not servers:
+            return None
+        weights = [1. / max(0.01, self.score(s)) for s in servers]
+        x = random.uniform(0, sum(weights))
+        for s, w in zip(servers, weights):
+            x -= w
+            if x <= 0:
+                return s
+        return servers[-1]
+
+    def get_stats(self):
+        return {k: dict(v, score=self.score(k)) for k, v in self.scores.items()}
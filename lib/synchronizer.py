@@ -30,6 +30,16 @@ from .transaction import Transaction
 from .util import ThreadJob, bh2u
 
 
+class StatusCache(object):
+
+    def __init__(self, hist, prefix, n, sha, status):
+        self.hist = hist        # history object the status is for
+        self.prefix = prefix    # same history, as a list of tuples
+        self.n = n              # length of its confirmed part
+        self.sha = sha          # hash state after the confirmed part
+        self.status = status
+
+
 class Synchronizer(ThreadJob):
     '''The synchronizer keeps the wallet up-to-date with its set of
     addresses and their transactions.  It subscribes over the network
@@ -38,7 +48,14 @@ class Synchronizer(ThreadJob):
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
 
-    External interface: __init__() and add() member functions.
+    Until the wallet is first up to date, the synchronizer is in bulk
+    mode: history requests, transaction requests, verified histories
+    and received transactions are queued, and run() handles each queue
+    as one batch.  Transactions wanted by several addresses are only
+    requested once.
+
+    External interface: __init__(), add() and get_progress() member
+    functions.
     '''
 
     def __init__(self, wallet, network):
@@ -49,6 +66,21 @@ class Synchronizer(ThreadJob):
         self.requested_tx = {}
         self.requested_histories = {}
         self.requested_addrs = set()
+        # addr -> StatusCache of the last history whose status we computed
+        self.status_cache = {}
+        # bulk mode queues
+        self.bulk = True
+        self.history_requests = []
+        self.tx_requests = []
+        self.histories = []
+        self.txs = []
+        self.progress = {
+            'addresses': 0,
+            'statuses': 0,
+            'histories': 0,
+            'txs_requested': 0,
+            'txs': 0,
+        }
         self.lock = Lock()
         self.initialize()
 
@@ -60,7 +92,9 @@ class Synchronizer(ThreadJob):
 
     def is_up_to_date(self):
         return (not self.requested_tx and not self.requested_histories
-                and not self.requested_addrs)
+                and not self.requested_addrs and not self.history_requests
+                and not self.tx_requests and not self.histories
+                and not self.txs)
 
     def release(self):
         self.network.unsubscribe(self.on_address_status)
@@ -69,9 +103,16 @@ class Synchronizer(ThreadJob):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+        self.network.wakeup()
+
+    def get_progress(self):
+        '''Counters of addresses subscribed, statuses received, histories
+        stored, and transactions requested and received.'''
+        return dict(self.progress, bulk=self.bulk)
 
     def subscribe_to_addresses(self, addresses):
         if addresses:
+            self.progress['addresses'] += len(addresses)
             self.requested_addrs |= addresses
             self.network.subscribe_to_addresses(addresses, self.on_address_status)
 
@@ -83,16 +124,50 @@ class Synchronizer(ThreadJob):
             status += tx_hash + ':%d:' % height
         return bh2u(hashlib.sha256(status.encode('ascii')).digest())
 
+    def get_address_status(self, addr, h):
+        '''Same as get_status(h), for the history h of addr.  The result is
+        cached until the history object changes, and the hash state of
+        its confirmed part is kept so that a history which only grows
+        by new confirmed transactions is not hashed again.'''
+        cache = self.status_cache.get(addr)
+        if cache and cache.hist is h:
+            return cache.status
+        if not h:
+            self.status_cache.pop(addr, None)
+            return None
+        hist = h if type(h[0]) is tuple else list(map(tuple, h))
+        # unconfirmed transactions come last
+        n = len(hist)
+        while n > 0 and hist[n-1][1] <= 0:
+            n -= 1
+        if cache and cache.n <= n and hist[:cache.n] == cache.prefix[:cache.n]:
+            sha = cache.sha.copy()
+            start = cache.n
+        else:
+            sha = hashlib.sha256()
+            start = 0
+        item = lambda x: x[0] + ':%d:' % x[1]
+        sha.update(''.join(map(item, hist[start:n])).encode('ascii'))
+        full = sha.copy()
+        full.update(''.join(map(item, hist[n:])).encode('ascii'))
+        status = bh2u(full.digest())
+        self.status_cache[addr] = StatusCache(h, hist, n, sha, status)
+        return status
+
     def on_address_status(self, response):
         params, result = self.parse_response(response)
         if not params:
             return
         addr = params[0]
+        self.progress['statuses'] += 1
         history = self.wallet.get_address_history(addr)
-        if self.get_status(history) != result:
+        if self.get_address_status(addr, history) != result:
             if self.requested_histories.get(addr) is None:
                 self.requested_histories[addr] = result
-                self.network.request_address_history(addr, self.on_address_history)
+                if self.bulk:
+                    self.history_requests.append(addr)
+                else:
+                    self.network.request_address_history(addr, self.on_address_history)
         # remove addr from list only after it is added to requested_histories
         if addr in self.requested_addrs:  # Notifications won't be in
             self.requested_addrs.remove(addr)
@@ -116,11 +191,15 @@ class Synchronizer(ThreadJob):
         if len(hashes) != len(result):
             self.print_error("error: server history has non-unique txids: %s"% addr)
         # Check that the status corresponds to what was announced
-        elif self.get_status(hist) != server_status:
+        elif self.get_address_status(addr, hist) != server_status:
             self.print_error("error: status mismatch: %s" % addr)
+        elif self.bulk:
+            self.histories.append((addr, hist, tx_fees))
+            self.request_missing_txs(hist)
         else:
             # Store received history
             self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.progress['histories'] += 1
             # Request transactions we don't have
             self.request_missing_txs(hist)
         # Remove request; this allows up_to_date to be True
@@ -131,15 +210,21 @@ class Synchronizer(ThreadJob):
         if not params:
             return
         tx_hash = params[0]
-        #assert tx_hash == hash_encode(Hash(bytes.fromhex(result)))
         tx = Transaction(result)
         try:
             tx.deserialize()
         except Exception:
             self.print_msg("cannot deserialize transaction, skipping", tx_hash)
             return
+        if tx.txid() != tx_hash:
+            self.print_error("transaction does not match its hash, skipping", tx_hash)
+            return
         tx_height = self.requested_tx.pop(tx_hash)
+        if self.bulk:
+            self.txs.append((tx_hash, tx, tx_height))
+            return
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        self.progress['txs'] += 1
         self.print_error("received tx %s height: %d bytes: %d" %
                          (tx_hash, tx_height, len(tx.raw)))
         # callbacks
@@ -147,18 +232,54 @@ class Synchronizer(ThreadJob):
         if not self.requested_tx:
             self.network.trigger_callback('updated')
 
+    def process_bulk(self):
+        '''Send and apply the work queued in bulk mode.'''
+        if self.history_requests:
+            addrs, self.history_requests = self.history_requests, []
+            self.network.request_address_histories(addrs, self.on_address_history)
+        if self.tx_requests:
+            requests = [('blockchain.transaction.get', [tx_hash])
+                        for tx_hash in self.tx_requests]
+            self.tx_requests = []
+            self.progress['txs_requested'] += len(requests)
+            self.network.send(requests, self.tx_response)
+        if self.histories:
+            histories, self.histories = self.histories, []
+            self.wallet.receive_history_batch(histories)
+            self.progress['histories'] += len(histories)
+        if self.txs:
+            txs, self.txs = self.txs, []
+            self.wallet.receive_tx_batch(txs)
+            self.progress['txs'] += len(txs)
+            for tx_hash, tx, tx_height in txs:
+                self.network.trigger_callback('new_transaction', tx)
+            self.print_error("bulk sync", self.progress)
+            if not self.requested_tx:
+                self.network.trigger_callback('updated')
+
 
     def request_missing_txs(self, hist):
         # "hist" is a list of [tx_hash, tx_height] lists
         requests = []
+        cached = []
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             if tx_hash in self.wallet.transactions:
                 continue
-            requests.append(('blockchain.transaction.get', [tx_hash]))
             self.requested_tx[tx_hash] = tx_height
-        self.network.send(requests, self.tx_response)
+            raw = self.network.tx_cache.get(tx_hash)
+            if raw:
+                cached.append({'params': [tx_hash], 'result': raw})
+            elif self.bulk:
+                self.tx_requests.append(tx_hash)
+            else:
+                requests.append(('blockchain.transaction.get', [tx_hash]))
+        for response in cached:
+            self.tx_response(response)
+        if requests:
+            self.progress['txs_requested'] += len(requests)
+            self.network.send(requests, self.tx_response)
 
 
     def initialize(self):
@@ -189,8 +310,15 @@ class Synchronizer(ThreadJob):
             self.new_addresses = set()
         self.subscribe_to_addresses(addresses)
 
-        # 3. Detect if situation has changed
+        # 3. Handle the work queued in bulk mode
+        if self.bulk:
+            self.process_bulk()
+
+        # 4. Detect if situation has changed
         up_to_date = self.is_up_to_date()
+        if up_to_date and self.bulk:
+            self.print_error("initial synchronization done", self.progress)
+            self.bulk = False
         if up_to_date != self.wallet.is_up_to_date():
             self.wallet.set_up_to_date(up_to_date)
             self.network.trigger_callback('updated')
@@ -0,0 +1,252 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from lib import bitcoin
+from lib import blockchain
+from lib.util import bfh
+
+
+# mainnet headers 0..4
+HEADERS = [
+    '0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c',
+    '010000006fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000982051fd1e4ba744bbbe680e1fee14677ba1a3c3540bf7b1cdb606e857233e0e61bc6649ffff001d01e36299',
+    '010000004860eb18bf1b1620e37e9490fc8a427514416fd75159ab86688e9a8300000000d5fdcc541e25de1c7a5addedf24858b8bb665c9f36ef744ee42c316022c90f9bb0bc6649ffff001d08d2bd61',
+    '01000000bddd99ccfda39da1b108ce1a5d70038d0a967bacb68b6b63065f626a0000000044f672226090d85db9a9f2fbfe5f0f9609b387af7be5b7fbb7a1767c831c9e995dbe6649ffff001d05e0ed6d',
+    '010000004944469562ae1c2c74d9a535e00b6f3e40ffbad4f2fda3895501b582000000007a06ea98cd40ba2e3288262b28638cec5337c1456aaf5eedc8e9e5a20f062bdf8cc16649ffff001d2bfee0a9',
+]
+
+
+def make_linked_chunk():
+    # headers that only satisfy the prev-hash linkage, for use on testnet
+    headers = []
+    prev_hash = '00' * 32
+    for i in range(2016):
+        header = {'version': 1, 'prev_block_hash': prev_hash, 'merkle_root': '00' * 32,
+                  'timestamp': 1231006505 + i, 'bits': 0x1d00ffff, 'nonce': i}
+        headers.append(blockchain.serialize_header(header))
+        prev_hash = blockchain.hash_header(header)
+    return bfh(''.join(headers)), prev_hash
+
+
+class FakeConfig(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key, default=None):
+        return default
+
+
+class TestBlockchain(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBlockchain, self).setUp()
+        self.data_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.data_dir, 'forks'))
+        self.config = FakeConfig(self.data_dir)
+        blockchain.blockchains.clear()
+        patcher = mock.patch.object(bitcoin.NetworkConstants, 'CHECKPOINTS', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(TestBlockchain, self).tearDown()
+        for b in blockchain.blockchains.values():
+            b.store.close()
+        blockchain.blockchains.clear()
+        shutil.rmtree(self.data_dir)
+
+    def _make_chain(self, n):
+        path = os.path.join(self.data_dir, 'blockchain_headers')
+        with open(path, 'wb') as f:
+            f.write(bfh(''.join(HEADERS[:n])))
+        b = blockchain.Blockchain(self.config, 0, None)
+        blockchain.blockchains[0] = b
+        return b
+
+    def test_read_header(self):
+        b = self._make_chain(3)
+        self.assertEqual(2, b.height())
+        header = b.read_header(1)
+        self.assertEqual(1, header['block_height'])
+        self.assertEqual(blockchain.hash_header(b.read_header(0)), header['prev_block_hash'])
+        self.assertIsNone(b.read_header(3))
+        self.assertIsNone(b.read_header(-1))
+
+    def test_read_header_after_write(self):
+        b = self._make_chain(3)
+        header = blockchain.deserialize_header(bfh(HEADERS[3]), 3)
+        b.save_header(header)
+        self.assertEqual(3, b.height())
+        self.assertEqual(header, b.read_header(3))
+        # truncating rewrite
+        b.write(bfh(HEADERS[1]), 80)
+        self.assertEqual(1, b.height())
+        self.assertIsNone(b.read_header(2))
+
+    def test_read_header_empty_file(self):
+        open(os.path.join(self.data_dir, 'blockchain_headers'), 'wb').close()
+        b = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual(-1, b.height())
+        self.assertIsNone(b.read_header(0))
+
+    def test_verify_chunk(self):
+        b = self._make_chain(1)
+        data = bfh(''.join(HEADERS))
+        b.verify_chunk(0, data)
+        self.assertTrue(b.connect_chunk(0, ''.join(HEADERS)))
+        self.assertEqual(4, b.height())
+
+    def test_verify_chunk_rejects_bad_link(self):
+        b = self._make_chain(1)
+        data = bfh(HEADERS[0] + HEADERS[2])
+        with self.assertRaises(BaseException):
+            b.verify_chunk(0, data)
+
+    def test_verify_chunk_rejects_bad_pow(self):
+        b = self._make_chain(1)
+        # bump the nonce of header 1
+        bad = HEADERS[1][:-8] + '00000000'
+        with self.assertRaises(BaseException):
+            b.verify_chunk(0, bfh(HEADERS[0] + bad))
+        self.assertFalse(b.connect_chunk(0, HEADERS[0] + bad))
+
+    @mock.patch.object(bitcoin.NetworkConstants, 'TESTNET', True)
+    def test_snapshot_roundtrip(self):
+        data, last_hash = make_linked_chunk()
+        path = os.path.join(self.data_dir, 'blockchain_headers')
+        with open(path, 'wb') as f:
+            f.write(data)
+        b = blockchain.Blockchain(self.config, 0, None)
+        b.checkpoints = [(last_hash, 0)]
+        snapshot = os.path.join(self.data_dir, 'snapshot.gz')
+        self.assertEqual(1, b.export_snapshot(snapshot))
+        # import into a sparse file
+        with open(path, 'wb') as f:
+            f.seek(len(data) - 1)
+            f.write(b'\x00')
+        b.update_size()
+        self.assertIsNone(b.read_header(100))
+        self.assertEqual(1, b.import_snapshot(snapshot))
+        self.assertEqual(blockchain.deserialize_header(data[8000:8080], 100), b.read_header(100))
+
+    @mock.patch.object(bitcoin.NetworkConstants, 'TESTNET', True)
+    def test_snapshot_rejects_wrong_checkpoint(self):
+        data, last_hash = make_linked_chunk()
+        snapshot = os.path.join(self.data_dir, 'snapshot.gz')
+        with gzip.open(snapshot, 'wb') as f:
+            f.write(blockchain.SNAPSHOT_MAGIC + b'\x00\x00\x00\x01' + data)
+        open(os.path.join(self.data_dir, 'blockchain_headers'), 'wb').close()
+        b = blockchain.Blockchain(self.config, 0, None)
+        b.checkpoints = [('00' * 32, 0)]
+        self.assertEqual(0, b.import_snapshot(snapshot))
+        self.assertEqual(-1, b.height())
+
+    @mock.patch.object(bitcoin.NetworkConstants, 'TESTNET', True)
+    def test_snapshot_truncated(self):
+        data, last_hash = make_linked_chunk()
+        snapshot = os.path.join(self.data_dir, 'snapshot.gz')
+        path = os.path.join(self.data_dir, 'blockchain_headers')
+        # announces three chunks, but the file ends inside the second one
+        with gzip.open(snapshot, 'wb') as f:
+            f.write(blockchain.SNAPSHOT_MAGIC + b'\x00\x00\x00\x03' + data + data[:8000])
+        open(path, 'wb').close()
+        b = blockchain.Blockchain(self.config, 0, None)
+        b.checkpoints = [(last_hash, 0), ('00' * 32, 0), ('00' * 32, 0)]
+        self.assertEqual(1, b.import_snapshot(snapshot))
+        self.assertEqual(2015, b.height())
+        # the compressed stream itself is cut short
+        with open(snapshot, 'rb') as f:
+            compressed = f.read()
+        with open(snapshot, 'wb') as f:
+            f.write(compressed[:len(compressed) // 2])
+        open(path, 'wb').close()
+        b.update_size()
+        self.assertEqual(0, b.import_snapshot(snapshot))
+        self.assertEqual(-1, b.height())
+
+    def test_hash_cache_invalidated_by_write(self):
+        b = self._make_chain(5)
+        h3 = blockchain.hash_header(blockchain.deserialize_header(bfh(HEADERS[3]), 3))
+        self.assertEqual(h3, b.get_hash(3))
+        self.assertIn(3, b.hashes)
+        # rewrite from height 2; header 3 is gone
+        b.write(bfh(HEADERS[2]), 160)
+        self.assertNotIn(3, b.hashes)
+        self.assertEqual('0' * 64, b.get_hash(3))
+        self.assertNotIn(3, b.hashes)
+        b.save_header(blockchain.deserialize_header(bfh(HEADERS[3]), 3))
+        self.assertEqual(h3, b.hashes.get(3))
+
+    def test_fork_lookup(self):
+        b = self._make_chain(5)
+        header = blockchain.deserialize_header(bfh(HEADERS[3]), 3)
+        other = dict(header)
+        other['nonce'] += 1
+        fork = b.fork(other)
+        self.assertIs(fork, blockchain.blockchains[3])
+        self.assertEqual(3, b.get_max_child())
+        self.assertEqual(3, b.get_checkpoint())
+        self.assertIsNone(fork.get_max_child())
+        self.assertIs(b, blockchain.check_header(header))
+        self.assertIs(fork, blockchain.check_header(other))
+        self.assertIs(fork, blockchain.lookup_hash(blockchain.hash_header(other), 3))
+        self.assertFalse(blockchain.check_header(blockchain.deserialize_header(bfh(HEADERS[4]), 3)))
+        self.assertEqual(b.get_hash(2), fork.get_hash(2))
+        # the next header connects to the main chain only
+        self.assertFalse(blockchain.can_connect(blockchain.deserialize_header(bfh(HEADERS[4]), 4)))
+        b.write(b'', 4 * 80)
+        self.assertIs(b, blockchain.can_connect(blockchain.deserialize_header(bfh(HEADERS[4]), 4)))
+
+    def test_write_behind(self):
+        b = self._make_chain(3)
+        path = b.path()
+        b.fsync_interval = 3600
+        for i in (3, 4):
+            b.save_header(blockchain.deserialize_header(bfh(HEADERS[i]), i))
+        self.assertEqual(4, b.height())
+        self.assertEqual(3 * 80, os.path.getsize(path))
+        self.assertEqual(blockchain.deserialize_header(bfh(HEADERS[4]), 4), b.read_header(4))
+        b.flush()
+        self.assertEqual(5 * 80, os.path.getsize(path))
+        self.assertEqual(4, b.height())
+        self.assertEqual(blockchain.deserialize_header(bfh(HEADERS[4]), 4), b.read_header(4))
+
+    def test_write_behind_flushed_by_rewrite(self):
+        b = self._make_chain(3)
+        b.fsync_interval = 3600
+        b.save_header(blockchain.deserialize_header(bfh(HEADERS[3]), 3))
+        b.write(bfh(HEADERS[2]), 160)
+        self.assertEqual(2, b.height())
+        self.assertEqual(3 * 80, os.path.getsize(b.path()))
+
+    @mock.patch.object(bitcoin.NetworkConstants, 'TESTNET', True)
+    def test_fork_survives_restart(self):
+        b = self._make_chain(4)
+        other = blockchain.deserialize_header(bfh(HEADERS[3]), 3)
+        other['nonce'] += 1
+        fork = b.fork(other)
+        # on disk without an explicit flush
+        self.assertEqual(80, os.path.getsize(fork.path()))
+        # an empty fork file, left by an older version
+        empty = os.path.join(self.data_dir, 'forks', 'fork_0_2')
+        open(empty, 'wb').close()
+        for c in blockchain.blockchains.values():
+            c.store.close()
+        blockchain.blockchains.clear()
+        chains = blockchain.read_blockchains(self.config)
+        self.assertEqual({0, 3}, set(chains))
+        self.assertEqual(other, chains[3].read_header(3))
+        self.assertFalse(os.path.exists(empty))
+
+    def test_truncate_partial_record(self):
+        path = os.path.join(self.data_dir, 'blockchain_headers')
+        with open(path, 'wb') as f:
+            f.write(bfh(''.join(HEADERS[:2]) + HEADERS[2][:50]))
+        b = blockchain.Blockchain(self.config, 0, None)
+        self.assertEqual(1, b.height())
+        self.assertEqual(2 * 80, os.path.getsize(path))
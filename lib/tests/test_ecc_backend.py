@@ -0,0 +1,108 @@
+import hashlib
+import os
+import unittest
+
+import ecdsa
+
+from lib import ecc_backend
+from lib.bitcoin import (SECP256k1, MySigningKey, MyVerifyingKey, point_to_ser,
+                         generator_secp256k1)
+
+
+N = generator_secp256k1.order()
+
+
+class ConformanceMixin(object):
+    """Checks a backend against the ecdsa module."""
+
+    backend = None
+
+    def random_secret(self):
+        return (int.from_bytes(os.urandom(32), 'big') % (N - 1) + 1).to_bytes(32, 'big')
+
+    def test_pubkey_from_secret(self):
+        for secret in [(1).to_bytes(32, 'big'), (N - 1).to_bytes(32, 'big'), self.random_secret()]:
+            point = int.from_bytes(secret, 'big') * SECP256k1.generator
+            for compressed in [True, False]:
+                self.assertEqual(point_to_ser(point, compressed),
+                                 self.backend.pubkey_from_secret(secret, compressed))
+        for secret in [bytes(32), N.to_bytes(32, 'big'), bytes(31)]:
+            with self.assertRaises(ValueError):
+                self.backend.pubkey_from_secret(secret)
+
+    def test_sign(self):
+        for i in range(5):
+            secret = self.random_secret()
+            h = os.urandom(32)
+            private_key = MySigningKey.from_secret_exponent(int.from_bytes(secret, 'big'), curve=SECP256k1)
+            expected = private_key.sign_digest_deterministic(
+                h, hashfunc=hashlib.sha256, sigencode=ecdsa.util.sigencode_strings)
+            r, s = self.backend.sign(secret, h)
+            self.assertLessEqual(s, N // 2)
+            self.assertEqual(expected, (r.to_bytes(32, 'big'), s.to_bytes(32, 'big')))
+
+    def test_verify(self):
+        secret = self.random_secret()
+        h = os.urandom(32)
+        r, s = self.backend.sign(secret, h)
+        for compressed in [True, False]:
+            pubkey = self.backend.pubkey_from_secret(secret, compressed)
+            self.assertTrue(self.backend.verify(pubkey, r, s, h))
+            # high S values are accepted too
+            self.assertTrue(self.backend.verify(pubkey, r, N - s, h))
+            self.assertFalse(self.backend.verify(pubkey, r, s, os.urandom(32)))
+            self.assertFalse(self.backend.verify(pubkey, r, s + 1, h))
+            self.assertFalse(self.backend.verify(pubkey, r, 0, h))
+            self.assertFalse(self.backend.verify(pubkey, N, s, h))
+        self.assertFalse(self.backend.verify(b'\x02' + b'\xff' * 32, r, s, h))
+
+    def test_recover(self):
+        secret = self.random_secret()
+        h = os.urandom(32)
+        r, s = self.backend.sign(secret, h)
+        sig_string = r.to_bytes(32, 'big') + s.to_bytes(32, 'big')
+        pubkey = self.backend.pubkey_from_secret(secret, True)
+        found = []
+        for recid in range(4):
+            recovered = self.backend.recover(r, s, recid, h, True)
+            if r + (recid // 2) * N >= ecc_backend.P:
+                # x out of range; MyVerifyingKey does not check this
+                self.assertIsNone(recovered)
+                continue
+            try:
+                public_key = MyVerifyingKey.from_signature(sig_string, recid, h, curve=SECP256k1)
+            except BaseException:
+                self.assertIsNone(recovered)
+                continue
+            self.assertEqual(point_to_ser(public_key.pubkey.point, True), recovered)
+            if recovered == pubkey:
+                found.append(recid)
+                self.assertEqual(self.backend.pubkey_from_secret(secret, False),
+                                 self.backend.recover(r, s, recid, h, False))
+        self.assertEqual(1, len(found))
+        self.assertIsNone(self.backend.recover(0, s, 0, h))
+        self.assertIsNone(self.backend.recover(r, s, 4, h))
+
+    def test_tweak_add_pubkey(self):
+        secret = self.random_secret()
+        k = int.from_bytes(os.urandom(32), 'big') % N
+        expected = ((int.from_bytes(secret, 'big') + k) % N).to_bytes(32, 'big')
+        for compressed in [True, False]:
+            pubkey = self.backend.pubkey_from_secret(secret, compressed)
+            self.assertEqual(self.backend.pubkey_from_secret(expected, compressed),
+                             self.backend.tweak_add_pubkey(pubkey, k, compressed))
+        with self.assertRaises(ValueError):
+            self.backend.tweak_add_pubkey(b'\x02' + b'\xff' * 32, k)
+
+
+class TestPythonBackend(ConformanceMixin, unittest.TestCase):
+
+    backend = ecc_backend.PythonBackend()
+
+
+@unittest.skipIf(ecc_backend.libsecp256k1 is None, "libsecp256k1 not available")
+class TestLibsecpBackend(ConformanceMixin, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = ecc_backend.LibsecpBackend(ecc_backend.libsecp256k1)
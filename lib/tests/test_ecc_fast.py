@@ -0,0 +1,46 @@
+import os
+import unittest
+
+from lib import ecc_fast
+from lib.bitcoin import SECP256k1, point_to_ser, ser_to_point
+
+
+class TestEccFast(unittest.TestCase):
+
+    def test_mul_G(self):
+        for k in [1, 2, 255, 256, ecc_fast.N - 1] + [int.from_bytes(os.urandom(32), 'big') for i in range(10)]:
+            expected = (k % ecc_fast.N) * SECP256k1.generator
+            q = ecc_fast.to_affine(ecc_fast.mul_G(k))
+            self.assertEqual((expected.x(), expected.y()), q)
+        self.assertIsNone(ecc_fast.to_affine(ecc_fast.mul_G(ecc_fast.N)))
+
+    def test_tweak_add_pubkey(self):
+        for i in range(10):
+            secret = int.from_bytes(os.urandom(32), 'big') % ecc_fast.N
+            k = int.from_bytes(os.urandom(32), 'big') % ecc_fast.N
+            point = secret * SECP256k1.generator
+            expected = k * SECP256k1.generator + point
+            for compressed in [True, False]:
+                ser = point_to_ser(point, compressed)
+                self.assertEqual(point_to_ser(expected, compressed),
+                                 ecc_fast.tweak_add_pubkey(ser, k, compressed))
+                self.assertEqual(ser, ecc_fast.serialize(ecc_fast.decompress(ser), compressed))
+
+    def test_tweak_add_opposite(self):
+        k = 12345
+        ser = ecc_fast.serialize(ecc_fast.to_affine(ecc_fast.mul_G(ecc_fast.N - k)))
+        with self.assertRaises(ValueError):
+            ecc_fast.tweak_add_pubkey(ser, k)
+
+    def test_decompress_invalid(self):
+        ser = point_to_ser(7 * SECP256k1.generator, True)
+        ecc_fast.decompress(ser)
+        for bad in [b'', b'\x05' + ser[1:], ser[:-1], b'\x02' + b'\xff' * 32,
+                    b'\x04' + ser[1:] + b'\x00' * 32]:
+            with self.assertRaises(ValueError):
+                ecc_fast.decompress(bad)
+
+    def test_matches_ser_to_point(self):
+        ser = point_to_ser(11 * SECP256k1.generator, True)
+        point = ser_to_point(ser)
+        self.assertEqual((point.x(), point.y()), ecc_fast.decompress(ser))
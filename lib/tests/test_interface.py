@@ -1,8 +1,35 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 from lib import interface
 
 
+class FakeSocket(object):
+
+    def __init__(self):
+        self.sent = []
+        self.incoming = []
+
+    def settimeout(self, t):
+        pass
+
+    def send(self, data):
+        self.sent.extend(json.loads(l) for l in data.decode('utf8').splitlines())
+        return len(data)
+
+    def recv(self, n):
+        if not self.incoming:
+            raise socket.timeout
+        return (json.dumps(self.incoming.pop(0)) + '\n').encode('utf8')
+
+
 class TestInterface(unittest.TestCase):
 
     def test_match_host_name(self):
@@ -24,3 +51,126 @@ class TestInterface(unittest.TestCase):
         self.assertTrue(i.check_host_name(
             peercert={'subject': [('commonName', 'foo.bar.com')]},
             name='foo.bar.com'))
+
+    def test_unusable_pinned_certificate(self):
+        for cert in ['', 'garbage', '-----BEGIN CERTIFICATE-----\nAAAA\n-----END CERTIFICATE-----\n']:
+            self.assertIsNone(interface.TLSCache.make_pinned_context(cert))
+        config_path = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(config_path, 'certs'))
+            with open(os.path.join(config_path, 'certs', 'example.invalid'), 'w') as f:
+                f.write('garbage')
+            c = interface.TcpConnection('example.invalid:50002:s', None, config_path)
+            with mock.patch.object(c, 'get_simple_socket') as get_simple_socket:
+                self.assertIsNone(c.get_socket())
+            self.assertFalse(get_simple_socket.called)
+            # the file is read again on the next attempt
+            self.assertNotIn('example.invalid', interface.tls_cache.pinned)
+        finally:
+            shutil.rmtree(config_path)
+
+    def _make_interface(self):
+        s = FakeSocket()
+        i = interface.Interface('localhost:1:t', s)
+        for n in range(3):
+            i.queue_request('server.version', [], n)
+        return i, s
+
+    def test_batch_requests(self):
+        i, s = self._make_interface()
+        self.assertTrue(i.send_requests())
+        self.assertEqual(1, len(s.sent))
+        self.assertEqual([0, 1, 2], [r['id'] for r in s.sent[0]])
+        s.incoming.append([{'id': 1, 'result': 'b'}, {'id': 0, 'result': 'a'}])
+        s.incoming.append({'id': 2, 'result': 'c'})
+        responses = i.get_responses()
+        self.assertEqual([1, 0, 2], [req[2] for req, resp in responses])
+        self.assertEqual('b', responses[0][1]['result'])
+        self.assertTrue(i.batch_supported)
+        self.assertEqual({}, i.unanswered_requests)
+
+    def test_batch_rejected(self):
+        i, s = self._make_interface()
+        i.send_requests()
+        # a notification with a null error is not a rejection
+        s.incoming.append({'id': None, 'error': None, 'method': 'm'})
+        self.assertEqual(1, len(i.get_responses()))
+        self.assertTrue(i.batch_requests)
+        s.incoming.append({'id': None, 'error': {'code': -32600, 'message': 'invalid request'}})
+        self.assertEqual([], i.get_responses())
+        self.assertFalse(i.batch_requests)
+        self.assertEqual([0, 1, 2], [r[2] for r in i.unsent_requests])
+        i.send_requests()
+        self.assertEqual([0, 1, 2], [r['id'] for r in s.sent[1:]])
+
+    def test_batch_unanswered(self):
+        i, s = self._make_interface()
+        i.send_requests()
+        self.assertTrue(i.batch_unanswered())
+        # the server closes the connection
+        s.incoming.append(None)
+        self.assertEqual([(None, None)], i.get_responses())
+        self.assertTrue(i.batch_unanswered())
+        i, s = self._make_interface()
+        i.send_requests()
+        s.incoming.append([{'id': 0, 'result': 'a'}])
+        i.get_responses()
+        self.assertFalse(i.batch_unanswered())
+
+    def test_request_window(self):
+        w = interface.RequestWindow()
+        self.assertEqual(interface.MIN_TIMEOUT, w.timeout())
+        for n in range(10):
+            w.on_response(0.1, False, w.limit())
+        self.assertEqual(interface.INITIAL_WINDOW + 10, w.limit())
+        # an idle window does not grow
+        w.on_response(0.1, False, 0)
+        self.assertEqual(interface.INITIAL_WINDOW + 10, w.limit())
+        # an answer later than the timeout halves it
+        w.on_response(60, False, 0)
+        self.assertEqual((interface.INITIAL_WINDOW + 10) // 2, w.limit())
+        self.assertGreater(w.timeout(), interface.MIN_TIMEOUT)
+        self.assertEqual(60, w.get_stats()['rtt_p99'])
+        self.assertEqual(0.1, w.get_stats()['rtt_p50'])
+
+    def test_window_limits_requests(self):
+        i, s = self._make_interface()
+        i.window.size = 2
+        i.send_requests()
+        self.assertEqual(2, len(i.unanswered_requests))
+        self.assertEqual(0, i.num_requests())
+        self.assertFalse(i.has_timed_out())
+        s.incoming.append([{'id': 0, 'result': 'a'}, {'id': 1, 'result': 'b'}])
+        i.get_responses()
+        self.assertEqual(1, i.num_requests())
+        self.assertEqual(0, i.get_stats()['in_flight'])
+        # a null error is a success
+        i.send_requests()
+        s.incoming.append({'id': 2, 'result': 'c', 'error': None})
+        i.get_responses()
+        self.assertEqual(0, i.window.error_rate())
+
+    def test_connection_pool(self):
+        pool = interface.ConnectionPool(2)
+        lock = threading.Lock()
+        lock.acquire()
+        done = []
+
+        class Job(object):
+            def __init__(self, n):
+                self.n = n
+            def run(self):
+                with lock:
+                    done.append(self.n)
+
+        for n in range(5):
+            pool.submit(Job(n))
+        self.assertEqual(2, pool.running)
+        self.assertEqual(3, len(pool.jobs))
+        lock.release()
+        for i in range(100):
+            if pool.running == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(0, pool.running)
+        self.assertEqual(list(range(5)), sorted(done))
@@ -0,0 +1,360 @@
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+from lib import interface
+from lib import network
+from lib import util
+from lib.network import ChunkPipeline, CHUNK_PIPELINE_DEPTH
+from lib.txcache import TxCache
+
+from .test_blockchain import FakeConfig
+
+
+class FakeChain(object):
+
+    def __init__(self, bad=()):
+        self.connected = []
+        self.bad = set(bad)
+        self.catch_up = None
+
+    def connect_chunk(self, index, data):
+        if data in self.bad:
+            return False
+        self.connected.append(index)
+        return True
+
+    def height(self):
+        return len(self.connected) * 2016 - 1
+
+
+class FakeInterface(object):
+
+    def __init__(self, server, chain, tip):
+        self.server = server
+        self.host = server
+        self.blockchain = chain
+        self.tip = tip
+        self.request = None
+        self.mode = 'catch_up'
+
+    def print_error(self, *msg):
+        pass
+
+
+class FakeNetwork(object):
+
+    def __init__(self, interfaces):
+        self.interfaces = {i.server: i for i in interfaces}
+        self.sent = []
+        self.down = []
+        self.chunk_pipeline = None
+        self.message_id = 0
+
+    def queue_request(self, method, params, interface):
+        self.message_id += 1
+        self.sent.append((params[0], interface.server, self.message_id))
+        return self.message_id
+
+    def connection_down(self, server):
+        self.down.append(server)
+        self.interfaces.pop(server, None)
+        pipeline = self.chunk_pipeline
+        if pipeline:
+            if pipeline.interface.server == server:
+                self.chunk_pipeline = None
+            else:
+                pipeline.on_interface_down(server)
+
+    def notify(self, event):
+        pass
+
+
+class TestChunkPipeline(unittest.TestCase):
+
+    def setUp(self):
+        super(TestChunkPipeline, self).setUp()
+        self.chain = FakeChain(bad={'bad'})
+        self.leader = FakeInterface('leader', self.chain, 2016 * 20)
+        self.peer = FakeInterface('peer', self.chain, 2016 * 20)
+        self.network = FakeNetwork([self.leader, self.peer])
+
+    def start(self, index=0):
+        pipeline = ChunkPipeline(self.network, self.leader, index)
+        self.network.chunk_pipeline = pipeline
+        pipeline.fill()
+        return pipeline
+
+    def request(self, index):
+        '''The last request sent for index, as (server, message id).'''
+        for i, server, message_id in reversed(self.network.sent):
+            if i == index:
+                return server, message_id
+
+    def answer(self, pipeline, index, data='ok'):
+        server, message_id = self.request(index)
+        interface = self.network.interfaces[server]
+        self.assertTrue(pipeline.expects(interface, index, message_id))
+        pipeline.on_chunk(interface, index, data)
+
+    def test_fill_and_refill(self):
+        pipeline = self.start()
+        self.assertEqual(list(range(CHUNK_PIPELINE_DEPTH)), [i for i, s, m in self.network.sent])
+        # spread over both interfaces
+        self.assertEqual({'leader', 'peer'}, {s for i, s, m in self.network.sent})
+        self.answer(pipeline, 0)
+        self.assertEqual([0], self.chain.connected)
+        self.assertEqual(CHUNK_PIPELINE_DEPTH, len(pipeline.in_flight))
+        self.assertEqual(CHUNK_PIPELINE_DEPTH, self.network.sent[-1][0])
+
+    def test_out_of_order(self):
+        pipeline = self.start()
+        self.answer(pipeline, 2)
+        self.answer(pipeline, 1)
+        self.assertEqual([], self.chain.connected)
+        self.assertEqual({1, 2}, set(pipeline.buffered))
+        self.answer(pipeline, 0)
+        self.assertEqual([0, 1, 2], self.chain.connected)
+        self.assertEqual({}, pipeline.buffered)
+
+    def test_last_chunk_from_leader(self):
+        pipeline = self.start(18)
+        self.assertEqual('leader', self.request(20)[0])
+        for index in (18, 19, 20):
+            self.answer(pipeline, index)
+        self.assertEqual([18, 19, 20], self.chain.connected)
+        self.assertIsNone(self.network.chunk_pipeline)
+        self.assertEqual('default', self.leader.mode)
+
+    def test_interface_down(self):
+        pipeline = self.start()
+        lost = [i for i, s, m in self.network.sent if s == 'peer']
+        self.answer(pipeline, lost[0])
+        self.network.connection_down('peer')
+        self.assertEqual({}, pipeline.buffered)
+        for index in lost:
+            self.assertEqual('leader', self.request(index)[0])
+            self.assertEqual('leader', pipeline.in_flight[index][0])
+
+    def test_bad_chunk(self):
+        pipeline = self.start()
+        self.assertEqual('peer', self.request(1)[0])
+        self.answer(pipeline, 1, 'bad')
+        self.answer(pipeline, 0)
+        self.assertEqual([0], self.chain.connected)
+        self.assertEqual(['peer'], self.network.down)
+        self.assertEqual('leader', self.request(1)[0])
+        self.assertIn(1, pipeline.in_flight)
+
+    def test_other_requests_not_claimed(self):
+        pipeline = self.start()
+        server, message_id = self.request(3)
+        interface = self.network.interfaces[server]
+        # another get_chunk for the same index on the same server
+        self.assertFalse(pipeline.expects(interface, 3, message_id + 1000))
+        other = self.leader if interface is self.peer else self.peer
+        self.assertFalse(pipeline.expects(other, 3, message_id))
+        pipeline.on_chunk(interface, 3, 'ok')
+        self.assertFalse(pipeline.expects(interface, 3, message_id))
+
+    def test_chain_and_errors(self):
+        main = FakeInterface('main', FakeChain(), 2016 * 20)
+        self.network.interfaces['main'] = main
+        pipeline = self.start()
+        self.assertNotIn('main', {s for i, s, m in self.network.sent})
+        index = [i for i, s, m in self.network.sent if s == 'peer'][0]
+        pipeline.on_error(self.peer, index)
+        self.assertEqual('leader', self.request(index)[0])
+        # the leader may fail a chunk once
+        pipeline.on_error(self.leader, index)
+        self.assertEqual([], self.network.down)
+        pipeline.on_error(self.leader, index)
+        self.assertEqual(['leader'], self.network.down)
+
+    def test_on_get_chunk(self):
+        pipeline = self.start()
+        n = network.Network.__new__(network.Network)
+        n.chunk_pipeline = pipeline
+        server, message_id = self.request(5)
+        interface = self.network.interfaces[server]
+        # a request outside the pipeline is ignored by it
+        n.on_get_chunk(interface, {'id': message_id + 1000, 'params': [5], 'result': 'ok'})
+        self.assertIn(5, pipeline.in_flight)
+        n.on_get_chunk(interface, {'id': message_id, 'params': [5], 'error': 'busy'})
+        self.assertNotEqual(message_id, self.request(5)[1])
+        server, message_id = self.request(5)
+        n.on_get_chunk(self.network.interfaces[server], {'id': message_id, 'params': [5], 'result': 'ok'})
+        self.assertIn(5, pipeline.buffered)
+
+
+def make_network():
+    '''A Network with only what the loop needs, and no connections.'''
+    n = network.Network.__new__(network.Network)
+    util.DaemonThread.__init__(n)
+    n.lock = threading.Lock()
+    n.pending_sends = []
+    n.interfaces = {}
+    n.blockchains = {}
+    n.wakeup_r, n.wakeup_w = socket.socketpair()
+    n.wakeup_r.setblocking(False)
+    n.wakeup_w.setblocking(False)
+    return n
+
+
+class TestWakeup(unittest.TestCase):
+
+    def test_send_wakes_loop(self):
+        n = make_network()
+        self.addCleanup(n.wakeup_r.close)
+        self.addCleanup(n.wakeup_w.close)
+        timer = threading.Timer(0.05, n.send, [[('server.version', [])], None])
+        start = time.time()
+        timer.start()
+        n.wait_on_sockets()
+        self.assertLess(time.time() - start, network.LOOP_TIMEOUT / 2)
+        timer.join()
+        self.assertEqual(1, len(n.pending_sends))
+        # the wakeup socket was drained
+        with self.assertRaises(BlockingIOError):
+            n.wakeup_r.recv(1)
+
+    def test_stop(self):
+        n = make_network()
+        for name in ['init_headers_file', 'maintain_sockets', 'maintain_requests',
+                     'process_pending_sends', 'stop_network', 'on_stop', 'scoreboard']:
+            setattr(n, name, mock.Mock())
+        n.start()
+        time.sleep(0.05)
+        start = time.time()
+        n.stop()
+        n.join(network.LOOP_TIMEOUT)
+        self.assertFalse(n.is_alive())
+        self.assertLess(time.time() - start, network.LOOP_TIMEOUT / 2)
+        self.assertTrue(n.stop_network.called)
+        self.assertEqual(-1, n.wakeup_r.fileno())
+        self.assertEqual(-1, n.wakeup_w.fileno())
+
+
+# signed_blob from test_transaction, and its hash
+RAW_TX = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+TXID = '8334c637900f1d2cd1d8abbd94a676e0ac92c2a20d19b3ca210a0f538ab157c8'
+
+
+class TestClientRequests(unittest.TestCase):
+
+    def setUp(self):
+        super(TestClientRequests, self).setUp()
+        n = network.Network.__new__(network.Network)
+        n.message_id = 0
+        n.debug = False
+        n.batch_requests = False
+        n.unanswered_requests = {}
+        n.request_servers = {}
+        n.subscriptions = {}
+        n.sub_cache = {}
+        n.subscribed_addresses = set()
+        n.disconnected_servers = set()
+        n.no_batch_servers = set()
+        n.blockchains = {}
+        n.chunk_pipeline = None
+        n.config = mock.Mock()
+        n.tx_cache = TxCache(FakeConfig(None))
+        n.scoreboard = mock.Mock()
+        n.notify = mock.Mock()
+        n.interfaces = {}
+        self.chain = object()
+        for server in ['main:1:t', 'a:1:t', 'b:1:t']:
+            i = interface.Interface(server, mock.Mock())
+            i.blockchain = self.chain
+            i.mode = 'default'
+            n.interfaces[server] = i
+        n.interface = n.interfaces['main:1:t']
+        n.default_server = 'main:1:t'
+        self.network = n
+        self.answers = []
+
+    def send(self, method, params):
+        self.network.queue_client_request(method, params, self.answers.append)
+
+    def pending(self, server):
+        '''Method, params and message id of the requests queued on server.'''
+        return self.network.interfaces[server].unsent_requests
+
+    def answer(self, server, response):
+        i = self.network.interfaces[server]
+        request = i.unsent_requests.pop(0)
+        response['id'] = request[2]
+        i.get_responses = lambda: [(request, response)]
+        self.network.process_responses(i)
+
+    def test_pick_interface(self):
+        n = self.network
+        self.assertIs(n.interface, n.pick_interface('blockchain.scripthash.get_history'))
+        picked = {n.pick_interface('blockchain.transaction.get').server for k in range(100)}
+        self.assertEqual(set(n.interfaces), picked)
+        # only interfaces on our chain that are not catching up
+        n.interfaces['a:1:t'].blockchain = object()
+        n.interfaces['b:1:t'].mode = 'catch_up'
+        self.assertIs(n.interface, n.pick_interface('blockchain.transaction.get'))
+
+    def test_requeue_on_close(self):
+        n = self.network
+        n.interfaces['b:1:t'].blockchain = object()
+        n.pick_interface = lambda method: n.interfaces['a:1:t']
+        self.send('blockchain.transaction.get', [TXID])
+        n.connection_down('a:1:t')
+        self.assertNotIn('a:1:t', n.interfaces)
+        self.assertEqual([('blockchain.transaction.get', [TXID])],
+                         [r[:2] for r in self.pending('main:1:t')])
+        self.assertEqual({'main:1:t'}, set(n.request_servers.values()))
+        self.answer('main:1:t', {'result': RAW_TX})
+        self.assertEqual(RAW_TX, self.answers[0]['result'])
+        self.assertEqual(RAW_TX, n.tx_cache.get(TXID))
+        self.assertEqual({}, n.unanswered_requests)
+
+    def test_retry_on_main(self):
+        n = self.network
+        n.pick_interface = lambda method: n.interfaces['a:1:t']
+        self.send('blockchain.transaction.get', [TXID])
+        # a null error is not an error
+        self.answer('a:1:t', {'result': RAW_TX, 'error': None})
+        self.assertEqual(RAW_TX, self.answers[0]['result'])
+        self.send('blockchain.transaction.get_merkle', [TXID, 1])
+        self.answer('a:1:t', {'error': 'not found'})
+        self.assertEqual(1, len(self.answers))
+        self.assertEqual('blockchain.transaction.get_merkle', self.pending('main:1:t')[0][0])
+        # the main server's answer is final
+        self.answer('main:1:t', {'error': 'not found'})
+        self.assertEqual('not found', self.answers[1]['error'])
+
+    def test_wrong_transaction(self):
+        n = self.network
+        n.pick_interface = lambda method: n.interfaces['a:1:t']
+        self.send('blockchain.transaction.get', [TXID])
+        self.answer('a:1:t', {'result': RAW_TX[:-2] + '01'})
+        self.assertEqual([], self.answers)
+        self.assertEqual('blockchain.transaction.get', self.pending('main:1:t')[0][0])
+        self.answer('main:1:t', {'result': RAW_TX[:-2] + '01'})
+        self.assertIn('error', self.answers[0])
+        self.assertNotIn('result', self.answers[0])
+        self.assertEqual({}, n.tx_cache.memory)
+
+    def test_switch_moves_requests(self):
+        n = self.network
+        n.pick_interface = lambda method: n.interfaces['a:1:t']
+        self.send('blockchain.transaction.get', [TXID])
+        n.pick_interface = lambda method: n.interface
+        self.send('blockchain.scripthash.get_history', ['00'])
+        self.send('blockchain.transaction.get', ['00' * 32])
+        n.connection_down('main:1:t')
+        self.assertIsNone(n.interface)
+        n.interface = n.interfaces['b:1:t']
+        n.send_subscriptions()
+        # the balanced request still pending on a stays there, the
+        # others go to the new main interface
+        self.assertEqual(['a:1:t', 'b:1:t', 'b:1:t'], sorted(n.request_servers.values()))
+        moved = [r[:2] for r in self.pending('b:1:t')]
+        self.assertIn(('blockchain.scripthash.get_history', ['00']), moved)
+        self.assertIn(('blockchain.transaction.get', ['00' * 32]), moved)
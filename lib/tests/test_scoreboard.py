@@ -0,0 +1,45 @@
+import shutil
+import tempfile
+import unittest
+
+from lib.scoreboard import ServerScoreboard
+
+from .test_blockchain import FakeConfig
+
+
+class TestScoreboard(unittest.TestCase):
+
+    def setUp(self):
+        super(TestScoreboard, self).setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.config = FakeConfig(self.data_dir)
+
+    def tearDown(self):
+        super(TestScoreboard, self).tearDown()
+        shutil.rmtree(self.data_dir)
+
+    def test_score(self):
+        sb = ServerScoreboard(self.config)
+        sb.on_connect('fast:1:s', 0.1)
+        sb.on_close('fast:1:s', {'rtt_p50': 0.05, 'rtt_p90': 0.1, 'error_rate': 0.})
+        sb.on_connect('slow:1:s', 3.)
+        sb.on_close('slow:1:s', {'rtt_p50': 2., 'rtt_p90': 5., 'error_rate': 0.})
+        sb.on_connect('lagging:1:s', 0.1)
+        sb.on_lag('lagging:1:s', 3)
+        sb.on_connect_failure('failing:1:s')
+        self.assertLess(sb.score('fast:1:s'), sb.score('unknown:1:s'))
+        self.assertLess(sb.score('unknown:1:s'), sb.score('slow:1:s'))
+        self.assertLess(sb.score('fast:1:s'), sb.score('lagging:1:s'))
+        self.assertLess(sb.score('unknown:1:s'), sb.score('failing:1:s'))
+        picks = [sb.choose(['fast:1:s', 'slow:1:s']) for i in range(200)]
+        self.assertGreater(picks.count('fast:1:s'), 150)
+        self.assertIsNone(sb.choose([]))
+
+    def test_persistence(self):
+        sb = ServerScoreboard(self.config)
+        sb.on_connect('a:1:s', 0.5)
+        sb.on_timeout('a:1:s')
+        sb.save()
+        sb = ServerScoreboard(self.config)
+        self.assertEqual(1, sb.scores['a:1:s']['timeouts'])
+        self.assertEqual(0.5, sb.scores['a:1:s']['connect_time'])
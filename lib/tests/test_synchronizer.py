@@ -0,0 +1,115 @@
+import unittest
+
+from lib.synchronizer import Synchronizer
+from lib.transaction import Transaction
+
+from .test_transaction import signed_blob
+
+
+class FakeWallet(object):
+
+    def __init__(self):
+        self.history = {}
+        self.transactions = {}
+        self.batches = []
+        self.up_to_date = False
+
+    def get_addresses(self):
+        return []
+
+    def get_address_history(self, addr):
+        return self.history.get(addr, [])
+
+    def synchronize(self):
+        pass
+
+    def receive_history_batch(self, items):
+        self.batches.append(('history', items))
+        for addr, hist, tx_fees in items:
+            self.history[addr] = hist
+
+    def receive_tx_batch(self, items):
+        self.batches.append(('tx', items))
+
+    def is_up_to_date(self):
+        return self.up_to_date
+
+    def set_up_to_date(self, b):
+        self.up_to_date = b
+
+
+class FakeTxCache(object):
+
+    def get(self, txid):
+        return None
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.sent = []
+        self.tx_cache = FakeTxCache()
+
+    def subscribe_to_addresses(self, addresses, callback):
+        pass
+
+    def request_address_histories(self, addresses, callback):
+        self.sent.append(('get_history', addresses))
+
+    def send(self, messages, callback):
+        self.sent.append(('send', messages))
+
+    def trigger_callback(self, *args):
+        pass
+
+
+class TestSynchronizer(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSynchronizer, self).setUp()
+        self.sync = Synchronizer(FakeWallet(), FakeNetwork())
+
+    def test_address_status(self):
+        s = self.sync
+        h1 = [('%064x' % i, 100 + i) for i in range(5)] + [('%064x' % 5, 0)]
+        self.assertEqual(s.get_status(h1), s.get_address_status('a', h1))
+        self.assertIs(h1, s.status_cache['a'].hist)
+        self.assertEqual(5, s.status_cache['a'].n)
+        # mempool tx confirmed, new one received: the prefix is reused
+        h2 = h1[:5] + [('%064x' % 5, 110), ('%064x' % 6, -1)]
+        sha = s.status_cache['a'].sha
+        self.assertEqual(s.get_status(h2), s.get_address_status('a', h2))
+        self.assertEqual(6, s.status_cache['a'].n)
+        self.assertIsNot(sha, s.status_cache['a'].sha)
+        # reorg of a confirmed tx
+        h3 = [list(x) for x in h2[:3]] + [['%064x' % 3, 120]]
+        self.assertEqual(s.get_status(h3), s.get_address_status('a', h3))
+        self.assertEqual(s.get_status(h3), s.get_address_status('a', h3))
+        self.assertIsNone(s.get_address_status('a', []))
+        self.assertNotIn('a', s.status_cache)
+
+    def test_bulk_sync(self):
+        s = self.sync
+        wallet, network = s.wallet, s.network
+        txid = Transaction(signed_blob).txid()
+        hist = [(txid, 100)]
+        for addr in ['a', 'b']:
+            s.on_address_status({'params': [addr], 'result': s.get_status(hist)})
+        self.assertEqual([], network.sent)
+        s.run()
+        self.assertEqual([('get_history', ['a', 'b'])], network.sent)
+        for addr in ['a', 'b']:
+            s.on_address_history({'params': [addr], 'result': [{'tx_hash': txid, 'height': 100}]})
+        s.run()
+        # one request for the shared transaction, one batch for both histories
+        self.assertEqual(('send', [('blockchain.transaction.get', [txid])]), network.sent[1])
+        self.assertEqual([('history', [('a', hist, {}), ('b', hist, {})])], wallet.batches)
+        self.assertTrue(s.bulk)
+        s.tx_response({'params': [txid], 'result': signed_blob})
+        s.run()
+        self.assertEqual('tx', wallet.batches[1][0])
+        self.assertFalse(s.bulk)
+        self.assertTrue(wallet.up_to_date)
+        progress = s.get_progress()
+        self.assertEqual(2, progress['histories'])
+        self.assertEqual(1, progress['txs'])
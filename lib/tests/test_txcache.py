@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib import transaction
+from lib.txcache import TxCache
+
+from .test_blockchain import FakeConfig
+from .test_transaction import signed_blob, signed_segwit_blob
+
+
+class PersistConfig(FakeConfig):
+
+    def get(self, key, default=None):
+        return True if key == 'txcache_persist' else default
+
+
+class TestTxCache(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTxCache, self).setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.config = PersistConfig(self.data_dir)
+        self.txid = transaction.Transaction(signed_blob).txid()
+        self.segwit_txid = transaction.Transaction(signed_segwit_blob).txid()
+
+    def tearDown(self):
+        super(TestTxCache, self).tearDown()
+        shutil.rmtree(self.data_dir)
+
+    def test_put_get(self):
+        cache = TxCache(self.config)
+        self.assertIsNone(cache.get(self.txid))
+        cache.put(self.txid, signed_blob)
+        cache.put(self.segwit_txid, signed_segwit_blob)
+        self.assertEqual(signed_blob, cache.get(self.txid))
+        # shared through the filesystem
+        cache = TxCache(self.config)
+        self.assertEqual(signed_segwit_blob, cache.get(self.segwit_txid))
+
+    def test_memory_only(self):
+        cache = TxCache(FakeConfig(self.data_dir))
+        cache.put(self.txid, signed_blob)
+        self.assertEqual(signed_blob, cache.get(self.txid))
+        self.assertEqual([], os.listdir(self.data_dir))
+        cache.max_size = len(signed_blob) // 2 + 1
+        cache.put(self.segwit_txid, signed_segwit_blob)
+        self.assertIsNone(cache.get(self.txid))
+        self.assertEqual([self.segwit_txid], list(cache.memory))
+
+    def test_rejects_wrong_txid(self):
+        cache = TxCache(self.config)
+        cache.put(self.segwit_txid, signed_blob)
+        self.assertIsNone(cache.get(self.segwit_txid))
+        self.assertEqual(0, cache.size)
+
+    def test_corrupt_file(self):
+        cache = TxCache(self.config)
+        cache.put(self.txid, signed_blob)
+        with open(cache.file_path(self.txid), 'r+b') as f:
+            f.write(b'\x02')
+        self.assertIsNone(cache.get(self.txid))
+        self.assertFalse(os.path.exists(cache.file_path(self.txid)))
+
+    def test_eviction(self):
+        cache = TxCache(self.config)
+        cache.max_size = len(signed_blob) // 2 + 1
+        cache.put(self.txid, signed_blob)
+        cache.put(self.segwit_txid, signed_segwit_blob)
+        self.assertIsNone(cache.get(self.txid))
+        self.assertEqual(signed_segwit_blob, cache.get(self.segwit_txid))
+        self.assertEqual(len(signed_segwit_blob) // 2, cache.size)
@@ -1,5 +1,23 @@
 import unittest
-from lib.util import format_satoshis, parse_URI
+import socket
+
+from lib.util import format_satoshis, parse_URI, LRUCache, SocketPipe, timeout
+
+
+class FakeSocket(object):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def settimeout(self, t):
+        pass
+
+    def recv(self, n):
+        if not self.chunks:
+            raise socket.timeout
+        return self.chunks.pop(0)
+
+
 
 class TestUtil(unittest.TestCase):
 
@@ -68,3 +86,32 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoin:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
 
+
+    def test_lru_cache(self):
+        c = LRUCache(2)
+        c.put('a', 1)
+        c.put('b', 2)
+        self.assertEqual(1, c.get('a'))
+        c.put('c', 3)
+        self.assertNotIn('b', c)
+        self.assertEqual(1, c.get('a'))
+        self.assertEqual(3, c.get('c'))
+        c.discard_if(lambda k: k > 'b')
+        self.assertEqual(['a'], list(c.d.keys()))
+
+    def test_socket_pipe_framing(self):
+        big = '{"id": 1, "result": "%s"}' % ('ab' * 100000)
+        data = (big + '\n{"id": 2}\n\nnot json\n{"id": 3').encode('utf8')
+        chunks = [data[i:i+1000] for i in range(0, len(data), 1000)]
+        pipe = SocketPipe(FakeSocket(chunks + [b'}\n', b'']))
+        self.assertEqual(1, pipe.get()['id'])
+        self.assertEqual({'id': 2}, pipe.get())
+        self.assertEqual({'id': 3}, pipe.get())
+        self.assertEqual(0, len(pipe.buffer))
+        self.assertIsNone(pipe.get())
+
+    def test_socket_pipe_timeout(self):
+        pipe = SocketPipe(FakeSocket([b'{"id": 1}\n{"id"']))
+        self.assertEqual({'id': 1}, pipe.get())
+        self.assertRaises(timeout, pipe.get)
+        self.assertEqual(b'{"id"', bytes(pipe.buffer))
@@ -0,0 +1,158 @@
+import os
+import unittest
+
+from lib.bitcoin import Hash, hash_encode
+from lib.verifier import BlockProofs, SPV
+
+
+def merkle_tree(leaves):
+    '''Levels of the merkle tree of leaves, as raw bytes.'''
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2:
+            level = level + [level[-1]]
+        levels.append([Hash(level[i] + level[i + 1]) for i in range(0, len(level), 2)])
+    return levels
+
+
+def merkle_branch(levels, pos):
+    branch = []
+    for level in levels[:-1]:
+        sibling = pos ^ 1
+        branch.append(hash_encode(level[sibling] if sibling < len(level) else level[pos]))
+        pos >>= 1
+    return branch
+
+
+class FakeChain(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.reads = 0
+
+    def read_header(self, height):
+        self.reads += 1
+        return self.headers.get(height)
+
+
+class FakeNetwork(object):
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.sent = []
+        self.interface = None
+        self.height = 100
+        self.callbacks = []
+
+    def blockchain(self):
+        return self.chain
+
+    def get_local_height(self):
+        return self.height
+
+    def register_callback(self, callback, events):
+        self.callbacks.append(callback)
+
+    def unregister_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def trigger_callback(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+    def send(self, messages, callback):
+        self.sent.append((messages, callback))
+
+
+class FakeWallet(object):
+
+    def __init__(self, unverified):
+        self.unverified = unverified
+        self.verified = {}
+        self.verifier = None
+
+    def add_unverified_tx(self, tx_hash, tx_height):
+        self.unverified[tx_hash] = tx_height
+        self.verifier.add(tx_hash, tx_height)
+
+    def get_unverified_txs(self):
+        return self.unverified
+
+    def add_verified_tx(self, tx_hash, info, block_hash):
+        self.unverified.pop(tx_hash)
+        self.verified[tx_hash] = info
+
+
+class TestVerifier(unittest.TestCase):
+
+    def setUp(self):
+        super(TestVerifier, self).setUp()
+        self.leaves = [os.urandom(32) for i in range(11)]
+        self.levels = merkle_tree(self.leaves)
+        self.header = {'version': 1, 'prev_block_hash': '00' * 32, 'merkle_root': hash_encode(self.levels[-1][0]),
+                       'timestamp': 1234, 'bits': 0x1d00ffff, 'nonce': 0}
+
+    def test_block_proofs(self):
+        block = BlockProofs(self.header)
+        for pos in [3, 2, 10, 0, 7]:
+            branch = merkle_branch(self.levels, pos)
+            self.assertTrue(block.verify(hash_encode(self.leaves[pos]), branch, pos))
+        # leaf 1 is known from the branch of leaf 0
+        self.assertTrue(block.verify(hash_encode(self.leaves[1]), ['00' * 32] * 4, 1))
+        # wrong position, wrong hash, wrong branch
+        branch = merkle_branch(self.levels, 5)
+        self.assertFalse(block.verify(hash_encode(self.leaves[5]), branch, 4))
+        self.assertFalse(block.verify(hash_encode(os.urandom(32)), branch, 5))
+        self.assertFalse(BlockProofs(self.header).verify(hash_encode(self.leaves[5]), branch[:-1], 5))
+        self.assertTrue(BlockProofs(self.header).verify(hash_encode(self.leaves[5]), branch, 5))
+
+    def test_spv_groups_by_height(self):
+        chain = FakeChain({50: self.header})
+        network = FakeNetwork(chain)
+        txids = [hash_encode(leaf) for leaf in self.leaves]
+        wallet = FakeWallet({txid: 50 for txid in txids})
+        spv = SPV(network, wallet)
+        spv.run()
+        self.assertEqual(1, chain.reads)
+        self.assertEqual(1, len(network.sent))
+        messages, callback = network.sent[0]
+        self.assertEqual(len(txids), len(messages))
+        spv.run()
+        self.assertEqual(1, len(network.sent))
+        for method, params in messages:
+            pos = txids.index(params[0])
+            callback({'params': params, 'result': {
+                'block_height': 50, 'pos': pos, 'merkle': merkle_branch(self.levels, pos)}})
+        self.assertEqual(1, chain.reads)
+        self.assertEqual({}, wallet.unverified)
+        self.assertEqual((50, 1234, 4), wallet.verified[txids[4]])
+        self.assertEqual({}, spv.blocks)
+
+    def test_spv_wakeup(self):
+        chain = FakeChain({50: self.header, 120: self.header})
+        network = FakeNetwork(chain)
+        txids = [hash_encode(leaf) for leaf in self.leaves]
+        wallet = FakeWallet({txids[0]: 120, txids[1]: 0})
+        spv = wallet.verifier = SPV(network, wallet)
+        self.assertEqual({120}, set(spv.queue))
+        # above the local height: nothing until headers arrive
+        spv.run()
+        self.assertEqual([], network.sent)
+        self.assertEqual(0, chain.reads)
+        network.height = 150
+        spv.run()
+        self.assertEqual(0, chain.reads)
+        network.trigger_callback('updated')
+        spv.run()
+        self.assertEqual(1, chain.reads)
+        self.assertEqual([('blockchain.transaction.get_merkle', [txids[0], 120])], network.sent[0][0])
+        self.assertEqual({}, spv.queue)
+        # new transactions wake it up; moved ones are skipped
+        wallet.add_unverified_tx(txids[2], 50)
+        wallet.add_unverified_tx(txids[3], 50)
+        wallet.unverified[txids[3]] = 0
+        spv.run()
+        self.assertEqual([('blockchain.transaction.get_merkle', [txids[2], 50])], network.sent[1][0])
+        spv.release()
+        self.assertEqual([], network.callbacks)
@@ -221,3 +221,149 @@ class TestWalletKeystoreAddressIntegrity(unittest.TestCase):
 
         self.assertEqual(w.get_receiving_addresses()[0], '35LeC45QgCVeRor1tJD6LiDgPbybBXisns')
         self.assertEqual(w.get_change_addresses()[0], '39RhtDchc6igmx5tyoimhojFL1ZbQBrXa6')
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_batch_address_derivation(self, mock_write):
+        ks = keystore.from_xpub('xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U')
+        w = self._create_standard_wallet(ks)
+        addresses = w.create_new_addresses(False, 4)
+        self.assertEqual(w.get_receiving_addresses()[1:], addresses)
+        for i, addr in enumerate(w.get_receiving_addresses()):
+            self.assertEqual(w.pubkeys_to_address(w.derive_pubkeys(False, i)), addr)
+        # on a process pool
+        try:
+            with mock.patch.object(keystore, 'MIN_POOL_BATCH', 2):
+                self.assertEqual([ks.derive_pubkey(True, i) for i in range(5)],
+                                 ks.derive_pubkeys(True, range(5), processes=2))
+        finally:
+            keystore.close_derivation_pool()
+        self.assertIsNone(keystore.derivation_pool)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_undo_verifications(self, mock_write):
+        ks = keystore.from_xpub('xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U')
+        w = self._create_standard_wallet(ks)
+        w.network = mock.Mock()
+        w.network.get_local_height.return_value = 200
+        w.add_verified_tx('aa' * 32, (100, 1000, 1), '01' * 32)
+        w.add_verified_tx('bb' * 32, (100, 1000, 2), '01' * 32)
+        w.add_verified_tx('cc' * 32, (101, 1010, 1), '02' * 32)
+        w.add_verified_tx('dd' * 32, (102, 1020, 1), '03' * 32)
+        # verified by an older version: no block hash
+        w.verified_tx['ee' * 32] = (103, 1030, 1)
+        w.verified_heights[103].add('ee' * 32)
+        chain = mock.Mock(checkpoints=[])
+        chain.get_hash.side_effect = {100: '01' * 32, 101: '02' * 32, 102: '04' * 32}.get
+        chain.read_header.return_value = {'timestamp': 1031}
+        self.assertEqual({'dd' * 32, 'ee' * 32}, w.undo_verifications(chain, 101))
+        self.assertEqual([101, 102], sorted(c[0][0] for c in chain.get_hash.call_args_list))
+        chain.read_header.assert_called_once_with(103)
+        self.assertEqual({100, 101}, set(w.verified_heights))
+        self.assertEqual({100: '01' * 32, 101: '02' * 32}, w.verified_blocks)
+        w.save_verified_tx()
+        self.assertEqual({'100': '01' * 32, '101': '02' * 32}, w.storage.get('verified_blocks'))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_address_index(self, mock_write):
+        ks = keystore.from_xpub('xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U')
+        w = self._create_standard_wallet(ks)
+        w.create_new_addresses(False, 3)
+        w.create_new_address(True)
+        for for_change, addresses in [(False, w.get_receiving_addresses()), (True, w.get_change_addresses())]:
+            for i, addr in enumerate(addresses):
+                self.assertTrue(w.is_mine(addr))
+                self.assertEqual(for_change, w.is_change(addr))
+                self.assertEqual((for_change, i), w.get_address_index(addr))
+        self.assertFalse(w.is_mine('1BoatSLRHtKNngkdXEeobR76b53LETtpyT'))
+        self.assertFalse(w.is_change('1BoatSLRHtKNngkdXEeobR76b53LETtpyT'))
+        with self.assertRaises(Exception):
+            w.get_address_index('1BoatSLRHtKNngkdXEeobR76b53LETtpyT')
+        # shrinking the gap limit drops trailing addresses
+        last = w.get_receiving_addresses()[-1]
+        w.gap_limit = 4
+        self.assertTrue(w.change_gap_limit(1))
+        self.assertEqual(1, len(w.get_receiving_addresses()))
+        self.assertFalse(w.is_mine(last))
+        self.assertEqual(len(w.get_addresses()), len(w.address_index))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_utxo_index(self, mock_write):
+        class FakeTx(object):
+            def __init__(self, inputs, outputs):
+                self._inputs = inputs
+                self._outputs = outputs
+            def inputs(self):
+                return self._inputs
+            def outputs(self):
+                return self._outputs
+
+        ks = keystore.from_xpub('xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U')
+        w = self._create_standard_wallet(ks)
+        r0, r1 = w.get_receiving_addresses()[0], w.create_new_address(False)
+        c0 = w.get_change_addresses()[0]
+        other = '1BoatSLRHtKNngkdXEeobR76b53LETtpyT'
+        tx1, tx2 = 'a1' * 32, 'b2' * 32
+        w.receive_tx_callback(tx1, FakeTx(
+            [{'type': 'p2pkh', 'address': other, 'prevout_hash': 'ff' * 32, 'prevout_n': 0}],
+            [(bitcoin.TYPE_ADDRESS, r0, 100000), (bitcoin.TYPE_ADDRESS, r1, 50000)]), 10)
+        w.receive_history_callback(r0, [[tx1, 10]], {})
+        w.receive_history_callback(r1, [[tx1, 10]], {})
+
+        def check():
+            for addr in [r0, r1, c0]:
+                expected = wallet.AddressCoins(addr, *w._get_addr_io(addr))
+                self.assertEqual(expected.utxos, w.get_addr_utxo(addr))
+                self.assertEqual(expected.get_balance(100), w.get_addr_balance(addr))
+            # the wallet-wide aggregates match a scan of every address
+            addresses = w.get_addresses()
+            self.assertEqual(w.get_balance(addresses), w.get_balance())
+            key = lambda x: (x['prevout_hash'], x['prevout_n'])
+            self.assertEqual(sorted(w.get_utxos(addresses), key=key), sorted(w.get_utxos(), key=key))
+
+        self.assertEqual((100000, 0, 0), w.get_addr_balance(r0))
+        self.assertEqual(150000, w.get_balance()[0])
+        self.assertEqual(2, len(w.get_utxos()))
+        check()
+        # spend the first output, with change
+        w.receive_tx_callback(tx2, FakeTx(
+            [{'type': 'p2pkh', 'address': r0, 'prevout_hash': tx1, 'prevout_n': 0}],
+            [(bitcoin.TYPE_ADDRESS, other, 60000), (bitcoin.TYPE_ADDRESS, c0, 30000)]), 0)
+        w.receive_history_callback(r0, [[tx1, 10], [tx2, 0]], {})
+        w.receive_history_callback(c0, [[tx2, 0]], {})
+        self.assertEqual((100000, -100000, 0), w.get_addr_balance(r0))
+        self.assertEqual((0, 30000, 0), w.get_addr_balance(c0))
+        self.assertIsNone(w.get_utxo(tx1 + ':0'))
+        self.assertEqual(30000, w.get_utxo(tx2 + ':1')['value'])
+        self.assertEqual(1, len(w.get_utxos(confirmed_only=True)))
+        check()
+        # confirmed
+        w.receive_history_callback(r0, [[tx1, 10], [tx2, 12]], {})
+        w.receive_history_callback(c0, [[tx2, 12]], {})
+        self.assertEqual((0, 0, 0), w.get_addr_balance(r0))
+        self.assertEqual((30000, 0, 0), w.get_addr_balance(c0))
+        self.assertEqual(2, len(w.get_utxos(confirmed_only=True)))
+        check()
+        # dropped from the history
+        w.receive_history_callback(r0, [[tx1, 10]], {})
+        w.receive_history_callback(c0, [], {})
+        self.assertEqual((100000, 0, 0), w.get_addr_balance(r0))
+        self.assertEqual((0, 0, 0), w.get_addr_balance(c0))
+        self.assertEqual(100000, w.get_utxo(tx1 + ':0')['value'])
+        self.assertIsNone(w.get_utxo(tx2 + ':1'))
+        check()
+        # returned coins are copies
+        w.get_utxos()[0]['value'] = 0
+        self.assertEqual(150000, sum(x['value'] for x in w.get_utxos()))
+        # coinbase maturity depends on the height at query time
+        tx3 = 'c3' * 32
+        w.receive_tx_callback(tx3, FakeTx(
+            [{'type': 'coinbase', 'address': None, 'prevout_hash': '00' * 32, 'prevout_n': 0}],
+            [(bitcoin.TYPE_ADDRESS, c0, 20000)]), 20)
+        w.receive_history_callback(c0, [[tx3, 20]], {})
+        with mock.patch.object(w, 'get_local_height', return_value=50):
+            self.assertEqual((150000, 0, 20000), w.get_balance())
+            self.assertEqual(2, len(w.get_utxos(mature=True)))
+            check()
+        with mock.patch.object(w, 'get_local_height', return_value=20 + bitcoin.COINBASE_MATURITY):
+            self.assertEqual((170000, 0, 0), w.get_balance())
+            self.assertEqual(3, len(w.get_utxos(mature=True)))
@@ -30,6 +30,7 @@
 from .util import print_error, profiler
 
 from . import bitcoin
+from . import ecc_backend
 from .bitcoin import *
 import struct
 
@@ -562,16 +563,17 @@ class Transaction:
                 if sig in sigs1:
                     continue
                 pre_hash = Hash(bfh(self.serialize_preimage(i)))
-                # der to string
                 order = ecdsa.ecdsa.generator_secp256k1.order()
                 r, s = ecdsa.util.sigdecode_der(bfh(sig[:-2]), order)
-                sig_string = ecdsa.util.sigencode_string(r, s, order)
                 compressed = True
                 for recid in range(4):
-                    public_key = MyVerifyingKey.from_signature(sig_string, recid, pre_hash, curve = SECP256k1)
-                    pubkey = bh2u(point_to_ser(public_key.pubkey.point, compressed))
+                    pubkey = ecc_backend.backend.recover(r, s, recid, pre_hash, compressed)
+                    if pubkey is None:
+                        continue
+                    pubkey = bh2u(pubkey)
                     if pubkey in pubkeys:
-                        public_key.verify_digest(sig_string, pre_hash, sigdecode = ecdsa.util.sigdecode_string)
+                        if not ecc_backend.backend.verify(bfh(pubkey), r, s, pre_hash):
+                            raise Exception("Bad signature")
                         j = pubkeys.index(pubkey)
                         print_error("adding sig", i, j, pubkey, sig)
                         self._inputs[i]['signatures'][j] = sig
@@ -942,12 +944,9 @@ class Transaction:
                     pubkey = public_key_from_private_key(sec, compressed)
                     # add signature
                     pre_hash = Hash(bfh(self.serialize_preimage(i)))
-                    pkey = regenerate_key(sec)
-                    secexp = pkey.secret
-                    private_key = bitcoin.MySigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-                    public_key = private_key.get_verifying_key()
-                    sig = private_key.sign_digest_deterministic(pre_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der)
-                    assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
+                    r, s = ecc_backend.backend.sign(sec, pre_hash)
+                    assert ecc_backend.backend.verify(bfh(pubkey), r, s, pre_hash)
+                    sig = ecdsa.util.sigencode_der(r, s, ecdsa.ecdsa.generator_secp256k1.order())
                     txin['signatures'][j] = bh2u(sig) + '01'
                     #txin['x_pubkeys'][j] = pubkey
                     txin['pubkeys'][j] = pubkey # needed for fd keys
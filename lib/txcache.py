@@ -0,0 +1,161 @@
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2017 The Electrum developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from .transaction import Transaction
+from .util import PrintError, bh2u, bfh
+
+
+# default size limit of the cache, in bytes
+TX_CACHE_SIZE = 64 * 1024 * 1024
+
+is_txid = re.compile('^[0-9a-f]{64}$').match
+
+
+class TxCache(PrintError):
+    """Raw transactions by txid, shared by all the wallets of a daemon.
+
+    Transactions are kept in memory.  If 'txcache_persist' is set, each
+    of them is also a binary file under config.path/txcache, named after
+    its txid; this is off by default because those files are not
+    encrypted, even if the wallets are.  The txid is recomputed whenever
+    a transaction is stored or read back, so a corrupt file is dropped
+    instead of being returned.  When the total size exceeds
+    'txcache_size' bytes, the least recently used transactions are
+    removed.
+    """
+
+    def __init__(self, config):
+        if config.get('txcache_persist', False):
+            self.path = os.path.join(config.path, 'txcache')
+        else:
+            self.path = None
+        self.max_size = config.get('txcache_size', TX_CACHE_SIZE)
+        self.lock = threading.Lock()
+        # txid -> size in bytes, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # txid -> serialized transaction, if not persisted
+        self.memory = {}
+        if self.path:
+            if not os.path.exists(self.path):
+                os.mkdir(self.path)
+            self.load()
+
+    def diagnostic_name(self):
+        return 'txcache'
+
+    def file_path(self, txid):
+        return os.path.join(self.path, txid[0:2], txid)
+
+    def load(self):
+        files = []
+        for d in os.listdir(self.path):
+            dir_path = os.path.join(self.path, d)
+            if not os.path.isdir(dir_path):
+                continue
+            for txid in os.listdir(dir_path):
+                if not is_txid(txid):
+                    continue
+                st = os.stat(os.path.join(dir_path, txid))
+                files.append((st.st_mtime, txid, st.st_size))
+        for mtime, txid, size in sorted(files):
+            self.entries[txid] = size
+            self.size += size
+        self.print_error("%d transactions, %d bytes" % (len(self.entries), self.size))
+
+    @staticmethod
+    def check(txid, raw):
+        try:
+            return Transaction(raw).txid() == txid
+        except BaseException:
+            return False
+
+    def read(self, txid):
+        if self.path is None:
+            return self.memory[txid]
+        path = self.file_path(txid)
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path, None)
+        return data
+
+    def write(self, txid, data):
+        if self.path is None:
+            self.memory[txid] = data
+            return
+        path = self.file_path(txid)
+        tmp = path + '.tmp'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, txid):
+        '''Returns the raw transaction as a hex string, or None.'''
+        with self.lock:
+            if txid not in self.entries:
+                return None
+            try:
+                raw = bh2u(self.read(txid))
+            except OSError:
+                self.remove(txid)
+                return None
+            if not self.check(txid, raw):
+                self.print_error("corrupt entry", txid)
+                self.remove(txid)
+                return None
+            self.entries.move_to_end(txid)
+            return raw
+
+    def put(self, txid, raw):
+        if not is_txid(txid) or not self.check(txid, raw):
+            self.print_error("not caching", txid)
+            return
+        data = bfh(raw)
+        with self.lock:
+            if txid in self.entries:
+                self.entries.move_to_end(txid)
+                return
+            try:
+                self.write(txid, data)
+            except OSError as e:
+                self.print_error("cannot write", txid, e)
+                return
+            self.entries[txid] = len(data)
+            self.size += len(data)
+            while self.size > self.max_size and len(self.entries) > 1:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, txid):
+        self.size -= self.entries.pop(txid, 0)
+        if self.path is None:
+            self.memory.pop(txid, None)
+            return
+        try:
+            os.remove(self.file_path(txid))
+        except OSError:
+            pass
@@ -22,7 +22,7 @@
 # SOFTWARE.
 import binascii
 import os, sys, re, json
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 from datetime import datetime
 from decimal import Decimal
 import traceback
@@ -109,6 +109,52 @@ class DebugMem(ThreadJob):
             self.mem_stats()
             self.next_time = time.time() + self.interval
 
+class LRUCache(object):
+    '''A bounded mapping that evicts the least recently used entries
+    once it holds more than maxsize items.  Thread safe.'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.d = OrderedDict()
+
+    def __len__(self):
+        return len(self.d)
+
+    def __contains__(self, key):
+        return key in self.d
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.d[key]
+            except KeyError:
+                return default
+            self.d.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.d[key] = value
+            self.d.move_to_end(key)
+            while len(self.d) > self.maxsize:
+                self.d.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.d.pop(key, default)
+
+    def discard_if(self, predicate):
+        '''Remove the entries whose key satisfies predicate'''
+        with self.lock:
+            for key in [k for k in self.d if predicate(k)]:
+                self.d.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+
+
 class DaemonThread(threading.Thread, PrintError):
     """ daemon thread that terminates cleanly """
 
@@ -588,10 +634,18 @@ import ssl
 import time
 
 
+RECV_SIZE = 65536
+
+
 class SocketPipe:
     def __init__(self, socket):
         self.socket = socket
-        self.message = b''
+        # bytes received but not yet framed; self.scanned marks how far
+        # it is known to contain no newline, so a partial line is never
+        # searched twice.
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.responses = deque()
         self.set_timeout(0.1)
         self.recv_time = time.time()
 
@@ -603,15 +657,17 @@ class SocketPipe:
 
     def get(self):
         while True:
-            response, self.message = parse_json(self.message)
-            if response is not None:
-                return response
+            if self.responses:
+                return self.responses.popleft()
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(RECV_SIZE)
             except socket.timeout:
                 raise timeout
             except ssl.SSLError:
                 raise timeout
+            except BlockingIOError:
+                # non-blocking socket with nothing left to read
+                raise timeout
             except socket.error as err:
                 if err.errno == 60:
                     raise timeout
@@ -628,8 +684,27 @@ class SocketPipe:
 
             if not data:  # Connection closed remotely
                 return None
-            self.message += data
+            self.buffer += data
             self.recv_time = time.time()
+            self.parse_buffer()
+
+    def parse_buffer(self):
+        n = self.buffer.rfind(b'\n', self.scanned)
+        if n == -1:
+            self.scanned = len(self.buffer)
+            return
+        lines = bytes(self.buffer[:n]).split(b'\n')
+        del self.buffer[:n+1]
+        self.scanned = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                j = json.loads(line.decode('utf8'))
+            except:
+                print_error("pipe: cannot parse", line[:100])
+                continue
+            self.responses.append(j)
 
     def send(self, request):
         out = json.dumps(request) + '\n'
@@ -20,12 +20,64 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import threading
+from collections import defaultdict
+
 from .util import ThreadJob
 from .bitcoin import *
+from .blockchain import hash_header
+
+
+def merkle_node(item):
+    '''Raw bytes of a hex hash as sent by the server.'''
+    return bytes.fromhex(item)[::-1]
+
+
+class BlockProofs(object):
+    """The header of a block, and the nodes of its merkle tree that are
+    known to lead to the merkle root.
+
+    Nodes are keyed by (level, index), level 0 being the transactions.
+    Once a branch is verified, its nodes and their siblings are kept,
+    so the branch of another transaction of the same block is only
+    hashed up to the first node they share.
+    """
+
+    def __init__(self, header):
+        self.header = header
+        self.nodes = {(-1, 0): merkle_node(header['merkle_root'])}
+        # merkle branches requested and not answered yet
+        self.pending = 0
+
+    def verify(self, tx_hash, branch, pos):
+        h = merkle_node(tx_hash)
+        path = []
+        for i, item in enumerate(branch):
+            index = pos >> i
+            known = self.nodes.get((i, index))
+            if known is not None:
+                if known != h:
+                    return False
+                break
+            sibling = merkle_node(item)
+            path.append(((i, index), h))
+            path.append(((i, index ^ 1), sibling))
+            h = Hash(sibling + h) if index & 1 else Hash(h + sibling)
+        else:
+            if h != self.nodes[(-1, 0)]:
+                return False
+        self.nodes.update(path)
+        return True
 
 
 class SPV(ThreadJob):
-    """ Simple Payment Verification """
+    """ Simple Payment Verification
+
+    Unverified transactions wait in a queue indexed by height.  run()
+    is called on every iteration of the network loop, but it only
+    looks at the queue after something that can make progress: a new
+    unverified transaction, new headers, or a change of chain.
+    """
 
     def __init__(self, network, wallet):
         self.wallet = wallet
@@ -35,68 +87,129 @@ class SPV(ThreadJob):
         # requested, and the merkle root once it has been verified
         self.merkle_roots = {}
         self.requested_chunks = {}
+        # height -> BlockProofs, for blocks with merkle branches in flight
+        self.blocks = {}
+        self.lock = threading.Lock()
+        # height -> tx hashes whose merkle branch is not requested yet
+        self.queue = defaultdict(set)
+        self.wakeup = True
+        for tx_hash, tx_height in list(wallet.get_unverified_txs().items()):
+            self.add(tx_hash, tx_height)
+        network.register_callback(self.on_updated, ['updated'])
+
+    def release(self):
+        self.network.unregister_callback(self.on_updated)
+
+    def add(self, tx_hash, tx_height):
+        '''Called by the wallet for each new unverified transaction.'''
+        if tx_height <= 0:
+            return
+        with self.lock:
+            self.queue[tx_height].add(tx_hash)
+            self.wakeup = True
+
+    def on_updated(self, event):
+        # new headers, or another chain
+        self.wakeup = True
 
     def run(self):
+        if self.network.blockchain() != self.blockchain:
+            self.blockchain = self.network.blockchain()
+            self.undo_verifications()
+        if not self.wakeup:
+            return
+        self.wakeup = False
         lh = self.network.get_local_height()
+        chain = self.network.blockchain()
         unverified = self.wallet.get_unverified_txs()
-        for tx_hash, tx_height in unverified.items():
+        with self.lock:
             # do not request merkle branch before headers are available
-            if (tx_height > 0) and (tx_height <= lh):
-                header = self.network.blockchain().read_header(tx_height)
-                index = tx_height // 2016
-                #print(index, header)
+            heights = [h for h in self.queue if h <= lh]
+        requests = []
+        for tx_height in sorted(heights):
+            block = self.blocks.get(tx_height)
+            if block is None:
+                header = chain.read_header(tx_height)
                 if header is None:
-                    if index not in self.requested_chunks  and self.network.interface:
-                        print("requesting chunk", index)
-                        #request = ('blockchain.block.get_chunk', [index])
-                        #self.network.send([request], self.verify_merkle)
+                    index = tx_height // 2016
+                    if index not in self.requested_chunks and self.network.interface:
+                        self.print_error("requesting chunk", index)
                         self.requested_chunks[index] = None
                         self.network.request_chunk(self.network.interface, index)
-                else:
-                    if tx_hash not in self.merkle_roots:
-                        request = ('blockchain.transaction.get_merkle',
-                                   [tx_hash, tx_height])
-                        self.network.send([request], self.verify_merkle)
-                        self.print_error('requested merkle', tx_hash)
-                        self.merkle_roots[tx_hash] = None
+                    continue
+                block = self.blocks[tx_height] = BlockProofs(header)
+            with self.lock:
+                tx_hashes = self.queue.pop(tx_height, ())
+            # skip transactions that were removed or moved since
+            tx_hashes = [tx_hash for tx_hash in tx_hashes
+                         if unverified.get(tx_hash) == tx_height
+                         and tx_hash not in self.merkle_roots]
+            for tx_hash in tx_hashes:
+                requests.append(('blockchain.transaction.get_merkle', [tx_hash, tx_height]))
+                self.merkle_roots[tx_hash] = None
+            block.pending += len(tx_hashes)
+            if block.pending == 0:
+                self.blocks.pop(tx_height)
+        if requests:
+            # sent together, so they are pipelined to the server
+            self.print_error('requesting %d merkle branches' % len(requests))
+            self.network.send(requests, self.verify_merkle)
 
-        if self.network.blockchain() != self.blockchain:
-            self.blockchain = self.network.blockchain()
-            self.undo_verifications()
+    def get_block(self, tx_height, requested_height):
+        if tx_height == requested_height and tx_height in self.blocks:
+            return self.blocks[tx_height]
+        header = self.network.blockchain().read_header(tx_height)
+        return BlockProofs(header) if header else None
+
+    def release_block(self, tx_height):
+        block = self.blocks.get(tx_height)
+        if block is None:
+            return
+        block.pending -= 1
+        if block.pending <= 0:
+            self.blocks.pop(tx_height)
 
     def verify_merkle(self, r):
+        tx_hash, requested_height = r['params']
+        try:
+            self._verify_merkle(r, tx_hash, requested_height)
+        finally:
+            self.release_block(requested_height)
+
+    def _verify_merkle(self, r, tx_hash, requested_height):
         if r.get('error'):
             self.print_error('received an error:', r)
             return
-        params = r['params']
         merkle = r['result']
         # Verify the hash of the server-provided merkle branch to a
         # transaction matches the merkle root of its block
-        tx_hash = params[0]
         tx_height = merkle.get('block_height')
         pos = merkle.get('pos')
-        merkle_root = self.hash_merkle_root(merkle['merkle'], tx_hash, pos)
-        header = self.network.blockchain().read_header(tx_height)
-        if not header or header.get('merkle_root') != merkle_root:
+        block = self.get_block(tx_height, requested_height)
+        try:
+            verified = block is not None and block.verify(tx_hash, merkle['merkle'], pos)
+        except (TypeError, ValueError):
+            verified = False
+        if not verified:
             # FIXME: we should make a fresh connection to a server to
             # recover from this, as this TX will now never verify
             self.print_error("merkle verification failed for", tx_hash)
             return
         # we passed all the tests
-        self.merkle_roots[tx_hash] = merkle_root
+        header = block.header
+        self.merkle_roots[tx_hash] = header.get('merkle_root')
         self.print_error("verified %s" % tx_hash)
-        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
-
-    def hash_merkle_root(self, merkle_s, target_hash, pos):
-        h = hash_decode(target_hash)
-        for i in range(len(merkle_s)):
-            item = merkle_s[i]
-            h = Hash(hash_decode(item) + h) if ((pos >> i) & 1) else Hash(h + hash_decode(item))
-        return hash_encode(h)
+        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos),
+                                    hash_header(header))
 
     def undo_verifications(self):
         height = self.blockchain.get_checkpoint()
+        self.blocks.clear()
         tx_hashes = self.wallet.undo_verifications(self.blockchain, height)
+        unverified = self.wallet.get_unverified_txs()
         for tx_hash in tx_hashes:
             self.print_error("redoing", tx_hash)
             self.merkle_roots.pop(tx_hash, None)
+            if tx_hash in unverified:
+                self.add(tx_hash, unverified[tx_hash])
+        self.wakeup = True
@@ -42,7 +42,7 @@ from .util import NotEnoughFunds, PrintError, UserCancelled, profiler, format_sa
 
 from .bitcoin import *
 from .version import *
-from .keystore import load_keystore, Hardware_KeyStore
+from .keystore import load_keystore, Hardware_KeyStore, close_derivation_pool
 from .storage import multisig_type
 
 from . import transaction
@@ -147,6 +147,62 @@ def sweep(privkeys, network, config, recipient, fee=None, imax=100):
     return tx
 
 
+def coinbase_balance(coinbase, local_height):
+    '''Balance of coinbase outputs given as (height, value) pairs.'''
+    c = u = x = 0
+    for tx_height, value in coinbase:
+        if tx_height + COINBASE_MATURITY > local_height:
+            x += value
+        elif tx_height > 0:
+            c += value
+        else:
+            u += value
+    return c, u, x
+
+
+class AddressCoins(object):
+    '''The coins of an address, derived from its history, txo and txi.'''
+
+    def __init__(self, address, received, sent):
+        # outpoint -> (height, value, is_coinbase)
+        self.received = received
+        # outpoint -> height of the spending transaction
+        self.sent = sent
+        # unspent outpoints -> coin, as returned by get_addr_utxo
+        self.utxos = {}
+        # balance, not counting coinbase outputs
+        self.confirmed = self.unconfirmed = 0
+        # (height, value) of coinbase outputs, whose maturity depends on
+        # the local height
+        self.coinbase = []
+        for txo, (tx_height, value, is_cb) in received.items():
+            if is_cb:
+                self.coinbase.append((tx_height, value))
+            elif tx_height > 0:
+                self.confirmed += value
+            else:
+                self.unconfirmed += value
+            if txo in sent:
+                if sent[txo] > 0:
+                    self.confirmed -= value
+                else:
+                    self.unconfirmed -= value
+                continue
+            prevout_hash, prevout_n = txo.split(':')
+            self.utxos[txo] = {
+                'address':address,
+                'value':value,
+                'prevout_n':int(prevout_n),
+                'prevout_hash':prevout_hash,
+                'height':tx_height,
+                'coinbase':is_cb
+            }
+
+    def get_balance(self, local_height):
+        c, u, x = coinbase_balance(self.coinbase, local_height)
+        return self.confirmed + c, self.unconfirmed + u, x
+
+
 class Abstract_Wallet(PrintError):
     """
     Wallet classes are created to handle various address generation methods.
@@ -175,6 +231,8 @@ class Abstract_Wallet(PrintError):
         self.load_addresses()
         self.load_transactions()
         self.build_reverse_history()
+        self.utxo_lock = threading.RLock()
+        self.build_coin_index()
 
         # load requests
         self.receive_requests = self.storage.get('payment_requests', {})
@@ -185,6 +243,14 @@ class Abstract_Wallet(PrintError):
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
         self.verified_tx = storage.get('verified_tx3', {})
+        # Hashes of the blocks of verified transactions, by height, and
+        # the verified transactions of each height.  Transactions
+        # verified by older versions have no block hash.
+        self.verified_heights = defaultdict(set)
+        for tx_hash, (tx_height, timestamp, pos) in self.verified_tx.items():
+            self.verified_heights[tx_height].add(tx_hash)
+        self.verified_blocks = {int(k): v for k, v in storage.get('verified_blocks', {}).items()
+                                if int(k) in self.verified_heights}
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
@@ -243,6 +309,11 @@ class Abstract_Wallet(PrintError):
             if write:
                 self.storage.write()
 
+    def save_verified_tx(self):
+        with self.lock:
+            self.storage.put('verified_tx3', self.verified_tx)
+            self.storage.put('verified_blocks', {str(k): v for k, v in self.verified_blocks.items()})
+
     def clear_history(self):
         with self.transaction_lock:
             self.txi = {}
@@ -253,6 +324,7 @@ class Abstract_Wallet(PrintError):
         with self.lock:
             self.history = {}
             self.tx_addr_hist = {}
+        self.build_coin_index()
 
     @profiler
     def build_reverse_history(self):
@@ -266,7 +338,7 @@ class Abstract_Wallet(PrintError):
     @profiler
     def check_history(self):
         save = False
-        mine_addrs = list(filter(lambda k: self.is_mine(self.history[k]), self.history.keys()))
+        mine_addrs = list(filter(lambda k: self.is_mine(k), self.history.keys()))
         if len(mine_addrs) != len(self.history.keys()):
             save = True
         for addr in mine_addrs:
@@ -293,6 +365,18 @@ class Abstract_Wallet(PrintError):
         if type(d) != dict: d={}
         self.receiving_addresses = d.get('receiving', [])
         self.change_addresses = d.get('change', [])
+        self.build_address_index()
+
+    def build_address_index(self):
+        # address -> (is_change, index); must be updated whenever the
+        # address lists change
+        self.address_index = {}
+        self.index_addresses(False, self.receiving_addresses, 0)
+        self.index_addresses(True, self.change_addresses, 0)
+
+    def index_addresses(self, for_change, addresses, start):
+        for i, address in enumerate(addresses, start):
+            self.address_index.setdefault(address, (for_change, i))
 
     def synchronize(self):
         pass
@@ -326,19 +410,17 @@ class Abstract_Wallet(PrintError):
         return changed
 
     def is_mine(self, address):
-        return address in self.get_addresses()
+        return address in self.address_index
 
     def is_change(self, address):
-        if not self.is_mine(address):
-            return False
-        return address in self.change_addresses
+        index = self.address_index.get(address)
+        return index is not None and index[0]
 
     def get_address_index(self, address):
-        if address in self.receiving_addresses:
-            return False, self.receiving_addresses.index(address)
-        if address in self.change_addresses:
-            return True, self.change_addresses.index(address)
-        raise Exception("Address not found", address)
+        index = self.address_index.get(address)
+        if index is None:
+            raise Exception("Address not found", address)
+        return index
 
     def export_private_key(self, address, password):
         """ extended WIF format """
@@ -360,18 +442,27 @@ class Abstract_Wallet(PrintError):
 
     def add_unverified_tx(self, tx_hash, tx_height):
         if tx_height == 0 and tx_hash in self.verified_tx:
-            self.verified_tx.pop(tx_hash)
-            self.verifier.merkle_roots.pop(tx_hash, None)
+            with self.lock:
+                self.remove_verified_tx(tx_hash)
+            if self.verifier:
+                self.verifier.merkle_roots.pop(tx_hash, None)
 
         # tx will be verified only if height > 0
         if tx_hash not in self.verified_tx:
             self.unverified_tx[tx_hash] = tx_height
+            if self.verifier:
+                self.verifier.add(tx_hash, tx_height)
 
-    def add_verified_tx(self, tx_hash, info):
+    def add_verified_tx(self, tx_hash, info, block_hash=None):
         # Remove from the unverified map and add to the verified map and
         self.unverified_tx.pop(tx_hash, None)
         with self.lock:
+            self.remove_verified_tx(tx_hash)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            tx_height = info[0]
+            self.verified_heights[tx_height].add(tx_hash)
+            if block_hash:
+                self.verified_blocks[tx_height] = block_hash
         height, conf, timestamp = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', tx_hash, height, conf, timestamp)
 
@@ -379,18 +470,39 @@ class Abstract_Wallet(PrintError):
         '''Returns a map from tx hash to transaction height'''
         return self.unverified_tx
 
+    def remove_verified_tx(self, tx_hash):
+        '''Call with self.lock held.'''
+        info = self.verified_tx.pop(tx_hash, None)
+        if info is None:
+            return
+        tx_height = info[0]
+        txs = self.verified_heights.get(tx_height)
+        if txs is not None:
+            txs.discard(tx_hash)
+            if not txs:
+                self.verified_heights.pop(tx_height)
+                self.verified_blocks.pop(tx_height, None)
+
     def undo_verifications(self, blockchain, height):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
+        # checkpointed blocks cannot be reorganized
+        height = max(height, len(blockchain.checkpoints) * 2016)
         with self.lock:
-            for tx_hash, item in list(self.verified_tx.items()):
-                tx_height, timestamp, pos = item
-                if tx_height >= height:
+            for tx_height in [h for h in self.verified_heights if h >= height]:
+                block_hash = self.verified_blocks.get(tx_height)
+                if block_hash is not None:
+                    if blockchain.get_hash(tx_height) == block_hash:
+                        continue
+                    undo = list(self.verified_heights[tx_height])
+                else:
+                    # verified before block hashes were recorded
                     header = blockchain.read_header(tx_height)
-                    # fixme: use block hash, not timestamp
-                    if not header or header.get('timestamp') != timestamp:
-                        self.verified_tx.pop(tx_hash, None)
-                        txs.add(tx_hash)
+                    undo = [tx_hash for tx_hash in self.verified_heights[tx_height]
+                            if not header or header.get('timestamp') != self.verified_tx[tx_hash][1]]
+                for tx_hash in undo:
+                    self.remove_verified_tx(tx_hash)
+                    txs.add(tx_hash)
         return txs
 
     def get_local_height(self):
@@ -543,7 +655,57 @@ class Abstract_Wallet(PrintError):
 
         return tx_hash, status, label, can_broadcast, can_bump, amount, fee, height, conf, timestamp, exp_n
 
-    def get_addr_io(self, address):
+    def build_coin_index(self):
+        with self.utxo_lock:
+            # address -> AddressCoins
+            self.addr_coins = {}
+            # outpoint -> coin, for the unspent outputs of all addresses
+            self.utxos = {}
+            # sums of AddressCoins.confirmed and unconfirmed
+            self.total_confirmed = self.total_unconfirmed = 0
+            # address -> AddressCoins.coinbase, if not empty
+            self.coinbase_coins = {}
+            # addresses whose coins must be recomputed
+            self.dirty_addresses = set(self.history.keys())
+
+    def invalidate_coins(self, addresses):
+        '''Called when the history, txo or txi of addresses changed.'''
+        with self.utxo_lock:
+            self.dirty_addresses.update(filter(None, addresses))
+
+    def update_addr_coins(self, address):
+        '''Call with utxo_lock held.'''
+        old = self.addr_coins.get(address)
+        if old is not None:
+            for txo in old.utxos:
+                self.utxos.pop(txo, None)
+            self.total_confirmed -= old.confirmed
+            self.total_unconfirmed -= old.unconfirmed
+        received, sent = self._get_addr_io(address)
+        coins = self.addr_coins[address] = AddressCoins(address, received, sent)
+        self.utxos.update(coins.utxos)
+        self.total_confirmed += coins.confirmed
+        self.total_unconfirmed += coins.unconfirmed
+        if coins.coinbase:
+            self.coinbase_coins[address] = coins.coinbase
+        else:
+            self.coinbase_coins.pop(address, None)
+        return coins
+
+    def refresh_coins(self):
+        '''Call with utxo_lock held.'''
+        while self.dirty_addresses:
+            self.update_addr_coins(self.dirty_addresses.pop())
+
+    def get_addr_coins(self, address):
+        with self.utxo_lock:
+            self.refresh_coins()
+            coins = self.addr_coins.get(address)
+            if coins is None:
+                coins = self.update_addr_coins(address)
+            return coins
+
+    def _get_addr_io(self, address):
         h = self.history.get(address, [])
         received = {}
         sent = {}
@@ -557,67 +719,55 @@ class Abstract_Wallet(PrintError):
                 sent[txi] = height
         return received, sent
 
+    def get_addr_io(self, address):
+        coins = self.get_addr_coins(address)
+        return dict(coins.received), dict(coins.sent)
+
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-        out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb
-            }
-            out[txo] = x
-        return out
+        coins = self.get_addr_coins(address)
+        return {txo: dict(x) for txo, x in coins.utxos.items()}
+
+    def get_utxo(self, outpoint):
+        '''The coin of an unspent output of the wallet, or None.'''
+        with self.utxo_lock:
+            self.refresh_coins()
+            x = self.utxos.get(outpoint)
+            return dict(x) if x else None
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
-        return sum([v for height, v, is_cb in received.values()])
+        coins = self.get_addr_coins(address)
+        return sum([v for height, v, is_cb in coins.received.values()])
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address):
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
-        return c, u, x
+        return self.get_addr_coins(address).get_balance(self.get_local_height())
 
     def get_spendable_coins(self, domain, config):
         confirmed_only = config.get('confirmed_only', False)
         return self.get_utxos(domain, exclude_frozen=True, mature=True, confirmed_only=confirmed_only)
 
     def get_utxos(self, domain = None, exclude_frozen = False, mature = False, confirmed_only = False):
-        coins = []
         if domain is None:
-            domain = self.get_addresses()
-        if exclude_frozen:
-            domain = set(domain) - self.frozen_addresses
-        for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos.values():
-                if confirmed_only and x['height'] <= 0:
-                    continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
-                    continue
-                coins.append(x)
+            with self.utxo_lock:
+                self.refresh_coins()
+                utxos = list(self.utxos.values())
+            if exclude_frozen:
+                utxos = [x for x in utxos if x['address'] not in self.frozen_addresses]
+        else:
+            if exclude_frozen:
+                domain = set(domain) - self.frozen_addresses
+            utxos = []
+            for addr in domain:
+                utxos.extend(self.get_addr_coins(addr).utxos.values())
+        coins = []
+        local_height = self.get_local_height()
+        for x in utxos:
+            if confirmed_only and x['height'] <= 0:
                 continue
+            if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > local_height:
+                continue
+            coins.append(dict(x))
         return coins
 
     def dummy_address(self):
@@ -633,11 +783,22 @@ class Abstract_Wallet(PrintError):
         return self.get_balance(self.frozen_addresses)
 
     def get_balance(self, domain=None):
+        local_height = self.get_local_height()
         if domain is None:
-            domain = self.get_addresses()
+            with self.utxo_lock:
+                self.refresh_coins()
+                cc, uu = self.total_confirmed, self.total_unconfirmed
+                coinbase = list(self.coinbase_coins.values())
+            xx = 0
+            for l in coinbase:
+                c, u, x = coinbase_balance(l, local_height)
+                cc += c
+                uu += u
+                xx += x
+            return cc, uu, xx
         cc = uu = xx = 0
         for addr in domain:
-            c, u, x = self.get_addr_balance(addr)
+            c, u, x = self.get_addr_coins(addr).get_balance(local_height)
             cc += c
             uu += u
             xx += x
@@ -656,60 +817,71 @@ class Abstract_Wallet(PrintError):
                     return addr
 
     def add_transaction(self, tx_hash, tx):
-        is_coinbase = tx.inputs()[0]['type'] == 'coinbase'
         with self.transaction_lock:
-            # add inputs
-            self.txi[tx_hash] = d = {}
-            for txi in tx.inputs():
-                addr = txi.get('address')
-                if txi['type'] != 'coinbase':
-                    prevout_hash = txi['prevout_hash']
-                    prevout_n = txi['prevout_n']
-                    ser = prevout_hash + ':%d'%prevout_n
-                if addr == "(pubkey)":
-                    addr = self.find_pay_to_pubkey_address(prevout_hash, prevout_n)
-                # find value from prev output
-                if addr and self.is_mine(addr):
-                    dd = self.txo.get(prevout_hash, {})
-                    for n, v, is_cb in dd.get(addr, []):
-                        if n == prevout_n:
-                            if d.get(addr) is None:
-                                d[addr] = []
-                            d[addr].append((ser, v))
-                            break
-                    else:
-                        self.pruned_txo[ser] = tx_hash
-
-            # add outputs
-            self.txo[tx_hash] = d = {}
-            for n, txo in enumerate(tx.outputs()):
-                ser = tx_hash + ':%d'%n
-                _type, x, v = txo
-                if _type == TYPE_ADDRESS:
-                    addr = x
-                elif _type == TYPE_PUBKEY:
-                    addr = bitcoin.public_key_to_p2pkh(bfh(x))
+            self._add_transaction(tx_hash, tx)
+
+    def _add_transaction(self, tx_hash, tx):
+        # must be called with transaction_lock held
+        is_coinbase = tx.inputs()[0]['type'] == 'coinbase'
+        # addresses whose coins change
+        changed = set(self.txi.get(tx_hash, {}).keys()) | set(self.txo.get(tx_hash, {}).keys())
+        # add inputs
+        self.txi[tx_hash] = d = {}
+        for txi in tx.inputs():
+            addr = txi.get('address')
+            if txi['type'] != 'coinbase':
+                prevout_hash = txi['prevout_hash']
+                prevout_n = txi['prevout_n']
+                ser = prevout_hash + ':%d'%prevout_n
+            if addr == "(pubkey)":
+                addr = self.find_pay_to_pubkey_address(prevout_hash, prevout_n)
+            # find value from prev output
+            if addr and self.is_mine(addr):
+                dd = self.txo.get(prevout_hash, {})
+                for n, v, is_cb in dd.get(addr, []):
+                    if n == prevout_n:
+                        if d.get(addr) is None:
+                            d[addr] = []
+                        d[addr].append((ser, v))
+                        break
                 else:
-                    addr = None
-                if addr and self.is_mine(addr):
-                    if d.get(addr) is None:
-                        d[addr] = []
-                    d[addr].append((n, v, is_coinbase))
-                # give v to txi that spends me
-                next_tx = self.pruned_txo.get(ser)
-                if next_tx is not None:
-                    self.pruned_txo.pop(ser)
-                    dd = self.txi.get(next_tx, {})
-                    if dd.get(addr) is None:
-                        dd[addr] = []
-                    dd[addr].append((ser, v))
-            # save
-            self.transactions[tx_hash] = tx
+                    self.pruned_txo[ser] = tx_hash
+
+        # add outputs
+        self.txo[tx_hash] = d = {}
+        for n, txo in enumerate(tx.outputs()):
+            ser = tx_hash + ':%d'%n
+            _type, x, v = txo
+            if _type == TYPE_ADDRESS:
+                addr = x
+            elif _type == TYPE_PUBKEY:
+                addr = bitcoin.public_key_to_p2pkh(bfh(x))
+            else:
+                addr = None
+            if addr and self.is_mine(addr):
+                if d.get(addr) is None:
+                    d[addr] = []
+                d[addr].append((n, v, is_coinbase))
+            # give v to txi that spends me
+            next_tx = self.pruned_txo.get(ser)
+            if next_tx is not None:
+                self.pruned_txo.pop(ser)
+                dd = self.txi.get(next_tx, {})
+                if dd.get(addr) is None:
+                    dd[addr] = []
+                dd[addr].append((ser, v))
+                changed.add(addr)
+        # save
+        self.transactions[tx_hash] = tx
+        changed.update(self.txi[tx_hash].keys())
+        changed.update(d.keys())
+        self.invalidate_coins(changed)
 
     def remove_transaction(self, tx_hash):
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             #tx = self.transactions.pop(tx_hash)
+            changed = set(self.txi.get(tx_hash, {}).keys()) | set(self.txo.get(tx_hash, {}).keys())
             for ser, hh in list(self.pruned_txo.items()):
                 if hh == tx_hash:
                     self.pruned_txo.pop(ser)
@@ -723,6 +895,7 @@ class Abstract_Wallet(PrintError):
                         if prev_hash == tx_hash:
                             l.remove(item)
                             self.pruned_txo[ser] = next_tx
+                            changed.add(addr)
                     if l == []:
                         dd.pop(addr)
                     else:
@@ -732,36 +905,61 @@ class Abstract_Wallet(PrintError):
                 self.txo.pop(tx_hash)
             except KeyError:
                 self.print_error("tx was not in history", tx_hash)
+            self.invalidate_coins(changed)
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
-        self.add_transaction(tx_hash, tx)
-        self.add_unverified_tx(tx_hash, tx_height)
+        self.receive_tx_batch([(tx_hash, tx, tx_height)])
 
-    def receive_history_callback(self, addr, hist, tx_fees):
-        with self.lock:
-            old_hist = self.history.get(addr, [])
-            for tx_hash, height in old_hist:
-                if (tx_hash, height) not in hist:
-                    # remove tx if it's not referenced in histories
-                    self.tx_addr_hist[tx_hash].remove(addr)
-                    if not self.tx_addr_hist[tx_hash]:
-                        self.remove_transaction(tx_hash)
-            self.history[addr] = hist
-
-        for tx_hash, tx_height in hist:
-            # add it in case it was previously unconfirmed
+    def receive_tx_batch(self, items):
+        '''Add a list of (tx_hash, tx, tx_height), taking the
+        transaction lock once.'''
+        with self.transaction_lock:
+            for tx_hash, tx, tx_height in items:
+                self._add_transaction(tx_hash, tx)
+        for tx_hash, tx, tx_height in items:
             self.add_unverified_tx(tx_hash, tx_height)
-            # add reference in tx_addr_hist
-            s = self.tx_addr_hist.get(tx_hash, set())
-            s.add(addr)
-            self.tx_addr_hist[tx_hash] = s
-            # if addr is new, we have to recompute txi and txo
-            tx = self.transactions.get(tx_hash)
-            if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
-                self.add_transaction(tx_hash, tx)
 
-        # Store fees
-        self.tx_fees.update(tx_fees)
+    def receive_history_callback(self, addr, hist, tx_fees):
+        self.receive_history_batch([(addr, hist, tx_fees)])
+
+    def receive_history_batch(self, items):
+        '''Store the histories of several addresses.  items is a list of
+        (addr, hist, tx_fees); each lock is taken once for the batch.'''
+        removed = []
+        with self.lock:
+            for addr, hist, tx_fees in items:
+                old_hist = self.history.get(addr, [])
+                if old_hist:
+                    new_items = set(map(tuple, hist))
+                    for tx_hash, height in old_hist:
+                        if (tx_hash, height) not in new_items:
+                            # remove tx if it's not referenced in histories
+                            self.tx_addr_hist[tx_hash].remove(addr)
+                            if not self.tx_addr_hist[tx_hash]:
+                                removed.append(tx_hash)
+                self.history[addr] = hist
+        self.invalidate_coins([addr for addr, hist, tx_fees in items])
+        for tx_hash in removed:
+            self.remove_transaction(tx_hash)
+
+        to_add = {}
+        for addr, hist, tx_fees in items:
+            for tx_hash, tx_height in hist:
+                # add it in case it was previously unconfirmed
+                self.add_unverified_tx(tx_hash, tx_height)
+                # add reference in tx_addr_hist
+                s = self.tx_addr_hist.get(tx_hash, set())
+                s.add(addr)
+                self.tx_addr_hist[tx_hash] = s
+                # if addr is new, we have to recompute txi and txo
+                tx = self.transactions.get(tx_hash)
+                if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
+                    to_add[tx_hash] = tx
+            # Store fees
+            self.tx_fees.update(tx_fees)
+        with self.transaction_lock:
+            for tx_hash, tx in to_add.items():
+                self._add_transaction(tx_hash, tx)
 
     def get_history(self, domain=None):
         # get domain
@@ -979,13 +1177,15 @@ class Abstract_Wallet(PrintError):
         if self.network:
             self.network.remove_jobs([self.synchronizer, self.verifier])
             self.synchronizer.release()
+            self.verifier.release()
             self.synchronizer = None
             self.verifier = None
             # Now no references to the syncronizer or verifier
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
+        close_derivation_pool()
         self.save_transactions()
-        self.storage.put('verified_tx3', self.verified_tx)
+        self.save_verified_tx()
         self.storage.write()
 
     def wait_until_synchronized(self, callback=None):
@@ -1082,8 +1282,7 @@ class Abstract_Wallet(PrintError):
                 break
         else:
             return
-        coins = self.get_addr_utxo(address)
-        item = coins.get(txid+':%d'%i)
+        item = self.get_utxo(txid+':%d'%i)
         if not item:
             return
         self.add_input_info(item)
@@ -1098,8 +1297,7 @@ class Abstract_Wallet(PrintError):
             txin['type'] = self.get_txin_type(address)
             # segwit needs value to sign
             if txin.get('value') is None and Transaction.is_segwit_input(txin):
-                received, spent = self.get_addr_io(address)
-                item = received.get(txin['prevout_hash']+':%d'%txin['prevout_n'])
+                item = self.get_addr_coins(address).received.get(txin['prevout_hash']+':%d'%txin['prevout_n'])
                 tx_height, value, is_cb = item
                 txin['value'] = value
             self.add_input_sig_info(txin, address)
@@ -1118,8 +1316,11 @@ class Abstract_Wallet(PrintError):
         # all the input txs, in which case we ask the network.
         tx = self.transactions.get(tx_hash)
         if not tx and self.network:
-            request = ('blockchain.transaction.get', [tx_hash])
-            tx = Transaction(self.network.synchronous_get(request))
+            raw = self.network.tx_cache.get(tx_hash)
+            if raw is None:
+                request = ('blockchain.transaction.get', [tx_hash])
+                raw = self.network.synchronous_get(request)
+            tx = Transaction(raw)
         return tx
 
     def add_hw_info(self, tx):
@@ -1438,6 +1639,9 @@ class Imported_Wallet(Simple_Wallet):
     def is_used(self, address):
         return False
 
+    def is_mine(self, address):
+        return address in self.addresses
+
     def is_change(self, address):
         return False
 
@@ -1486,16 +1690,17 @@ class Imported_Wallet(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self.history.pop(address, None)
+            self.invalidate_coins([address])
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
                 self.tx_fees.pop(tx_hash, None)
-                self.verified_tx.pop(tx_hash, None)
+                self.remove_verified_tx(tx_hash)
                 self.unverified_tx.pop(tx_hash, None)
                 self.transactions.pop(tx_hash, None)
                 # FIXME: what about pruned_txo?
 
-        self.storage.put('verified_tx3', self.verified_tx)
+        self.save_verified_tx()
         self.save_transactions()
 
         self.set_label(address, None)
@@ -1608,6 +1813,7 @@ class Deterministic_Wallet(Abstract_Wallet):
             k = self.num_unused_trailing_addresses(addresses)
             n = len(addresses) - k + value
             self.receiving_addresses = self.receiving_addresses[0:n]
+            self.build_address_index()
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit)
             self.save_addresses()
@@ -1636,28 +1842,50 @@ class Deterministic_Wallet(Abstract_Wallet):
                 if n > nmax: nmax = n
         return nmax + 1
 
+    def get_derivation_processes(self):
+        '''Number of processes used to derive large batches of addresses,
+        from the 'derivation_processes' config variable.'''
+        if self.network is None:
+            return 0
+        return self.network.config.get('derivation_processes', 0)
+
     def create_new_address(self, for_change=False):
+        assert type(for_change) is bool
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change, n):
+        '''Derive the next n addresses of a chain at once, and save the
+        address list once.'''
         assert type(for_change) is bool
         addr_list = self.change_addresses if for_change else self.receiving_addresses
-        n = len(addr_list)
-        x = self.derive_pubkeys(for_change, n)
-        address = self.pubkeys_to_address(x)
-        addr_list.append(address)
+        start = len(addr_list)
+        indices = range(start, start + n)
+        processes = self.get_derivation_processes() if n > 1 else 0
+        pubkeys = self.derive_pubkeys_batch(for_change, indices, processes)
+        addresses = [self.pubkeys_to_address(x) for x in pubkeys]
+        addr_list.extend(addresses)
+        self.index_addresses(for_change, addresses, start)
         self.save_addresses()
-        self.add_address(address)
-        return address
+        for address in addresses:
+            self.add_address(address)
+        return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
             if len(addresses) < limit:
-                self.create_new_address(for_change)
+                self.create_new_addresses(for_change, limit - len(addresses))
                 continue
-            if list(map(lambda a: self.address_is_old(a), addresses[-limit:] )) == limit*[False]:
+            # the last limit addresses must be unused
+            k = 0
+            for a in addresses[-limit:][::-1]:
+                if self.address_is_old(a):
+                    break
+                k += 1
+            if k == limit:
                 break
-            else:
-                self.create_new_address(for_change)
+            self.create_new_addresses(for_change, limit - k)
 
     def synchronize(self):
         with self.lock:
@@ -1668,13 +1896,14 @@ class Deterministic_Wallet(Abstract_Wallet):
                 if len(self.receiving_addresses) != len(self.keystore.keypairs):
                     pubkeys = self.keystore.keypairs.keys()
                     self.receiving_addresses = [self.pubkeys_to_address(i) for i in pubkeys]
+                    self.build_address_index()
                     self.save_addresses()
                     for addr in self.receiving_addresses:
                         self.add_address(addr)
 
     def is_beyond_limit(self, address, is_change):
         addr_list = self.get_change_addresses() if is_change else self.get_receiving_addresses()
-        i = addr_list.index(address)
+        i = self.get_address_index(address)[1]
         prev_addresses = addr_list[:max(0, i)]
         limit = self.gap_limit_for_change if is_change else self.gap_limit
         if len(prev_addresses) < limit:
@@ -1734,6 +1963,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkeys_batch(self, c, indices, processes=0):
+        return self.keystore.derive_pubkeys(c, indices, processes)
+
 
 
 
@@ -1768,6 +2000,11 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkeys_batch(self, c, indices, processes=0):
+        indices = list(indices)
+        pubkeys = [k.derive_pubkeys(c, indices, processes) for k in self.get_keystores()]
+        return [list(x) for x in zip(*pubkeys)]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -75,6 +75,7 @@ setup(
             'servers_testnet.json',
             'currencies.json',
             'checkpoints.json',
+            'headers_snapshot*.gz',
             'www/index.html',
             'wordlist/*.txt',
             'locale/*/LC_MESSAGES/electrum.mo',